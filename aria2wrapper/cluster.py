@@ -0,0 +1,234 @@
+# coding=utf-8
+
+import os
+import sys
+import time
+import subprocess
+
+from aria2wrapper.rpc import Aria2Client, DEFAULT_PORT
+from aria2wrapper.files import disk_free
+from aria2wrapper.enqueue import enqueue, normalize_entry
+from aria2wrapper.process import (Aria2ProcessTracker, Aria2Handle,
+                                  Aria2StartError, shutdown_aria2,
+                                  build_aria2_args)
+from aria2wrapper.session import compact_session
+from aria2wrapper.reconfigure import get_runtime_options
+from aria2wrapper.supervisor import Aria2Supervisor, SupervisorGroup
+
+
+class Aria2Instance(object):
+    def __init__(self, index, aria2_bin, config_dir, output_dir, rpc_port,
+                 rpc_secret=None, options=None):
+        self.index = index
+        self.aria2_bin = aria2_bin
+        self.output_dir = output_dir
+        self.rpc_port = rpc_port
+        self.rpc_secret = rpc_secret
+        self.options = options
+        self.session_path = os.path.join(config_dir,
+                                         'aria2-{}.session'.format(index))
+        self.tracker = Aria2ProcessTracker(
+            aria2_bin, os.path.join(config_dir, 'aria2-{}.pid'.format(index)),
+            scan=False)
+        self.client = Aria2Client(rpc_port, rpc_secret)
+        self.stat = None
+        self.free = None
+        self.placed = 0
+
+    @property
+    def running(self):
+        return self.tracker.get_process() is not None
+
+    def start(self):
+        # The spawned aria2c as an Aria2Handle, None if already running.
+        if self.running:
+            return None
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+        if os.path.exists(self.session_path):
+            try:
+                compact_session(self.session_path, self.output_dir)
+            except (IOError, OSError):
+                pass
+        args = build_aria2_args(self.aria2_bin, self.output_dir,
+                                self.session_path, self.rpc_secret,
+                                self.rpc_port, self.options)
+        handle = Aria2Handle(subprocess.Popen(args, close_fds=True),
+                             self.rpc_port, self.rpc_secret)
+        self.tracker.attach(handle.popen, {'rpc-port': self.rpc_port,
+                                           'rpc-secret': self.rpc_secret})
+        return handle
+
+    def stop(self, wait=True):
+        return shutdown_aria2(self.tracker, self.client, wait)
+
+    def refresh(self):
+        try:
+            self.stat = self.client.getGlobalStat()
+        except Exception:
+            self.stat = None
+        try:
+            self.free = disk_free(self.output_dir)
+        except OSError:
+            self.free = None
+        self.placed = 0
+
+    def load(self):
+        stat = self.stat or {}
+        return (int(stat.get('numActive', 0)) +
+                int(stat.get('numWaiting', 0)) + self.placed)
+
+
+class Aria2Cluster(object):
+    """Runs several aria2c, each with its own RPC port, session file and
+    download directory, and spreads new downloads over them.
+
+    ``start`` spawns the instances not running and leaves them be: one
+    that exits stays down until the next ``start``.  The daemon runs
+    ``supervise`` instead, which restarts each instance on its own.
+
+    A download goes to the instance with the fewest active plus waiting
+    downloads.  Ties go to the lower current download speed, then to the
+    most free space.  Instances with less than ``min_free`` bytes free
+    are skipped.  Instance stats are refreshed at most every
+    ``refresh_interval`` seconds; placements made since the last refresh
+    count towards the load, so a burst does not all land on one instance.
+    """
+
+    def __init__(self, instances, refresh_interval=1.0, min_free=0):
+        self.instances = instances
+        self.refresh_interval = refresh_interval
+        self.min_free = min_free
+        self._refreshed = 0
+
+    @classmethod
+    def from_settings(cls, aria2_bin, config_dir, settings, **kwargs):
+        # 'instances': [{'dir': ..., 'rpc-port': ...}, ...].  Ports default
+        # to consecutive ports after the main daemon's.
+        base_port = settings.get('rpc-port') or DEFAULT_PORT
+        options = get_runtime_options(settings)
+        instances = []
+        for index, config in enumerate(settings.get('instances') or []):
+            instances.append(Aria2Instance(
+                index, aria2_bin, config_dir,
+                config.get('dir') or settings.get('dir') or
+                os.path.join(os.path.expanduser('~'), 'Downloads'),
+                config.get('rpc-port') or base_port + 1 + index,
+                settings.get('rpc-secret') or None, options))
+        return cls(instances, **kwargs)
+
+    def start(self, ready_timeout=10):
+        """Spawns the instances not running and waits for their RPC
+        ports.  Returns ``(index, error)`` per instance, error being None
+        when it is up; one that did not come up in time is stopped."""
+        handles = [(instance, instance.start())
+                   for instance in self.instances]
+        result = []
+        for instance, handle in handles:
+            error = None
+            if handle is not None:
+                try:
+                    handle.wait_ready(ready_timeout)
+                except Aria2StartError as e:
+                    error = str(e)
+                    instance.stop()
+            result.append((instance.index, error))
+        return result
+
+    def supervise(self, ready_timeout=10, **kwargs):
+        """A SupervisorGroup keeping every instance running, restarted
+        with Aria2Supervisor's backoff (``kwargs``: its settings)."""
+        def supervisor(instance):
+            def log(message):
+                sys.stderr.write('instance {}: {}\n'.format(instance.index,
+                                                            message))
+            return Aria2Supervisor(
+                lambda: self._spawn(instance, ready_timeout),
+                instance.stop, log=log, **kwargs)
+        return SupervisorGroup([supervisor(instance)
+                                for instance in self.instances])
+
+    def _spawn(self, instance, ready_timeout):
+        # A fresh aria2c, ready: one still running from before is
+        # stopped first, as the main aria2c is.
+        instance.stop()
+        handle = instance.start()
+        if handle is None:
+            raise RuntimeError('aria2c did not stop')
+        try:
+            handle.wait_ready(ready_timeout)
+        except Aria2StartError:
+            instance.stop()
+            raise
+        return handle
+
+    def stop(self, wait=True):
+        return [instance.stop(wait) for instance in self.instances]
+
+    def close(self):
+        for instance in self.instances:
+            instance.client.close()
+
+    def refresh(self, force=False):
+        if not force and time.time() - self._refreshed < \
+                self.refresh_interval:
+            return
+        for instance in self.instances:
+            instance.refresh()
+        self._refreshed = time.time()
+
+    def choose(self):
+        self.refresh()
+        candidates = [instance for instance in self.instances
+                      if instance.stat is not None and
+                      (instance.free is None or
+                       instance.free >= self.min_free)]
+        if not candidates:
+            raise RuntimeError('no aria2 instance available')
+        return min(candidates,
+                   key=lambda i: (i.load(),
+                                  int(i.stat.get('downloadSpeed', 0)),
+                                  -(i.free or 0)))
+
+    def add_uri(self, uris, options=None):
+        instance = self.choose()
+        gid = instance.client.addUri(uris, options or {})
+        instance.placed += 1
+        return instance.index, gid
+
+    def enqueue(self, entries, batch_size=200, **kwargs):
+        # Each batch goes to the least loaded instance at that moment.
+        batch = []
+        stats = []
+
+        def flush():
+            instance = self.choose()
+            instance.placed += len(batch)
+            stats.append(enqueue(instance.client, batch,
+                                 batch_size=batch_size, workers=1,
+                                 **kwargs))
+        for entry in entries:
+            batch.append(normalize_entry(entry))
+            if len(batch) >= batch_size:
+                flush()
+                batch = []
+        if batch:
+            flush()
+        return stats
+
+    def status(self):
+        self.refresh(force=True)
+        total = {'downloadSpeed': 0, 'uploadSpeed': 0, 'numActive': 0,
+                 'numWaiting': 0, 'numStopped': 0, 'instances': []}
+        for instance in self.instances:
+            stat = instance.stat or {}
+            for key in ('downloadSpeed', 'uploadSpeed', 'numActive',
+                        'numWaiting', 'numStopped'):
+                total[key] += int(stat.get(key, 0))
+            total['instances'].append({'index': instance.index,
+                                       'dir': instance.output_dir,
+                                       'rpc-port': instance.rpc_port,
+                                       'running': instance.stat is not None,
+                                       'free': instance.free,
+                                       'stat': stat})
+        return total
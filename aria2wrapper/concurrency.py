@@ -0,0 +1,184 @@
+# coding=utf-8
+
+import threading
+from collections import deque
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+KNOBS = ('max-concurrent-downloads', 'split', 'max-connection-per-server')
+
+DEFAULT_LIMITS = {'max-concurrent-downloads': (1, 32),
+                  'split': (1, 32),
+                  'max-connection-per-server': (1, 16)}
+
+
+def host_of(uri):
+    return urlparse(uri).hostname or ''
+
+
+class ConcurrencyController(object):
+    """Tunes aria2's concurrency options from observed throughput.
+
+    Hill climbing in both directions with multiplicative back-off: each
+    step moves one knob by one, up first.  If throughput improves by
+    more than ``tolerance`` the knob keeps going that way.  Otherwise the
+    move is undone, the next step measures the options as they were
+    again, and the knob is tried the other way (then the next knob), so
+    a link that does better with fewer connections gets fewer.  If any
+    server's error rate over the step exceeds ``error_threshold``,
+    ``split`` and ``max-connection-per-server`` are halved instead.
+    Every value stays within ``limits``.  Like any global option change,
+    ``split`` and ``max-connection-per-server`` apply to downloads aria2
+    starts afterwards.
+    """
+
+    def __init__(self, options, limits=None, tolerance=0.05,
+                 error_threshold=0.2):
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.options = dict((knob, self._clamp(knob, int(options[knob])))
+                            for knob in KNOBS)
+        self.tolerance = tolerance
+        self.error_threshold = error_threshold
+        # Throughput with the options kept; None until measured.
+        self.best = None
+        # The next (knob index, direction) to try.
+        self._next = (0, 1)
+        self._last_move = None
+        self._results = {}
+
+    def _clamp(self, knob, value):
+        low, high = self.limits[knob]
+        return max(low, min(high, value))
+
+    def record_result(self, host, succeeded):
+        ok, failed = self._results.get(host, (0, 0))
+        self._results[host] = (ok + 1, failed) if succeeded \
+            else (ok, failed + 1)
+
+    def error_rates(self):
+        return dict((host, failed / float(ok + failed))
+                    for host, (ok, failed) in self._results.items())
+
+    def step(self, throughput):
+        """Feeds the throughput of the last interval, returns the options
+        to change (possibly empty)."""
+        before = dict(self.options)
+        rates = self.error_rates()
+        self._results = {}
+        if rates and max(rates.values()) > self.error_threshold:
+            for knob in ('split', 'max-connection-per-server'):
+                self.options[knob] = self._clamp(knob,
+                                                 self.options[knob] // 2)
+            self._last_move = None
+            self.best = None
+        elif self._last_move is None:
+            # The kept options, measured as they are.
+            self.best = throughput
+            self._move()
+        else:
+            index, previous, direction = self._last_move
+            if throughput > self.best * (1 + self.tolerance):
+                self.best = throughput
+                self._next = (index, direction)
+                self._move()
+            else:
+                # Neutral or worse: undo, and try the other way (after
+                # up) or the next knob (after down) once re-measured.
+                self.options[KNOBS[index]] = previous
+                self._last_move = None
+                self._next = (index, -1) if direction > 0 \
+                    else ((index + 1) % len(KNOBS), 1)
+        return dict((knob, str(value))
+                    for knob, value in self.options.items()
+                    if before[knob] != value)
+
+    def _move(self):
+        index, direction = self._next
+        for _ in range(2 * len(KNOBS)):
+            knob = KNOBS[index]
+            value = self._clamp(knob, self.options[knob] + direction)
+            if value != self.options[knob]:
+                self._last_move = (index, self.options[knob], direction)
+                self.options[knob] = value
+                return
+            if direction > 0:
+                direction = -1
+            else:
+                index, direction = (index + 1) % len(KNOBS), 1
+        self._last_move = None
+
+
+class Aria2ConcurrencyTuner(object):
+    """Runs a ConcurrencyController against a live aria2 over RPC.
+
+    ``throughput`` is a callable returning bytes/s for the last interval,
+    e.g. ``lambda: sampler.rate(interval)``; by default the current
+    ``downloadSpeed`` is read.  Hook ``on_event`` to the monitor so
+    completions and errors feed the per-server error rates.
+    """
+
+    def __init__(self, client, interval=30, limits=None, throughput=None,
+                 **kwargs):
+        self.client = client
+        self.interval = interval
+        self.limits = limits
+        self.kwargs = kwargs
+        self.throughput = throughput or (
+            lambda: int(client.getGlobalStat()['downloadSpeed']))
+        self.controller = None
+        # (gid, succeeded) from the monitor, looked up at the next step.
+        self._results = deque(maxlen=10000)
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def on_event(self, method, gid):
+        # Runs on the monitor's thread: no RPC here.
+        if method in ('aria2.onDownloadComplete', 'aria2.onDownloadError'):
+            self._results.append((gid,
+                                  method == 'aria2.onDownloadComplete'))
+
+    def _record_results(self):
+        results = []
+        while self._results:
+            results.append(self._results.popleft())
+        if not results:
+            return
+        answers = self.client.multicall([('aria2.tellStatus', [gid,
+                                                               ['files']])
+                                         for gid, _ in results])
+        for (gid, succeeded), status in zip(results, answers):
+            try:
+                uri = status['files'][0]['uris'][0]['uri']
+            except (TypeError, KeyError, IndexError):
+                continue
+            self.controller.record_result(host_of(uri), succeeded)
+
+    def step(self):
+        if self.controller is None:
+            self.controller = ConcurrencyController(
+                self.client.getGlobalOption(), self.limits, **self.kwargs)
+        self._record_results()
+        changes = self.controller.step(self.throughput())
+        if changes:
+            self.client.changeGlobalOption(changes)
+        return changes
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='aria2-concurrency')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.step()
+            except Exception:
+                pass
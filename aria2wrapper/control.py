@@ -0,0 +1,133 @@
+# coding=utf-8
+
+# Control socket of a running wrapper.  One JSON object per line each way:
+#
+#   -> {"command": "status", "args": {}}
+#   <- {"ok": true, "result": {...}}     or     {"ok": false, "error": "..."}
+#
+# A connection may carry any number of requests.
+
+import os
+import json
+import socket
+import threading
+
+
+class ControlError(Exception):
+    pass
+
+
+class ControlServer(object):
+    def __init__(self, path, handlers):
+        if not hasattr(socket, 'AF_UNIX'):
+            raise NotImplementedError()
+        self.path = path
+        self.handlers = handlers
+        self._sock = None
+        self._thread = None
+
+    def start(self):
+        if os.path.exists(self.path):
+            # A stale socket from a wrapper that died; a live one answers.
+            try:
+                ControlClient(self.path, timeout=1).close()
+            except socket.error:
+                os.remove(self.path)
+            else:
+                raise ControlError('another wrapper is listening on ' +
+                                   self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        sock.listen(16)
+        self._sock = sock
+        self._thread = threading.Thread(target=self._accept,
+                                        name='aria2-control')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        sock, self._sock = self._sock, None
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            sock.close()
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def _accept(self):
+        while self._sock is not None:
+            try:
+                connection, _ = self._sock.accept()
+            except (socket.error, AttributeError):
+                return
+            thread = threading.Thread(target=self._serve, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, request):
+        handler = self.handlers.get(request.get('command'))
+        if handler is None:
+            return {'ok': False, 'error': 'unknown command: {}'.
+                    format(request.get('command'))}
+        try:
+            return {'ok': True, 'result': handler(**(request.get('args') or
+                                                     {}))}
+        except Exception as e:
+            return {'ok': False, 'error': '{}: {}'.format(type(e).__name__,
+                                                          e)}
+
+    def _serve(self, connection):
+        f = connection.makefile('rwb')
+        try:
+            for line in f:
+                try:
+                    request = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    request = None
+                if isinstance(request, dict):
+                    response = self.handle(request)
+                else:
+                    response = {'ok': False, 'error': 'bad request'}
+                f.write(json.dumps(response).encode('utf-8') + b'\n')
+                f.flush()
+        except socket.error:
+            pass
+        finally:
+            f.close()
+            connection.close()
+
+
+class ControlClient(object):
+    def __init__(self, path, timeout=30):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        try:
+            self.sock.connect(path)
+        except socket.error:
+            self.sock.close()
+            raise
+        self._file = self.sock.makefile('rwb')
+
+    def request(self, command, **args):
+        self._file.write(json.dumps({'command': command, 'args': args}).
+                         encode('utf-8') + b'\n')
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise ControlError('connection closed')
+        response = json.loads(line.decode('utf-8'))
+        if not response.get('ok'):
+            raise ControlError(response.get('error'))
+        return response.get('result')
+
+    def close(self):
+        self._file.close()
+        self.sock.close()
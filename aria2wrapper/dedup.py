@@ -0,0 +1,428 @@
+# coding=utf-8
+
+import os
+import sys
+import time
+import errno
+import ftplib
+import shutil
+import sqlite3
+import threading
+try:
+    from Queue import Queue
+    from urlparse import urlsplit, urlunsplit
+    from urllib import unquote
+    from urllib2 import Request, urlopen
+except ImportError:
+    from queue import Queue
+    from urllib.parse import urlsplit, urlunsplit, unquote
+    from urllib.request import Request, urlopen
+
+from aria2wrapper.enqueue import normalize_entry
+from aria2wrapper.files import free_name, file_digest
+
+_SCHEMES = ('http', 'https', 'ftp')
+_DEFAULT_PORTS = {'http': 80, 'https': 443, 'ftp': 21}
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS objects (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS objects_last_used ON objects (last_used);
+CREATE TABLE IF NOT EXISTS entries (
+    uri TEXT PRIMARY KEY,
+    digest TEXT NOT NULL,
+    etag TEXT,
+    last_modified TEXT,
+    size INTEGER,
+    name TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS entries_digest ON entries (digest);
+CREATE TABLE IF NOT EXISTS counters (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+'''
+
+_COUNTERS = ('lookups', 'hits', 'bytes_saved', 'stale', 'evicted')
+
+# ioctl(dest, FICLONE, src): a copy-on-write clone (btrfs, xfs, ...).
+_FICLONE = 0x40049409
+
+
+def normalize_uri(uri):
+    """The form a URI is indexed under: scheme and host in lower case, no
+    credentials, default port or fragment."""
+    parts = urlsplit(uri)
+    scheme = parts.scheme.lower()
+    host = parts.hostname or ''
+    if ':' in host:
+        host = '[{}]'.format(host)
+    if parts.port and parts.port != _DEFAULT_PORTS.get(scheme):
+        host += ':{}'.format(parts.port)
+    return urlunsplit((scheme, host, parts.path or '/', parts.query, ''))
+
+
+class _HeadRequest(Request):
+    def get_method(self):
+        return 'HEAD'
+
+
+def _ftp_validators(uri, timeout):
+    parts = urlsplit(uri)
+    path = unquote(parts.path)
+    ftp = ftplib.FTP(timeout=timeout)
+    try:
+        ftp.connect(parts.hostname, parts.port or _DEFAULT_PORTS['ftp'])
+        if parts.username:
+            ftp.login(unquote(parts.username),
+                      unquote(parts.password or ''))
+        else:
+            ftp.login()
+        # SIZE counts bytes only in binary mode.
+        ftp.voidcmd('TYPE I')
+        try:
+            size = ftp.size(path)
+        except ftplib.error_perm:
+            size = None
+        try:
+            modified = ftp.voidcmd('MDTM ' + path)[4:].strip() or None
+        except ftplib.error_perm:
+            modified = None
+        return None, modified, size
+    finally:
+        try:
+            ftp.quit()
+        except Exception:
+            ftp.close()
+
+
+def fetch_validators(uri, timeout=10):
+    """``(etag, last_modified, size)`` of ``uri`` from a HEAD request, or
+    for ftp:// from MDTM and SIZE (a HEAD there would start a RETR);
+    None for what the server does not send."""
+    if urlsplit(uri).scheme.lower() == 'ftp':
+        return _ftp_validators(uri, timeout)
+    response = urlopen(_HeadRequest(uri), timeout=timeout)
+    try:
+        headers = response.info()
+        length = headers.get('Content-Length')
+        return (headers.get('ETag'), headers.get('Last-Modified'),
+                int(length) if length and length.isdigit() else None)
+    finally:
+        response.close()
+
+
+def validators_match(stored, current):
+    # An ETag decides if both sides have one, then Last-Modified.  A copy
+    # the server gives neither for cannot be verified.
+    etag, last_modified, size = stored
+    if size is not None and current[2] is not None and size != current[2]:
+        return False
+    if etag and current[0]:
+        return etag == current[0]
+    if last_modified and current[1]:
+        return last_modified == current[1]
+    return False
+
+
+def _encode(path):
+    if isinstance(path, bytes):
+        return path
+    return path.encode(sys.getfilesystemencoding() or 'utf-8')
+
+
+def reflink(source, target):
+    """Clones ``source`` as ``target`` sharing its blocks until either is
+    written; raises OSError where the filesystem cannot."""
+    if sys.platform.startswith('linux'):
+        import fcntl
+        fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        try:
+            with open(source, 'rb') as f:
+                fcntl.ioctl(fd, _FICLONE, f.fileno())
+        except (IOError, OSError):
+            os.close(fd)
+            os.remove(target)
+            raise
+        os.close(fd)
+    elif sys.platform == 'darwin':
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        if libc.clonefile(_encode(source), _encode(target), 0) != 0:
+            raise OSError(ctypes.get_errno(), 'clonefile failed')
+    else:
+        raise OSError(errno.EOPNOTSUPP, 'reflinks are not supported')
+
+
+def place(source, target, methods):
+    """Makes ``target`` a copy of ``source`` by the first of ``methods``
+    ('reflink', 'hardlink', 'copy') that works; returns which."""
+    for method in methods:
+        try:
+            if method == 'reflink':
+                reflink(source, target)
+            elif method == 'hardlink':
+                os.link(source, target)
+            else:
+                shutil.copyfile(source, target)
+            return method
+        except (IOError, OSError, AttributeError):
+            continue
+    raise OSError(errno.EXDEV, 'cannot place {} at {}'.format(source,
+                                                              target))
+
+
+class DedupCache(object):
+    """A content-addressed store of finished downloads.
+
+    ``add`` files a download under its content hash in ``cache_dir``
+    (a hard link, else a reflink, else a copy) and indexes each of its
+    normalized URIs with the ETag, Last-Modified and size the server
+    reported.  ``fetch`` looks a URI up, checks the stored copy is
+    unchanged and the server still reports the same validators (one HEAD
+    request), and then reflinks or hard links the copy into place.  Only
+    on a different filesystem does it copy.  The store is kept under
+    ``max_size`` bytes by evicting the least recently used content.
+    Counters persist in the index, so hit rate and bytes saved cover
+    every process and run.
+    """
+
+    def __init__(self, index_path, cache_dir, max_size=10 << 30,
+                 algorithm='sha256', check=fetch_validators):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.algorithm = algorithm
+        self.check = check
+        self._db = sqlite3.connect(index_path, timeout=10,
+                                   check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+
+    def _object_path(self, digest):
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def _count(self, **counts):
+        self._db.executemany(
+            'INSERT OR IGNORE INTO counters VALUES (?, 0)',
+            [(name,) for name in counts])
+        self._db.executemany(
+            'UPDATE counters SET value = value + ? WHERE name = ?',
+            [(value, name) for name, value in counts.items()])
+
+    def _drop(self, digest):
+        try:
+            os.remove(self._object_path(digest))
+        except OSError:
+            pass
+        self._db.execute('DELETE FROM entries WHERE digest = ?', (digest,))
+        self._db.execute('DELETE FROM objects WHERE digest = ?', (digest,))
+
+    def lookup(self, uri):
+        with self._lock:
+            row = self._db.execute(
+                'SELECT e.digest, e.etag, e.last_modified, e.size, e.name, '
+                'o.mtime FROM entries e JOIN objects o USING (digest) '
+                'WHERE e.uri = ?', (normalize_uri(uri),)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('digest', 'etag', 'last_modified', 'size', 'name',
+                         'mtime'), row))
+
+    def fetch(self, uris, directory, name=None):
+        """Places a verified copy of the content of ``uris`` in
+        ``directory`` (as ``name``, or the name it was downloaded under;
+        never over another file).  Returns its path, or None on a miss."""
+        uris = [uri for uri in uris
+                if urlsplit(uri).scheme.lower() in _SCHEMES]
+        found = None
+        for uri in uris:
+            entry = self.lookup(uri)
+            if entry is not None:
+                found = uri
+                break
+        if found is None:
+            with self._lock, self._db:
+                self._count(lookups=1)
+            return None
+        source = self._object_path(entry['digest'])
+        try:
+            stat = os.stat(source)
+            fresh = stat.st_size == entry['size'] and \
+                stat.st_mtime == entry['mtime']
+        except OSError:
+            fresh = False
+        if not fresh:
+            # Gone, or written to through a hard link.
+            with self._lock, self._db:
+                self._drop(entry['digest'])
+                self._count(lookups=1, stale=1)
+            return None
+        try:
+            current = self.check(found)
+        except Exception:
+            current = None
+        if current is None or not validators_match(
+                (entry['etag'], entry['last_modified'], entry['size']),
+                current):
+            with self._lock, self._db:
+                if current is not None:
+                    # The server has something else under that URI now.
+                    self._db.execute('DELETE FROM entries WHERE uri = ?',
+                                     (normalize_uri(found),))
+                self._count(lookups=1, stale=1 if current else 0)
+            return None
+        directory = os.path.expanduser(directory)
+        target = os.path.join(directory, name or entry['name'])
+        if not (os.path.exists(target) and os.path.samefile(source, target)):
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            target = free_name(target)
+            place(source, target, ('reflink', 'hardlink', 'copy'))
+        with self._lock, self._db:
+            self._db.execute('UPDATE objects SET last_used = ? '
+                             'WHERE digest = ?',
+                             (time.time(), entry['digest']))
+            self._count(lookups=1, hits=1, bytes_saved=entry['size'])
+        return target
+
+    def add(self, uris, path, validators):
+        """Files the downloaded ``path`` of ``uris``; ``validators`` are
+        ``(etag, last_modified, size)`` as from ``fetch_validators``.
+        Content the server gives no validators for is not filed, as it
+        could never be verified.  Returns the digest or None."""
+        etag, last_modified, _ = validators
+        if not etag and not last_modified:
+            return None
+        digest = file_digest(path, self.algorithm)
+        size = os.path.getsize(path)
+        source = self._object_path(digest)
+        if not os.path.exists(source):
+            if not os.path.isdir(os.path.dirname(source)):
+                os.makedirs(os.path.dirname(source))
+            temp_path = '{}.{}.tmp'.format(source, os.getpid())
+            place(path, temp_path, ('hardlink', 'reflink', 'copy'))
+            os.rename(temp_path, source)
+        with self._lock, self._db:
+            self._db.execute(
+                'INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)',
+                (digest, size, os.stat(source).st_mtime, time.time()))
+            self._db.executemany(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)',
+                [(normalize_uri(uri), digest, etag, last_modified, size,
+                  os.path.basename(path)) for uri in uris
+                 if urlsplit(uri).scheme.lower() in _SCHEMES])
+            self._evict()
+        return digest
+
+    def _evict(self):
+        total = self._db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM objects').fetchone()[0]
+        while total > self.max_size:
+            oldest = self._db.execute(
+                'SELECT digest, size FROM objects ORDER BY last_used '
+                'LIMIT 100').fetchall()
+            if not oldest:
+                break
+            for digest, size in oldest:
+                if total <= self.max_size:
+                    break
+                self._drop(digest)
+                self._count(evicted=1)
+                total -= size
+
+    def stats(self):
+        with self._lock:
+            counters = dict((name, 0) for name in _COUNTERS)
+            counters.update(self._db.execute(
+                'SELECT name, value FROM counters').fetchall())
+            objects, size = self._db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) '
+                'FROM objects').fetchone()
+        counters.update({'objects': objects, 'size': size,
+                         'hit_rate': counters['hits'] /
+                         float(max(counters['lookups'], 1))})
+        return counters
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class Aria2Dedup(object):
+    """Keeps aria2 from fetching what the cache already has.
+
+    ``filter`` passes on the entries (as for ``enqueue``) that are not
+    in the cache, and places the cached ones where aria2 would have saved
+    them.  Hook ``on_event`` to the monitor: downloads of a single
+    file from http(s)/ftp are added to the cache on a thread of their
+    own once aria2 reports them complete.
+    """
+
+    def __init__(self, client, cache, default_dir):
+        self.client = client
+        self.cache = cache
+        self.default_dir = default_dir
+        self._gids = Queue()
+        self._thread = None
+
+    def filter(self, entries, on_hit=None):
+        """Yields the entries to send to aria2; ``on_hit`` is called with
+        ``(uris, path)`` for each one placed from the cache instead."""
+        for entry in entries:
+            uris, options = normalize_entry(entry)
+            try:
+                path = self.cache.fetch(
+                    uris, options.get('dir') or self.default_dir,
+                    options.get('out'))
+            except (IOError, OSError):
+                path = None
+            if path is None:
+                yield uris, options
+            elif on_hit is not None:
+                on_hit(uris, path)
+
+    def on_event(self, method, gid):
+        if method == 'aria2.onDownloadComplete':
+            self._gids.put(gid)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='aria2-dedup')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._gids.put(None)
+        if self._thread is not None:
+            self._thread.join()
+
+    def stats(self):
+        return self.cache.stats()
+
+    def record(self, gid):
+        files = self.client.tellStatus(gid, ['files'])['files']
+        if len(files) != 1 or not files[0]['path'] or \
+                not os.path.isfile(files[0]['path']):
+            return None
+        uris = sorted(set(uri['uri'] for uri in files[0]['uris']))
+        for uri in uris:
+            if urlsplit(uri).scheme.lower() in _SCHEMES:
+                return self.cache.add(uris, files[0]['path'],
+                                      self.cache.check(uri))
+        return None
+
+    def _run(self):
+        while True:
+            gid = self._gids.get()
+            if gid is None:
+                return
+            try:
+                self.record(gid)
+            except Exception:
+                pass
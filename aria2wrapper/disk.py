@@ -0,0 +1,290 @@
+# coding=utf-8
+
+import os
+import re
+import sys
+import json
+import time
+import threading
+import subprocess
+
+from aria2wrapper.files import atomic_write, disk_free
+
+# aria2 options chosen from the download directory's profile.  aria2 only
+# reads them at startup.
+DISK_OPTIONS = ('file-allocation', 'disk-cache', 'enable-mmap')
+
+NETWORK_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smb', 'smb2', 'smb3',
+                       'smbfs', 'afpfs', 'webdav', 'davfs', 'fuse.sshfs',
+                       'fuse.rclone', 'sshfs', '9p', 'ceph', 'glusterfs')
+MEMORY_FILESYSTEMS = ('tmpfs', 'ramfs')
+COPY_ON_WRITE_FILESYSTEMS = ('btrfs', 'zfs', 'apfs')
+NON_SPARSE_FILESYSTEMS = ('vfat', 'msdos', 'msdosfs', 'exfat')
+
+# Below this a disk is slow enough that batching writes pays off.
+SLOW_WRITE_SPEED = 50 << 20
+
+
+def _existing(path):
+    path = os.path.realpath(os.path.expanduser(path))
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    return path
+
+
+def _unescape_mount(path):
+    # /proc/mounts writes spaces, tabs and backslashes as octal escapes.
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), path)
+
+
+def _mounts():
+    if sys.platform.startswith('linux'):
+        with open('/proc/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 3:
+                    yield _unescape_mount(fields[1]), fields[2]
+    elif sys.platform == 'darwin':
+        output = subprocess.check_output(['mount']).decode('utf-8',
+                                                           'replace')
+        for line in output.splitlines():
+            match = re.match(r'^.* on (.*) \(([^,)]+)', line)
+            if match:
+                yield match.group(1), match.group(2)
+
+
+def filesystem_type(path):
+    """The type of the filesystem holding ``path`` ('ext4', 'nfs4', 'apfs'
+    ...), or 'unknown'."""
+    path = _existing(path)
+    best, fs_type = '', 'unknown'
+    try:
+        mounts = list(_mounts())
+    except (IOError, OSError, subprocess.CalledProcessError):
+        return fs_type
+    for mount_point, mount_type in mounts:
+        if (path == mount_point or
+                path.startswith(mount_point.rstrip(os.sep) + os.sep)) and \
+                len(mount_point) >= len(best):
+            best, fs_type = mount_point, mount_type
+    return fs_type
+
+
+def _fallocate(fd, size):
+    # fallocate(2), unlike posix_fallocate(3), fails instead of quietly
+    # writing zeros where the filesystem cannot allocate.
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if libc.fallocate(fd, 0, ctypes.c_int64(0), ctypes.c_int64(size)) != 0:
+        raise OSError(ctypes.get_errno(), 'fallocate failed')
+
+
+def probe_fallocate(path, size=64 << 20):
+    """Seconds to fallocate ``size`` bytes in ``path``, or None when the
+    filesystem (or platform) cannot."""
+    if not sys.platform.startswith('linux'):
+        return None
+    probe_path = os.path.join(path, '.aria2-wrapper-fallocate')
+    fd = os.open(probe_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        start = time.time()
+        _fallocate(fd, size)
+        return time.time() - start
+    except (OSError, AttributeError):
+        return None
+    finally:
+        os.close(fd)
+        os.remove(probe_path)
+
+
+def probe_write_speed(path, size=32 << 20, block_size=1 << 20, budget=2,
+                      sync_every=4 << 20):
+    """Sequential write speed into ``path`` in bytes/s, fsync included.
+    Writes go to disk every ``sync_every`` bytes and stop once ``budget``
+    seconds passed, so a slow mount costs the budget plus one such sync,
+    not an fsync of everything the page cache took meanwhile."""
+    probe_path = os.path.join(path, '.aria2-wrapper-write')
+    block = os.urandom(block_size)
+    fd = os.open(probe_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    try:
+        start = time.time()
+        written = 0
+        while written < size and time.time() - start < budget:
+            unsynced = 0
+            while unsynced < sync_every and written < size:
+                count = os.write(fd, block)
+                unsynced += count
+                written += count
+            os.fsync(fd)
+        return written / max(time.time() - start, 1e-6)
+    finally:
+        os.close(fd)
+        os.remove(probe_path)
+
+
+class DiskProfile(object):
+    def __init__(self, path, device=None, fs_type='unknown', fallocate=None,
+                 free=None, write_speed=None, probed_at=None):
+        self.path = path
+        self.device = device
+        self.fs_type = fs_type
+        self.fallocate = fallocate
+        self.free = free
+        self.write_speed = write_speed
+        self.probed_at = probed_at
+
+    @classmethod
+    def probe(cls, path, write=True):
+        """Measures the filesystem ``path`` is (or will be) on.  The write
+        probe writes up to 32 MiB; it is skipped when ``write`` is false or
+        less than ten times that is free."""
+        existing = _existing(path)
+        free = disk_free(existing)
+        writable = os.access(existing, os.W_OK)
+        profile = cls(os.path.realpath(os.path.expanduser(path)),
+                      os.stat(existing).st_dev, filesystem_type(existing),
+                      probe_fallocate(existing) if writable else None, free,
+                      probed_at=time.time())
+        if write and writable and free > 320 << 20:
+            profile.write_speed = probe_write_speed(existing)
+        return profile
+
+    def as_dict(self):
+        return dict(vars(self))
+
+
+_cache_lock = threading.Lock()
+_probing = set()
+
+
+def _load_cache(cache_path):
+    try:
+        with open(cache_path) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def _probe_into_cache(path, cache_path):
+    key = os.path.realpath(os.path.expanduser(path))
+    try:
+        profile = DiskProfile.probe(path)
+        with _cache_lock:
+            cache = _load_cache(cache_path)
+            cache[key] = profile.as_dict()
+            try:
+                with atomic_write(cache_path) as f:
+                    json.dump(cache, f, indent=2)
+            except (IOError, OSError):
+                pass
+        return profile
+    finally:
+        with _cache_lock:
+            _probing.discard(key)
+
+
+def _background_probe(path, cache_path):
+    try:
+        _probe_into_cache(path, cache_path)
+    except (IOError, OSError):
+        pass
+
+
+def get_profile(path, cache_path, max_age=7 * 86400, refresh=False,
+                background=False):
+    """The profile of ``path``, from ``cache_path`` unless it is missing,
+    older than ``max_age`` or the directory moved to another device.  The
+    filesystem type is cached with it: on macOS finding it runs mount(8).
+
+    With ``background`` a missing profile is probed on a thread for the
+    next call, and this one gets only what costs nothing to learn (no
+    fallocate or write speed), so a slow mount never holds up aria2c.
+    """
+    key = os.path.realpath(os.path.expanduser(path))
+    existing = _existing(path)
+    device = os.stat(existing).st_dev
+    with _cache_lock:
+        cached = _load_cache(cache_path).get(key)
+    if not refresh and cached and \
+            time.time() - cached.get('probed_at', 0) < max_age and \
+            cached.get('device') == device:
+        return DiskProfile(**cached)
+    if not background:
+        return _probe_into_cache(path, cache_path)
+    with _cache_lock:
+        probing = key in _probing
+        _probing.add(key)
+    if not probing:
+        thread = threading.Thread(target=_background_probe,
+                                  args=(path, cache_path),
+                                  name='disk-probe')
+        thread.daemon = True
+        thread.start()
+    return DiskProfile(key, device, filesystem_type(existing),
+                       free=disk_free(existing))
+
+
+def choose_options(profile):
+    """Returns ``(options, reasons)``: aria2 options for DISK_OPTIONS and
+    one line of reasoning per decision."""
+    fs_type = profile.fs_type
+    options = {}
+    reasons = []
+    if fs_type in MEMORY_FILESYSTEMS:
+        options.update({'file-allocation': 'none', 'disk-cache': '0',
+                        'enable-mmap': 'false'})
+        reasons.append('{} is memory: allocating ahead or caching writes '
+                       'only doubles memory use'.format(fs_type))
+        return options, reasons
+    if fs_type in NETWORK_FILESYSTEMS or fs_type.startswith('fuse.'):
+        options.update({'file-allocation': 'none',
+                        'enable-mmap': 'false'})
+        reasons.append('{} is a network/FUSE mount: preallocation would '
+                       'write every file in full over the wire before '
+                       'the download starts; mmap over it is '
+                       'unsafe'.format(fs_type))
+    elif fs_type in COPY_ON_WRITE_FILESYSTEMS:
+        options.update({'file-allocation': 'none',
+                        'enable-mmap': 'false'})
+        reasons.append('{} is copy-on-write: allocated blocks are '
+                       'replaced on the first write anyway'.format(fs_type))
+    elif profile.fallocate is not None:
+        options['file-allocation'] = 'falloc'
+        reasons.append('fallocate works on {} ({:.1f} ms for 64 MiB): '
+                       'space is reserved up front without writing '
+                       'zeros'.format(fs_type, profile.fallocate * 1000))
+        if sys.maxsize > 2 ** 32:
+            options['enable-mmap'] = 'true'
+            reasons.append('files are allocated and the address space is '
+                           '64-bit: mmap saves a copy per write')
+        else:
+            options['enable-mmap'] = 'false'
+    elif fs_type in NON_SPARSE_FILESYSTEMS:
+        options.update({'file-allocation': 'none',
+                        'enable-mmap': 'false'})
+        reasons.append('{} has no sparse files or fallocate: any '
+                       'allocation writes the whole file'.format(fs_type))
+    else:
+        options.update({'file-allocation': 'trunc',
+                        'enable-mmap': 'false'})
+        reasons.append('no fallocate on {}: truncate to size (sparse) '
+                       'instead of writing zeros'.format(fs_type))
+    if profile.write_speed is not None and \
+            profile.write_speed < SLOW_WRITE_SPEED:
+        options['disk-cache'] = '64M'
+        reasons.append('writes reach {:.1f} MB/s: a 64M cache batches '
+                       'small pieces'.format(profile.write_speed / 1e6))
+    elif fs_type in NETWORK_FILESYSTEMS or fs_type.startswith('fuse.'):
+        options['disk-cache'] = '64M'
+        reasons.append('network writes are batched through a 64M cache')
+    else:
+        options['disk-cache'] = '16M'
+        if profile.write_speed is not None:
+            reasons.append('writes reach {:.1f} MB/s: aria2\'s default '
+                           '16M cache is enough'.format(
+                               profile.write_speed / 1e6))
+    return options, reasons
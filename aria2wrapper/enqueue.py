@@ -0,0 +1,172 @@
+# coding=utf-8
+
+import os
+import time
+import binascii
+import threading
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from aria2wrapper.rpc import Aria2Error
+
+
+def parse_input_file(lines):
+    """Yields ``(uris, options)`` from aria2 input-file formatted lines.
+
+    A line holds TAB separated URIs of one download; the indented
+    ``name=value`` lines after it are that download's options.
+    """
+    uris, options = None, None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if not line.strip() or line.lstrip().startswith('#'):
+            continue
+        if line[0] in ' \t':
+            if uris is not None:
+                name, _, value = line.strip().partition('=')
+                options[name.strip()] = value.strip()
+            continue
+        if uris is not None:
+            yield uris, options
+        uris = [uri for uri in line.split('\t') if uri.strip()]
+        options = {}
+    if uris is not None:
+        yield uris, options
+
+
+def normalize_entry(entry):
+    if isinstance(entry, tuple):
+        uris, options = entry
+    else:
+        uris, options = entry, {}
+    if not isinstance(uris, list):
+        uris = [uris]
+    return uris, dict((k, str(v)) for k, v in (options or {}).items())
+
+
+def new_gid():
+    # aria2 takes any 16 hex digits but all zeros.
+    gid = binascii.hexlify(os.urandom(8)).decode('ascii')
+    return gid if gid.strip('0') else new_gid()
+
+
+class EnqueueStats(object):
+    def __init__(self):
+        self.submitted = 0
+        self.failed = 0
+        self.retries = 0
+        self.elapsed = 0.0
+        self._lock = threading.Lock()
+
+    def count(self, submitted=0, failed=0, retries=0):
+        with self._lock:
+            self.submitted += submitted
+            self.failed += failed
+            self.retries += retries
+
+
+def enqueue(client, entries, batch_size=200, workers=2, retries=3,
+            retry_wait=0.5, on_result=None, indexed=False):
+    """Adds downloads to aria2 in ``system.multicall`` batches.
+
+    ``entries`` may be any iterable (a generator, ``parse_input_file``
+    over a file or stdin) of URIs, URI lists or ``(uris, options)``
+    tuples.  It is consumed lazily: at most ``workers`` batches wait to be
+    sent, so memory stays flat however long the input is.
+
+    Entries without a ``gid`` option get one, so a call that failed in
+    transport (aria2 may have run it all the same: a timeout) is looked
+    up with ``aria2.tellStatus`` before it is resent, up to ``retries``
+    times with exponential backoff; a download is never added twice.
+    Calls aria2 rejects are counted as failed.  ``on_result`` is
+    called with ``(uris, gid or exception)`` for every entry, or with
+    ``indexed`` with ``(index, uris, gid or exception)``, index being the
+    entry's position in ``entries``.
+    """
+    stats = EnqueueStats()
+    queue = Queue(maxsize=workers)
+    start = time.time()
+
+    def submit(batch, counted):
+        results = [None] * len(batch)
+        send = list(range(len(batch)))
+        check = []
+        for attempt in range(retries + 1):
+            if check:
+                # Sent, but did aria2 get it?  An unknown gid is an
+                # Aria2Error; no answer at all, ask again next time.
+                answers = client.multicall(
+                    [('aria2.tellStatus', [batch[i][2]['gid'], ['gid']])
+                     for i in check])
+                unknown = []
+                for i, answer in zip(check, answers):
+                    if isinstance(answer, Aria2Error):
+                        send.append(i)
+                    elif isinstance(answer, Exception):
+                        unknown.append(i)
+                    else:
+                        results[i] = answer['gid']
+                check = unknown
+            if send:
+                answers = client.multicall(
+                    [('aria2.addUri', list(batch[i][1:])) for i in send])
+                for i, answer in zip(send, answers):
+                    results[i] = answer
+                    if isinstance(answer, Exception) and \
+                            not isinstance(answer, Aria2Error):
+                        check.append(i)
+                send = []
+            if not check or attempt == retries:
+                break
+            stats.count(retries=1)
+            time.sleep(retry_wait * 2 ** attempt)
+        errors = sum(1 for result in results if isinstance(result, Exception))
+        stats.count(submitted=len(batch) - errors, failed=errors)
+        counted.append(True)
+        if on_result is not None:
+            for (index, uris, _), result in zip(batch, results):
+                if indexed:
+                    on_result(index, uris, result)
+                else:
+                    on_result(uris, result)
+
+    def worker():
+        while True:
+            batch = queue.get()
+            if batch is None:
+                return
+            counted = []
+            try:
+                submit(batch, counted)
+            except Exception:
+                if not counted:
+                    stats.count(failed=len(batch))
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    try:
+        batch = []
+        for index, entry in enumerate(entries):
+            uris, options = normalize_entry(entry)
+            options.setdefault('gid', new_gid())
+            batch.append((index, uris, options))
+            if len(batch) >= batch_size:
+                queue.put(batch)
+                batch = []
+        if batch:
+            queue.put(batch)
+    finally:
+        for _ in threads:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+    stats.elapsed = time.time() - start
+    return stats
+
+
+def enqueue_file(client, f, **kwargs):
+    return enqueue(client, parse_input_file(f), **kwargs)
@@ -0,0 +1,83 @@
+# coding=utf-8
+
+import os
+import re
+import sys
+import mmap
+import shutil
+import hashlib
+import tempfile
+import contextlib
+
+
+@contextlib.contextmanager
+def atomic_write(path, mode='w'):
+    """Writes ``path`` through a fsynced temp file renamed over it, so
+    readers see either the old or the new content, never a torn file."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path),
+                                     dir=directory)
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        if sys.platform == 'win32' and os.path.exists(path):
+            os.remove(path)
+        os.rename(temp_path, path)
+    except BaseException:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+
+def parse_size(value):
+    """Bytes from an aria2-style size: ``1048576``, ``1M``, ``2.5G``."""
+    match = re.match(r'^(\d+(?:\.\d+)?)([KMG]?)$', str(value).upper())
+    if not match:
+        raise ValueError('bad size: {}'.format(value))
+    return int(float(match.group(1)) *
+               {'': 1, 'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+               [match.group(2)])
+
+
+def free_name(path):
+    """``path``, or ``name.1.ext``, ``name.2.ext``... if it exists."""
+    root, ext = os.path.splitext(path)
+    n = 1
+    while os.path.exists(path):
+        path = '{}.{}{}'.format(root, n, ext)
+        n += 1
+    return path
+
+
+def file_digest(path, algorithm):
+    """Hex digest of the file at ``path`` with hashlib's ``algorithm``."""
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size:
+            # One update over the mapping: no read() copies, and hashlib
+            # releases the GIL while it runs.
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                digest.update(mapped)
+            finally:
+                mapped.close()
+    return digest.hexdigest()
+
+
+def disk_free(path):
+    try:
+        return shutil.disk_usage(path).free
+    except AttributeError:
+        pass
+    if sys.platform == 'win32':
+        import ctypes
+        free = ctypes.c_ulonglong(0)
+        ctypes.windll.kernel32.GetDiskFreeSpaceExW(
+            ctypes.c_wchar_p(path), None, None, ctypes.pointer(free))
+        return free.value
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize
@@ -0,0 +1,395 @@
+# coding=utf-8
+
+import os
+import sys
+import time
+import threading
+
+import psutil
+
+from aria2wrapper.files import parse_size
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+# Limits in bytes; the others (nofile, nproc, ...) are plain counts.
+_SIZE_RLIMITS = ('as', 'core', 'data', 'fsize', 'memlock', 'rss', 'stack')
+
+THROTTLE_OPTIONS = ('max-overall-download-limit', 'max-overall-upload-limit')
+
+# The usage that follows throughput, so slowing aria2 down relieves it.
+THROTTLE_RESOURCES = ('cpu', 'io')
+
+
+def _set_nice(process, nice):
+    if sys.platform == 'win32':
+        # Windows has priority classes instead of nice values.
+        nice = psutil.IDLE_PRIORITY_CLASS if nice >= 15 else \
+            psutil.BELOW_NORMAL_PRIORITY_CLASS if nice > 0 else \
+            psutil.NORMAL_PRIORITY_CLASS
+    process.nice(nice)
+
+
+def _set_ionice(process, ionice):
+    # 'idle', 'best-effort' or 'best-effort:<0-7>'.
+    name, _, level = ionice.partition(':')
+    if name == 'idle':
+        process.ionice(psutil.IOPRIO_CLASS_IDLE)
+    elif name == 'best-effort':
+        process.ionice(psutil.IOPRIO_CLASS_BE,
+                       int(level) if level else None)
+    else:
+        raise ValueError('bad ionice class: {}'.format(ionice))
+
+
+def _set_rlimit(process, name, value):
+    resource = getattr(psutil, 'RLIMIT_' + name.upper(), None)
+    if resource is None:
+        raise ValueError('rlimit {} not supported here'.format(name))
+    limit = parse_size(value) if name in _SIZE_RLIMITS else int(value)
+    hard = process.rlimit(resource)[1]
+    if hard != psutil.RLIM_INFINITY:
+        # An unprivileged process can lower its hard limit, not raise it.
+        limit = min(limit, hard)
+    process.rlimit(resource, (limit, hard))
+
+
+def cgroup_available(root=CGROUP_ROOT):
+    return os.path.exists(os.path.join(root, 'cgroup.controllers'))
+
+
+def cgroup_files(memory_high=None, memory_max=None, cpu_max=None,
+                 io_weight=None):
+    """The cgroup v2 interface files for an envelope: memory in aria2
+    size syntax, cpu_max in cores, io_weight 1-10000."""
+    files = {}
+    if memory_high:
+        files['memory.high'] = str(parse_size(memory_high))
+    if memory_max:
+        files['memory.max'] = str(parse_size(memory_max))
+    if cpu_max:
+        files['cpu.max'] = '{} 100000'.format(int(cpu_max * 100000))
+    if io_weight:
+        files['io.weight'] = 'default {}'.format(int(io_weight))
+    return files
+
+
+def place_in_cgroup(pid, path, files=None, root=CGROUP_ROOT):
+    """Moves ``pid`` into the cgroup v2 group ``path`` (relative to
+    ``root``), creating it and writing ``files`` into it first.  The
+    group has to be writable by this user: under systemd, a delegated
+    one such as ``user.slice/user-1000.slice/user@1000.service/aria2``.
+
+    ``pid`` is moved even when the parent does not hand down the
+    controller of some file; those files are skipped and reported in the
+    EnvironmentError raised afterwards."""
+    if not cgroup_available(root):
+        raise EnvironmentError('no cgroup v2 hierarchy at {}'.format(root))
+    directory = os.path.join(root, path.strip('/'))
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    subtree_control = os.path.join(os.path.dirname(directory),
+                                   'cgroup.subtree_control')
+    missing = {}
+    for name in sorted(files or {}):
+        controller = name.partition('.')[0]
+        if controller in missing:
+            continue
+        try:
+            # The parent has to hand the controller down.
+            with open(subtree_control, 'w') as f:
+                f.write('+' + controller)
+        except EnvironmentError as e:
+            # Fine if it already does.
+            if controller not in _controllers(subtree_control):
+                missing[controller] = e
+                continue
+        with open(os.path.join(directory, name), 'w') as f:
+            f.write(files[name])
+    with open(os.path.join(directory, 'cgroup.procs'), 'w') as f:
+        f.write(str(pid))
+    if missing:
+        raise EnvironmentError('; '.join(
+            '{} controller not enabled in {} ({}): {} not set'.format(
+                controller, subtree_control, missing[controller],
+                ', '.join(name for name in sorted(files)
+                          if name.partition('.')[0] == controller))
+            for controller in sorted(missing)))
+
+
+def _controllers(subtree_control):
+    try:
+        with open(subtree_control) as f:
+            return f.read().split()
+    except EnvironmentError:
+        return []
+
+
+def apply_limits(pid, nice=None, ionice=None, rlimits=None, cgroup=None,
+                 cgroup_limits=None, cgroup_root=CGROUP_ROOT):
+    """Puts the running process ``pid`` into a resource envelope.
+
+    Returns ``{limit: error}`` with ``None`` for the limits applied.  A
+    limit this platform or user cannot apply is reported, not raised, so
+    aria2c runs either way.
+    """
+    result = {}
+
+    def apply(name, func, *args):
+        try:
+            func(*args)
+        except (EnvironmentError, ValueError, AttributeError,
+                psutil.Error) as e:
+            result[name] = str(e) or e.__class__.__name__
+        else:
+            result[name] = None
+    try:
+        process = psutil.Process(pid)
+    except psutil.Error as e:
+        return {'process': str(e)}
+    if nice is not None:
+        apply('nice', _set_nice, process, nice)
+    if ionice:
+        apply('ionice', _set_ionice, process, ionice)
+    for name, value in sorted((rlimits or {}).items()):
+        apply('rlimit-' + name, _set_rlimit, process, name, value)
+    if cgroup:
+        apply('cgroup', place_in_cgroup, pid, cgroup,
+              cgroup_limits, cgroup_root)
+    return result
+
+
+class ProcessSampler(object):
+    """RSS, CPU (cores in use) and disk I/O (bytes/s) of one process.
+
+    ``get_process`` returns the ``psutil.Process`` to sample, or None:
+    typically ``Aria2ProcessTracker.get_process``, which answers from
+    the known pid.  Rates are over the time since the previous sample of
+    the same process, so the first sample after a (re)start has ``cpu``
+    and ``io`` set to None, as has ``io`` where psutil cannot count it
+    (macOS).
+    """
+
+    def __init__(self, get_process):
+        self.get_process = get_process
+        self._last = None
+
+    def sample(self):
+        process = self.get_process()
+        if process is None:
+            self._last = None
+            return None
+        now = time.time()
+        try:
+            with process.oneshot():
+                rss = process.memory_info().rss
+                times = process.cpu_times()
+                try:
+                    counters = process.io_counters()
+                except (AttributeError, psutil.AccessDenied):
+                    counters = None
+        except psutil.Error:
+            self._last = None
+            return None
+        cpu = times.user + times.system
+        io = counters.read_bytes + counters.write_bytes \
+            if counters is not None else None
+        usage = {'pid': process.pid, 'rss': rss, 'cpu': None, 'io': None}
+        last = self._last
+        if last is not None and last[0] == process.pid and now > last[1]:
+            usage['cpu'] = (cpu - last[2]) / (now - last[1])
+            if io is not None and last[3] is not None:
+                usage['io'] = (io - last[3]) / (now - last[1])
+        self._last = (process.pid, now, cpu, io)
+        return usage
+
+
+class ResourceGovernor(object):
+    """Decides aria2's overall speed limits from aria2c's resource usage.
+
+    ``budgets`` caps any of ``rss`` (bytes), ``cpu`` (cores) and ``io``
+    (bytes/s).  Pressure is the largest usage / budget ratio of the CPU
+    and disk I/O budgets.  Above 1, both directions are limited to their
+    current speed scaled by ``backoff / pressure`` (CPU and disk I/O
+    follow throughput), never below ``floor``.  After ``recover``
+    samples in a row under ``headroom``, the limits grow by
+    ``increase``.  The limits aria2 had before are restored once they are
+    no longer the tighter ones, or are twice the speed seen when
+    throttling began.
+
+    RSS does not follow speed: most of it is the disk cache, sized by
+    ``disk-cache`` at startup, and the piece buffers of the downloads in
+    flight.  An ``rss`` budget is only reported by ``over_budget``; bound
+    memory with the cgroup ``memory.high`` instead.
+    """
+
+    def __init__(self, budgets, backoff=0.9, increase=1.25, headroom=0.8,
+                 recover=3, floor=64 << 10):
+        self.budgets = dict((name, float(budget))
+                            for name, budget in budgets.items() if budget)
+        self.backoff = backoff
+        self.increase = increase
+        self.headroom = headroom
+        self.recover = recover
+        self.floor = floor
+        self.throttles = 0
+        self.reset()
+
+    @property
+    def throttled(self):
+        return self.baseline is not None
+
+    def reset(self):
+        # aria2c restarted with the options from the settings.
+        self.baseline = None
+        self.limits = {}
+        self._peak = {}
+        self._calm = 0
+
+    def pressure(self, usage):
+        ratios = [usage[name] / budget
+                  for name, budget in self.budgets.items()
+                  if name in THROTTLE_RESOURCES and
+                  usage.get(name) is not None]
+        return max(ratios) if ratios else 0.0
+
+    def over_budget(self, usage):
+        """The budgets ``usage`` exceeds, throttled or not."""
+        return sorted(name for name, budget in self.budgets.items()
+                      if usage.get(name) is not None and
+                      usage[name] > budget)
+
+    def step(self, usage, speeds, options):
+        """Feeds a sample, the current ``{option: speed}`` and aria2's
+        global options; returns the options to change (possibly empty)."""
+        pressure = self.pressure(usage)
+        if pressure > 1:
+            self._calm = 0
+            if not self.throttled:
+                self.baseline = dict((name, options.get(name, '0'))
+                                     for name in THROTTLE_OPTIONS)
+                self._peak = dict(speeds)
+                self.throttles += 1
+            changes = {}
+            for name in THROTTLE_OPTIONS:
+                known = [value for value in (self.limits.get(name),
+                                             speeds.get(name)) if value]
+                if not known:
+                    continue
+                limit = self._cap(name, max(
+                    self.floor, int(min(known) * self.backoff / pressure)))
+                if limit != self.limits.get(name):
+                    self.limits[name] = changes[name] = limit
+            return dict((name, str(limit))
+                        for name, limit in changes.items())
+        if not self.throttled or pressure > self.headroom:
+            self._calm = 0
+            return {}
+        self._calm += 1
+        if self._calm < self.recover:
+            return {}
+        self._calm = 0
+        for name in list(self.limits):
+            self.limits[name] = self._cap(
+                name, int(self.limits[name] * self.increase))
+        if all(self._released(name) for name in self.limits):
+            changes = dict(self.baseline)
+            self.reset()
+            return changes
+        return dict((name, str(limit)) for name, limit in self.limits.items())
+
+    def _cap(self, name, limit):
+        # Never looser than the limit set by the user.
+        baseline = parse_size(self.baseline[name])
+        return min(limit, baseline) if baseline else limit
+
+    def _released(self, name):
+        baseline = parse_size(self.baseline[name])
+        if baseline:
+            return self.limits[name] >= baseline
+        return self.limits[name] >= 2 * max(self._peak.get(name, 0),
+                                            self.floor)
+
+
+class Aria2Governor(object):
+    """Runs a ResourceGovernor against a live aria2c.
+
+    Every ``interval`` seconds ``sampler`` measures aria2c, and one
+    multicall reads the speeds and global options the governor needs.
+    The limits it decides on go out with ``aria2.changeGlobalOption``.
+    ``stop`` gives aria2 back its own limits.
+    """
+
+    def __init__(self, client, sampler, budgets, interval=2, **kwargs):
+        self.client = client
+        self.sampler = sampler
+        self.interval = interval
+        self.governor = ResourceGovernor(budgets, **kwargs)
+        self.usage = None
+        self.over_budget = []
+        self.sample_time = 0.0
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def step(self):
+        start = time.time()
+        usage = self.sampler.sample()
+        sample_time = time.time() - start
+        with self._lock:
+            self.usage = usage
+            self.over_budget = self.governor.over_budget(usage or {})
+            self.sample_time = sample_time
+            if usage is None or usage['pid'] != self._pid:
+                self.governor.reset()
+                self._pid = usage and usage['pid']
+            if usage is None:
+                return {}
+        stat, options = self.client.multicall(
+            [('aria2.getGlobalStat', []), ('aria2.getGlobalOption', [])])
+        for result in (stat, options):
+            if isinstance(result, Exception):
+                raise result
+        speeds = {'max-overall-download-limit': int(stat['downloadSpeed']),
+                  'max-overall-upload-limit': int(stat['uploadSpeed'])}
+        with self._lock:
+            changes = self.governor.step(usage, speeds, options)
+        if changes:
+            self.client.changeGlobalOption(changes)
+        return changes
+
+    def stats(self):
+        with self._lock:
+            return {'usage': self.usage,
+                    'budgets': self.governor.budgets,
+                    'over_budget': self.over_budget,
+                    'throttled': self.governor.throttled,
+                    'limits': dict(self.governor.limits),
+                    'throttles': self.governor.throttles,
+                    'sample_ms': self.sample_time * 1000}
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='aria2-governor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            baseline = self.governor.baseline
+            self.governor.reset()
+        if baseline is not None:
+            try:
+                self.client.changeGlobalOption(baseline)
+            except Exception:
+                pass
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.step()
+            except Exception:
+                pass
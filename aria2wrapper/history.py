@@ -0,0 +1,278 @@
+# coding=utf-8
+
+import os
+import time
+import sqlite3
+import datetime
+import threading
+
+# tellStopped fields the history needs; ``files`` carries the URIs and
+# paths.
+_KEYS = ['gid', 'status', 'totalLength', 'completedLength', 'errorCode',
+         'dir', 'files']
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS downloads (
+    gid TEXT PRIMARY KEY,
+    uri TEXT,
+    path TEXT,
+    status TEXT NOT NULL,
+    error_code INTEGER,
+    size INTEGER,
+    completed INTEGER,
+    started REAL,
+    finished REAL NOT NULL,
+    duration REAL,
+    speed REAL
+);
+CREATE INDEX IF NOT EXISTS downloads_uri ON downloads (uri);
+CREATE INDEX IF NOT EXISTS downloads_finished ON downloads (finished);
+CREATE INDEX IF NOT EXISTS downloads_status
+    ON downloads (status, finished);
+'''
+
+COLUMNS = ('gid', 'uri', 'path', 'status', 'error_code', 'size',
+           'completed', 'started', 'finished', 'duration', 'speed')
+
+_TIME_FORMATS = ('%Y-%m-%d', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S',
+                 '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S')
+
+
+def parse_time(value):
+    """A Unix time from a number, ``-3600`` (an hour ago) or a local
+    ``YYYY-MM-DD[THH:MM[:SS]]``."""
+    value = str(value)
+    try:
+        number = float(value)
+    except ValueError:
+        pass
+    else:
+        return time.time() + number if value.startswith('-') else number
+    for time_format in _TIME_FORMATS:
+        try:
+            parsed = datetime.datetime.strptime(value, time_format)
+        except ValueError:
+            continue
+        return time.mktime(parsed.timetuple())
+    raise ValueError('bad time: {}'.format(value))
+
+
+def _final_path(files):
+    paths = [f['path'] for f in files
+             if f['path'] and not f['path'].startswith('[METADATA]')]
+    if len(paths) == 1:
+        return paths[0]
+    if paths:
+        # A multi-file torrent: the directory holding its files.
+        return os.path.dirname(os.path.commonprefix(
+            [os.path.dirname(path) + os.sep for path in paths]))
+    return None
+
+
+def record(status, started=None, finished=None):
+    """A history row from a tellStopped entry."""
+    finished = finished or time.time()
+    uris = [uri['uri'] for f in status.get('files', [])
+            for uri in f.get('uris', [])]
+    completed = int(status.get('completedLength', 0))
+    duration = finished - started if started else None
+    return {'gid': status['gid'], 'uri': uris[0] if uris else None,
+            'path': _final_path(status.get('files', [])),
+            'status': status['status'],
+            'error_code': int(status.get('errorCode') or 0),
+            'size': int(status.get('totalLength', 0)),
+            'completed': completed, 'started': started,
+            'finished': finished, 'duration': duration,
+            'speed': completed / duration if duration else None}
+
+
+class HistoryStore(object):
+    """Stopped downloads in SQLite, indexed by URI, time and status.
+
+    Writes go in one transaction per batch; the WAL journal lets
+    ``main.py history`` read while the wrapper writes.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+
+    def add(self, records):
+        """Stores ``records`` (dicts of COLUMNS), replacing the rows of
+        gids already stored: aria2 restores an errored download from the
+        session under the same gid, and it may complete this time.
+        Returns the number stored."""
+        rows = [tuple(r.get(name) for name in COLUMNS) for r in records]
+        with self._lock:
+            with self._db:
+                before = self._db.total_changes
+                self._db.executemany(
+                    'INSERT OR REPLACE INTO downloads ({}) VALUES ({})'.
+                    format(', '.join(COLUMNS),
+                           ', '.join('?' * len(COLUMNS))),
+                    rows)
+                return self._db.total_changes - before
+
+    def known(self, gids):
+        """``{gid: (status, error_code)}`` for the gids stored."""
+        gids = list(gids)
+        if not gids:
+            return {}
+        with self._lock:
+            return dict((row[0], (row[1], row[2])) for row in self._db.execute(
+                'SELECT gid, status, error_code FROM downloads '
+                'WHERE gid IN ({})'.format(', '.join('?' * len(gids))),
+                gids))
+
+    def completed_size(self, gid):
+        """The length of ``gid`` if it is stored as complete, else None."""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT size FROM downloads WHERE gid = ? AND '
+                'status = ?', (gid, 'complete')).fetchone()
+        return row[0] if row else None
+
+    def query(self, uri=None, uri_prefix=None, since=None, until=None,
+              status=None, limit=100):
+        """Downloads matching every given condition, newest first."""
+        conditions, params = [], []
+        if uri is not None:
+            conditions.append('uri = ?')
+            params.append(uri)
+        if uri_prefix:
+            # A range rather than LIKE, so the index is used.
+            conditions.append('uri >= ? AND uri < ?')
+            params.extend([uri_prefix, uri_prefix[:-1] +
+                           chr(ord(uri_prefix[-1]) + 1)])
+        if since is not None:
+            conditions.append('finished >= ?')
+            params.append(since)
+        if until is not None:
+            conditions.append('finished < ?')
+            params.append(until)
+        if status is not None:
+            conditions.append('status = ?')
+            params.append(status)
+        sql = 'SELECT {} FROM downloads'.format(', '.join(COLUMNS))
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY finished DESC'
+        if limit:
+            sql += ' LIMIT ?'
+            params.append(limit)
+        with self._lock:
+            return [dict(zip(COLUMNS, row))
+                    for row in self._db.execute(sql, params)]
+
+    def count(self):
+        with self._lock:
+            return self._db.execute(
+                'SELECT COUNT(*) FROM downloads').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class Aria2HistoryRecorder(object):
+    """Copies aria2's stopped downloads into a HistoryStore.
+
+    ``sync`` pages ``tellStopped`` from the newest end and stops at the
+    first page reaching downloads an earlier sync stored as they are, so
+    a sync costs one round trip when little has finished.  Hook ``on_event`` to
+    the monitor: start and stop notifications give each download its
+    duration, and a stop triggers a sync ``delay`` seconds later (so a
+    burst of stops is one sync); otherwise it syncs every ``interval``
+    seconds.  aria2 keeps only the last ``max-download-result`` stopped
+    downloads; any that drop out between two syncs are lost.
+    """
+
+    def __init__(self, client, store, interval=60, page=100, delay=1):
+        self.client = client
+        self.store = store
+        self.interval = interval
+        self.page = page
+        self.delay = delay
+        self.ingested = 0
+        self.syncs = 0
+        self.sync_time = 0.0
+        self._started = {}
+        self._finished = {}
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def on_event(self, method, gid):
+        if method == 'aria2.onDownloadStart':
+            self._started.setdefault(gid, time.time())
+        elif method in ('aria2.onDownloadComplete', 'aria2.onDownloadError',
+                        'aria2.onDownloadStop'):
+            self._finished[gid] = time.time()
+            self._wakeup.set()
+
+    def sync(self):
+        """Stores the downloads stopped since the last sync; returns how
+        many."""
+        start = time.time()
+        seen = set()
+        added = 0
+        offset = -1
+        while True:
+            page = self.client.tellStopped(offset, self.page, _KEYS)
+            # Downloads stopping meanwhile shift the pages; ones already
+            # seen in this sync are skipped.
+            fresh = [status for status in page if status['gid'] not in seen]
+            known = self.store.known(status['gid'] for status in fresh)
+            records = []
+            unchanged = False
+            for status in fresh:
+                gid = status['gid']
+                seen.add(gid)
+                if known.get(gid) == (status['status'],
+                                      int(status.get('errorCode') or 0)):
+                    unchanged = True
+                    self._started.pop(gid, None)
+                    self._finished.pop(gid, None)
+                    continue
+                # New, or stored but finished again since (a download
+                # restored from the session keeps its gid).
+                records.append(record(status, self._started.pop(gid, None),
+                                      self._finished.pop(gid, None)))
+            added += self.store.add(records)
+            if unchanged or len(page) < self.page:
+                break
+            offset -= self.page
+        self.ingested += added
+        self.syncs += 1
+        self.sync_time += time.time() - start
+        return added
+
+    def stats(self):
+        return {'rows': self.store.count(), 'ingested': self.ingested,
+                'syncs': self.syncs, 'sync_time': self.sync_time}
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='aria2-history')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            if self._wakeup.wait(self.interval):
+                self._stopped.wait(self.delay)
+            self._wakeup.clear()
+            try:
+                self.sync()
+            except Exception:
+                pass
@@ -0,0 +1,384 @@
+# coding=utf-8
+
+import os
+import time
+import heapq
+import base64
+import threading
+from collections import deque, OrderedDict
+
+from aria2wrapper.rpc import Aria2Error, never_sent
+from aria2wrapper.enqueue import new_gid, parse_input_file
+from aria2wrapper.files import free_name
+from aria2wrapper.watch import (create_watcher, file_signature, IN_MODIFY,
+                                IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO,
+                                IN_CREATE, IN_DELETE)
+
+EXTENSIONS = ('.torrent', '.metalink', '.meta4', '.txt')
+
+_MASK = (IN_CREATE | IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO |
+         IN_MOVED_FROM | IN_DELETE)
+# After these the writer is done with the file.
+_DONE = IN_CLOSE_WRITE | IN_MOVED_TO
+_GONE = IN_MOVED_FROM | IN_DELETE
+
+
+def file_calls(path):
+    """The RPC calls adding the downloads of a dropped file: one
+    ``aria2.addUri`` per entry of a URI list (aria2 input-file format),
+    ``aria2.addTorrent`` or ``aria2.addMetalink`` for the others.  All but
+    ``addMetalink``, which may add several downloads, carry a ``gid``."""
+    extension = os.path.splitext(path)[1].lower()
+    if extension == '.txt':
+        with open(path, 'r') as f:
+            entries = list(parse_input_file(f))
+        for _, options in entries:
+            options.setdefault('gid', new_gid())
+        return [('aria2.addUri', [uris, options]) for uris, options in entries]
+    with open(path, 'rb') as f:
+        data = base64.b64encode(f.read()).decode('ascii')
+    if extension == '.torrent':
+        return [('aria2.addTorrent', [data, [], {'gid': new_gid()}])]
+    return [('aria2.addMetalink', [data, {}])]
+
+
+def _gid(call):
+    # The gid a call adds its download under, None for addMetalink.
+    method, params = call
+    if method == 'aria2.addUri':
+        return params[1].get('gid')
+    if method == 'aria2.addTorrent':
+        return params[2].get('gid')
+    return None
+
+
+def _percentiles(values):
+    values = sorted(values)
+    if not values:
+        return None
+    return {'p50': values[len(values) // 2],
+            'p95': values[min(len(values) * 95 // 100, len(values) - 1)]}
+
+
+class _Pending(object):
+    __slots__ = ('deadline', 'closed', 'signature', 'dropped')
+
+    def __init__(self):
+        self.deadline = None
+        self.closed = False
+        self.signature = None
+        self.dropped = None
+
+
+class _Drop(object):
+    # A file taken from the folder, until all its calls are answered.
+    # ``sent``: the calls that may have reached aria2 unanswered.
+    __slots__ = ('name', 'path', 'dropped', 'calls', 'results', 'sent')
+
+    def __init__(self, name, path, dropped, calls):
+        self.name = name
+        self.path = path
+        self.dropped = dropped
+        self.calls = calls
+        self.results = [None] * len(calls)
+        self.sent = set()
+
+
+class _Folder(object):
+    def __init__(self, path):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.watcher = create_watcher(path, _MASK)
+        self.pending = {}
+        # (deadline, name); entries whose deadline moved on are skipped.
+        self.deadlines = []
+        self.retry = []
+        self.retry_at = None
+        self.backoff = None
+        self.stuck = set()
+        self.thread = None
+
+
+class Aria2Ingester(object):
+    """Submits the files dropped into watch folders to aria2.
+
+    ``.txt`` URI lists, ``.torrent`` and ``.metalink``/``.meta4`` files
+    become ``aria2.addUri``, ``addTorrent`` and ``addMetalink`` calls.
+    Every file ready at a time goes out in one ``system.multicall``, so a
+    burst of thousands of drops is a handful of requests.  Hidden files
+    are ignored: write to ``.name`` and rename to publish.
+
+    With inotify a file is ready ``debounce`` seconds after its writer
+    closed it (or it was moved in), provided no other event for it came
+    meanwhile.  Without inotify, and for files found by the scan at start
+    or after an inotify queue overflow, a file is ready once its size and
+    mtime held for ``debounce`` seconds.  The folder is listed only then;
+    events are handled one name at a time.
+
+    Files whose downloads were all added are moved into ``processed``,
+    the others into ``failed`` (both relative to the folder unless
+    absolute).  When aria2 cannot be reached the files stay and are
+    retried with exponential backoff, resuming where the last attempt
+    stopped.  Hook ``on_event`` to the monitor to measure the time from
+    the drop to the download starting.
+    """
+
+    def __init__(self, client, folders, debounce=0.5,
+                 processed='.processed', failed='.failed', retry_wait=1,
+                 max_retry_wait=30):
+        self.client = client
+        self.folders = [_Folder(os.path.abspath(folder))
+                        for folder in folders]
+        self.debounce = debounce
+        self.processed = processed
+        self.failed = failed
+        self.retry_wait = retry_wait
+        self.max_retry_wait = max_retry_wait
+        self.files = 0
+        self.failed_files = 0
+        self.downloads = 0
+        self.rejected = 0
+        self.retries = 0
+        self.scans = 0
+        self._submit_latency = deque(maxlen=1024)
+        self._start_latency = deque(maxlen=1024)
+        self._gids = {}
+        # Starts reported before the submitting thread saw the gid.
+        self._early = OrderedDict()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def _wanted(self, name):
+        return not name.startswith('.') and \
+            os.path.splitext(name)[1].lower() in EXTENSIONS
+
+    def _touch(self, folder, name, mask, now):
+        if not self._wanted(name) or name in folder.stuck:
+            return
+        if mask & _GONE:
+            folder.pending.pop(name, None)
+            return
+        entry = folder.pending.get(name)
+        if entry is None:
+            entry = folder.pending[name] = _Pending()
+        # A write after the close means the file is being rewritten.
+        entry.closed = bool(mask & _DONE)
+        if entry.closed:
+            entry.dropped = now
+        entry.deadline = now + self.debounce
+        heapq.heappush(folder.deadlines, (entry.deadline, name))
+
+    def _scan(self, folder, now):
+        try:
+            names = os.listdir(folder.path)
+        except OSError:
+            return
+        with self._lock:
+            self.scans += 1
+        retrying = set(drop.name for drop in folder.retry)
+        for name in names:
+            if name not in folder.pending and name not in retrying:
+                self._touch(folder, name, 0, now)
+
+    def _take(self, folder, now):
+        ready = []
+        while folder.deadlines and folder.deadlines[0][0] <= now:
+            deadline, name = heapq.heappop(folder.deadlines)
+            entry = folder.pending.get(name)
+            if entry is None or entry.deadline != deadline:
+                continue
+            path = os.path.join(folder.path, name)
+            signature = file_signature(path)
+            if signature is None or not os.path.isfile(path):
+                del folder.pending[name]
+                continue
+            if not entry.closed and signature != entry.signature:
+                # Still changing, or not seen long enough to tell.
+                entry.signature = signature
+                entry.deadline = now + self.debounce
+                heapq.heappush(folder.deadlines, (entry.deadline, name))
+                continue
+            del folder.pending[name]
+            ready.append((entry.dropped or signature[2], name, path))
+        drops = []
+        for dropped, name, path in sorted(ready):
+            try:
+                calls = file_calls(path)
+            except (IOError, OSError, ValueError):
+                if os.path.exists(path):
+                    self._finish(folder, _Drop(name, path, dropped, []),
+                                 True)
+                continue
+            drops.append(_Drop(name, path, dropped, calls))
+        return drops
+
+    def _submit(self, folder, drops, now):
+        todo = [(drop, i) for drop in drops
+                for i, result in enumerate(drop.results) if result is None]
+        # A call aria2 may have run (a timeout) is only resent once
+        # aria2 says it does not know its gid.
+        check = [(drop, i) for drop, i in todo if i in drop.sent]
+        answers = self.client.multicall(
+            [('aria2.tellStatus', [_gid(drop.calls[i]), ['gid']])
+             for drop, i in check]) if check else []
+        for (drop, i), answer in zip(check, answers):
+            if isinstance(answer, Aria2Error):
+                drop.sent.discard(i)
+            elif not isinstance(answer, Exception):
+                drop.sent.discard(i)
+                drop.results[i] = answer['gid']
+        todo = [(drop, i) for drop, i in todo
+                if drop.results[i] is None and i not in drop.sent]
+        answers = self.client.multicall([drop.calls[i] for drop, i in todo]) \
+            if todo else []
+        answered = time.time()
+        gids = [(drop.results[i], drop.dropped) for drop, i in check
+                if drop.results[i] is not None]
+        for (drop, i), answer in zip(todo, answers):
+            if isinstance(answer, Exception) and \
+                    not isinstance(answer, Aria2Error):
+                if _gid(drop.calls[i]) is not None:
+                    # Looked up before it is resent.
+                    drop.sent.add(i)
+                    continue
+                if never_sent(answer):
+                    continue
+                # An addMetalink aria2 may have run: not resent.
+            drop.results[i] = answer
+            if not isinstance(answer, Exception):
+                for gid in answer if isinstance(answer, list) else [answer]:
+                    gids.append((gid, drop.dropped))
+        self._track(gids)
+        retry = []
+        for drop in drops:
+            if any(result is None for result in drop.results):
+                retry.append(drop)
+                continue
+            with self._lock:
+                self._submit_latency.append(answered - drop.dropped)
+            self._finish(folder, drop, any(isinstance(result, Exception)
+                                           for result in drop.results))
+        folder.retry = retry
+        if retry:
+            folder.backoff = min(folder.backoff * 2, self.max_retry_wait) \
+                if folder.backoff else self.retry_wait
+            folder.retry_at = now + folder.backoff
+            with self._lock:
+                self.retries += 1
+        else:
+            folder.backoff = folder.retry_at = None
+
+    def _track(self, gids):
+        now = time.time()
+        with self._lock:
+            for gid, dropped in gids:
+                started = self._early.pop(gid, None)
+                if started is not None:
+                    self._start_latency.append(started - dropped)
+                else:
+                    self._gids[gid] = dropped
+            # Starts of downloads that are not ours never get claimed.
+            while self._early and \
+                    next(iter(self._early.values())) < now - 60:
+                self._early.popitem(last=False)
+
+    def _finish(self, folder, drop, failed):
+        added = rejected = 0
+        for result in drop.results:
+            if isinstance(result, Exception):
+                rejected += 1
+            else:
+                # addMetalink answers with a gid per file.
+                added += len(result) if isinstance(result, list) else 1
+        with self._lock:
+            self.files += 1
+            self.failed_files += int(failed)
+            self.downloads += added
+            self.rejected += rejected
+        directory = os.path.join(folder.path,
+                                 self.failed if failed else self.processed)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            os.rename(drop.path, free_name(os.path.join(directory,
+                                                        drop.name)))
+        except OSError:
+            # Left in place, but not submitted again.
+            folder.stuck.add(drop.name)
+
+    def on_event(self, method, gid):
+        if method not in ('aria2.onDownloadStart', 'aria2.onDownloadStop',
+                          'aria2.onDownloadComplete',
+                          'aria2.onDownloadError'):
+            return
+        now = time.time()
+        with self._lock:
+            dropped = self._gids.pop(gid, None)
+            if method != 'aria2.onDownloadStart':
+                return
+            if dropped is not None:
+                self._start_latency.append(now - dropped)
+            elif len(self._early) < 10000:
+                self._early[gid] = now
+
+    def stats(self):
+        with self._lock:
+            return {'folders': [folder.path for folder in self.folders],
+                    'files': self.files,
+                    'failed_files': self.failed_files,
+                    'downloads': self.downloads,
+                    'rejected': self.rejected,
+                    'retries': self.retries,
+                    'scans': self.scans,
+                    'pending': sum(len(folder.pending) + len(folder.retry)
+                                   for folder in self.folders),
+                    'submit_latency': _percentiles(self._submit_latency),
+                    'start_latency': _percentiles(self._start_latency)}
+
+    def start(self):
+        for folder in self.folders:
+            folder.thread = threading.Thread(
+                target=self._run, args=(folder,),
+                name='ingest-' + os.path.basename(folder.path))
+            folder.thread.daemon = True
+            folder.thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        for folder in self.folders:
+            if folder.thread is not None:
+                folder.watcher.wake()
+                folder.thread.join()
+
+    def _timeout(self, folder, now):
+        deadlines = [deadline for deadline in (
+            folder.deadlines[0][0] if folder.deadlines else None,
+            folder.retry_at) if deadline is not None]
+        return max(min(deadlines) - now, 0) if deadlines else None
+
+    def _run(self, folder):
+        try:
+            self._scan(folder, time.time())
+            while not self._stopped.is_set():
+                events = folder.watcher.read_events(
+                    self._timeout(folder, time.time()))
+                if self._stopped.is_set():
+                    return
+                now = time.time()
+                if events is None:
+                    self._scan(folder, now)
+                else:
+                    for name, mask in events:
+                        self._touch(folder, name, mask, now)
+                drops = self._take(folder, now)
+                if folder.retry and (drops or folder.retry_at <= now):
+                    drops = folder.retry + drops
+                if drops:
+                    try:
+                        self._submit(folder, drops, now)
+                    except Exception:
+                        folder.retry = drops
+                        folder.retry_at = now + self.retry_wait
+        finally:
+            folder.watcher.close()
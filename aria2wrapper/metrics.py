@@ -0,0 +1,207 @@
+# coding=utf-8
+
+import time
+import threading
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+
+class RingBuffer(object):
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._items = [None] * capacity
+        self._next = 0
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._size
+
+    def append(self, item):
+        with self._lock:
+            self._items[self._next] = item
+            self._next = (self._next + 1) % self.capacity
+            self._size = min(self._size + 1, self.capacity)
+
+    def items(self):
+        with self._lock:
+            start = (self._next - self._size) % self.capacity
+            return [self._items[(start + i) % self.capacity]
+                    for i in range(self._size)]
+
+    def last(self):
+        with self._lock:
+            if not self._size:
+                return None
+            return self._items[(self._next - 1) % self.capacity]
+
+
+class Sample(object):
+    __slots__ = ('time', 'download_speed', 'upload_speed', 'active',
+                 'waiting', 'stopped', 'errors', 'speeds')
+
+    def __init__(self, time, download_speed, upload_speed, active, waiting,
+                 stopped, errors, speeds):
+        self.time = time
+        self.download_speed = download_speed
+        self.upload_speed = upload_speed
+        self.active = active
+        self.waiting = waiting
+        self.stopped = stopped
+        self.errors = errors
+        self.speeds = speeds
+
+
+def _percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Aria2Sampler(object):
+    """Samples aria2 throughput and queue state into a ring buffer.
+
+    One sample is a single ``system.multicall`` of ``getGlobalStat`` and
+    ``tellActive``, so memory is bounded by ``capacity`` and the cost per
+    sample is one round trip.  ``record_error`` is meant to be hooked to
+    ``aria2.onDownloadError`` notifications from the monitor.
+    """
+
+    def __init__(self, client, interval=5, capacity=720):
+        self.client = client
+        self.interval = interval
+        self.samples = RingBuffer(capacity)
+        self.errors = 0
+        self.sampling_time = 0.0
+        self.sample_count = 0
+        self._started = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def record_error(self, *args):
+        self.errors += 1
+
+    def sample_once(self):
+        start = time.time()
+        stat, active = self.client.multicall([
+            ('aria2.getGlobalStat', []),
+            ('aria2.tellActive', [['gid', 'downloadSpeed']])])
+        if isinstance(stat, Exception):
+            raise stat
+        if isinstance(active, Exception):
+            active = []
+        sample = Sample(start, int(stat['downloadSpeed']),
+                        int(stat['uploadSpeed']), int(stat['numActive']),
+                        int(stat['numWaiting']), int(stat['numStopped']),
+                        self.errors,
+                        dict((d['gid'], int(d['downloadSpeed']))
+                             for d in active))
+        self.samples.append(sample)
+        self.sampling_time += time.time() - start
+        self.sample_count += 1
+        return sample
+
+    def start(self):
+        self._started = time.time()
+        self._thread = threading.Thread(target=self._run,
+                                        name='aria2-sampler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.sample_once()
+            except Exception:
+                pass
+
+    def overhead(self):
+        # Fraction of wall time spent sampling since start().
+        if self._started is None:
+            return 0.0
+        return self.sampling_time / max(time.time() - self._started, 1e-9)
+
+    def window(self, seconds=None):
+        samples = self.samples.items()
+        if seconds is None or not samples:
+            return samples
+        since = samples[-1].time - seconds
+        return [sample for sample in samples if sample.time >= since]
+
+    def rate(self, seconds=None, field='download_speed'):
+        samples = self.window(seconds)
+        if not samples:
+            return None
+        return sum(getattr(s, field) for s in samples) / float(len(samples))
+
+    def percentile(self, fraction, seconds=None, field='download_speed'):
+        return _percentile([getattr(s, field) for s in self.window(seconds)],
+                           fraction)
+
+    def queue_depth(self):
+        sample = self.samples.last()
+        return sample.waiting if sample else None
+
+    def error_count(self, seconds=None):
+        samples = self.window(seconds)
+        if seconds is None:
+            return self.errors
+        if not samples:
+            return 0
+        return self.errors - samples[0].errors
+
+    def render_prometheus(self):
+        sample = self.samples.last()
+        lines = ['# TYPE aria2_errors_total counter',
+                 'aria2_errors_total {}'.format(self.errors),
+                 '# TYPE aria2_sampling_seconds_total counter',
+                 'aria2_sampling_seconds_total {:.6f}'.
+                 format(self.sampling_time)]
+        if sample is not None:
+            for name, value in (('download_speed_bytes', 'download_speed'),
+                                ('upload_speed_bytes', 'upload_speed'),
+                                ('active_downloads', 'active'),
+                                ('waiting_downloads', 'waiting'),
+                                ('stopped_downloads', 'stopped')):
+                lines.append('# TYPE aria2_{} gauge'.format(name))
+                lines.append('aria2_{} {}'.format(name,
+                                                  getattr(sample, value)))
+            lines.append('# TYPE aria2_download_speed_bytes_by_gid gauge')
+            for gid, speed in sorted(sample.speeds.items()):
+                lines.append('aria2_download_speed_bytes_by_gid'
+                             '{{gid="{}"}} {}'.format(gid, speed))
+        return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        data = self.server.sampler.render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_metrics_server(sampler, port, host='127.0.0.1'):
+    server = HTTPServer((host, port), _MetricsHandler)
+    server.sampler = sampler
+    thread = threading.Thread(target=server.serve_forever,
+                              name='aria2-metrics')
+    thread.daemon = True
+    thread.start()
+    return server
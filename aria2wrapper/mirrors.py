@@ -0,0 +1,305 @@
+# coding=utf-8
+
+import time
+import threading
+try:
+    from Queue import Queue, Empty
+    from urlparse import urlsplit
+    from urllib2 import Request, urlopen
+except ImportError:
+    from queue import Queue, Empty
+    from urllib.parse import urlsplit
+    from urllib.request import Request, urlopen
+
+from aria2wrapper.enqueue import normalize_entry
+
+_SCHEMES = ('http', 'https', 'ftp')
+
+
+def host_of(uri):
+    # Mirrors are told apart by host and port.
+    return urlsplit(uri).netloc.lower().rpartition('@')[2]
+
+
+def probe(uri, size=64 << 10, timeout=5):
+    """``(latency, speed)`` of fetching the first ``size`` bytes of
+    ``uri``: seconds to the response headers, then bytes/s of the body."""
+    start = time.time()
+    request = Request(uri, headers={'Range': 'bytes=0-{}'.format(size - 1)})
+    response = urlopen(request, timeout=timeout)
+    try:
+        latency = time.time() - start
+        received = 0
+        while received < size:
+            # A server ignoring Range sends the whole file; stop anyway.
+            chunk = response.read(min(size - received, 16384))
+            if not chunk:
+                break
+            received += len(chunk)
+    finally:
+        response.close()
+    elapsed = time.time() - start - latency
+    return latency, received / max(elapsed, 1e-6)
+
+
+class HostScore(object):
+    """Latency and per-connection speed of one host, as moving averages
+    whose memory halves every ``half_life`` seconds."""
+
+    def __init__(self, half_life=600, alpha=0.3):
+        self.half_life = half_life
+        self.alpha = alpha
+        self.latency = None
+        self.speed = None
+        self.failures = 0.0
+        self.updated = None
+
+    def _keep(self, now):
+        # The weight of the old value: ``1 - alpha`` for back-to-back
+        # samples, less the older it is.
+        if self.updated is None:
+            return 0.0
+        return (1 - self.alpha) * 0.5 ** (
+            max(now - self.updated, 0) / float(self.half_life))
+
+    def observe(self, latency=None, speed=None, now=None):
+        now = now or time.time()
+        keep = self._keep(now)
+        if latency is not None:
+            self.latency = latency if self.latency is None else \
+                keep * self.latency + (1 - keep) * latency
+        if speed is not None:
+            self.speed = speed if self.speed is None else \
+                keep * self.speed + (1 - keep) * speed
+        self.failures *= keep
+        self.updated = now
+
+    def fail(self, now=None):
+        now = now or time.time()
+        self.failures = self.failures * self._keep(now) + 1
+        self.updated = now
+
+    def cost(self, size, now=None):
+        """Estimated seconds to fetch ``size`` bytes from this host."""
+        if self.speed is None:
+            return float('inf')
+        failures = self.failures * 0.5 ** (
+            max((now or time.time()) - self.updated, 0) /
+            float(self.half_life))
+        # A host only seen in aria2's live speeds was never probed: its
+        # connections are open already, so no latency to add.
+        latency = self.latency if self.latency is not None else 0.0
+        # Each recent failure counts as a lost round of retrying.
+        return (latency + size / max(self.speed, 1.0)) * (1 + failures)
+
+    def stale(self, max_age, now=None):
+        return self.updated is None or \
+            (now or time.time()) - self.updated > max_age
+
+
+class MirrorSelector(object):
+    """Orders the URIs of a download, fastest source first.
+
+    Hosts without a recent score are probed concurrently (``workers``
+    at a time) with a ranged GET of ``probe_size`` bytes.  A host is
+    ranked by its estimated time to fetch ``size_hint`` bytes:
+    latency + size / speed, inflated by recent failures.  ``rank_entries``
+    reorders (and with ``max_uris`` trims) the URIs of entries on their
+    way to ``enqueue``.  Entries with a single URI pass through unprobed.
+
+    Once started, the selector also learns from the downloads themselves.
+    Every ``interval`` seconds the per-connection speeds from
+    ``aria2.getServers`` of the active downloads feed the scores.  When
+    the ranking changes, downloads it submitted that have not started yet
+    get their URIs reordered with ``aria2.changeUri``.
+    """
+
+    def __init__(self, client=None, probe_size=64 << 10, size_hint=64 << 20,
+                 max_uris=None, workers=8, timeout=5, half_life=600,
+                 interval=5, probe=probe):
+        self.client = client
+        self.probe_size = probe_size
+        self.size_hint = size_hint
+        self.max_uris = max_uris
+        self.workers = workers
+        self.timeout = timeout
+        self.half_life = half_life
+        self.interval = interval
+        self.probe = probe
+        self.scores = {}
+        self.probes = 0
+        self._submitted = {}
+        self._order = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _score(self, host):
+        # Called with the lock held.
+        score = self.scores.get(host)
+        if score is None:
+            score = self.scores[host] = HostScore(self.half_life)
+        return score
+
+    def probe_hosts(self, uris):
+        """Probes, concurrently, one URI of every host among ``uris``
+        without a fresh score."""
+        todo = {}
+        with self._lock:
+            for uri in uris:
+                host = host_of(uri)
+                if host not in todo and \
+                        urlsplit(uri).scheme.lower() in _SCHEMES and \
+                        self._score(host).stale(self.half_life):
+                    todo[host] = uri
+        if not todo:
+            return
+        queue = Queue()
+        for item in todo.items():
+            queue.put(item)
+
+        def worker():
+            while True:
+                try:
+                    host, uri = queue.get(False)
+                except Empty:
+                    return
+                try:
+                    latency, speed = self.probe(uri, self.probe_size,
+                                                self.timeout)
+                except Exception:
+                    with self._lock:
+                        self.scores[host].fail()
+                    continue
+                with self._lock:
+                    self.scores[host].observe(latency, speed)
+                    self.probes += 1
+        threads = [threading.Thread(target=worker)
+                   for _ in range(min(self.workers, len(todo)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def rank(self, uris, probe=True):
+        if probe:
+            self.probe_hosts(uris)
+        now = time.time()
+        with self._lock:
+            costs = dict((host_of(uri),
+                          self.scores[host_of(uri)].cost(self.size_hint, now)
+                          if host_of(uri) in self.scores else float('inf'))
+                         for uri in uris)
+        # sorted() is stable: equally unknown mirrors keep their order.
+        ranked = sorted(uris, key=lambda uri: costs[host_of(uri)])
+        if self.max_uris:
+            ranked = ranked[:self.max_uris]
+        return ranked
+
+    def rank_entries(self, entries, batch_size=200):
+        """Yields ``entries`` with their URIs ranked.  Hosts are probed a
+        batch of entries at a time, so a long input stays concurrent."""
+        batch = []
+        for entry in entries:
+            batch.append(normalize_entry(entry))
+            if len(batch) >= batch_size:
+                for ranked in self._rank_batch(batch):
+                    yield ranked
+                batch = []
+        for ranked in self._rank_batch(batch):
+            yield ranked
+
+    def _rank_batch(self, batch):
+        self.probe_hosts([uri for uris, _ in batch if len(uris) > 1
+                          for uri in uris])
+        for uris, options in batch:
+            yield (self.rank(uris, False) if len(uris) > 1 else uris,
+                   options)
+
+    def add(self, uris, options=None):
+        ranked = self.rank(uris)
+        gid = self.client.addUri(ranked, options or {})
+        self.track(ranked, gid)
+        return gid
+
+    def track(self, uris, result):
+        # An ``on_result`` for enqueue: downloads with a choice of
+        # mirrors are kept up to date with the ranking.
+        if len(uris) > 1 and not isinstance(result, Exception):
+            with self._lock:
+                self._submitted[result] = list(uris)
+
+    def on_event(self, method, gid):
+        if method in ('aria2.onDownloadStart', 'aria2.onDownloadComplete',
+                      'aria2.onDownloadError', 'aria2.onDownloadStop'):
+            with self._lock:
+                self._submitted.pop(gid, None)
+
+    def step(self):
+        active = self.client.tellActive(['gid'])
+        servers = self.client.multicall([('aria2.getServers', [d['gid']])
+                                         for d in active])
+        now = time.time()
+        with self._lock:
+            for files in servers:
+                if isinstance(files, Exception):
+                    continue
+                for f in files:
+                    for server in f['servers']:
+                        speed = int(server['downloadSpeed'])
+                        if speed:
+                            self._score(host_of(
+                                server['currentUri'])).observe(speed=speed,
+                                                               now=now)
+            order = sorted(self.scores, key=lambda host:
+                           self.scores[host].cost(self.size_hint, now))
+            if order == self._order:
+                return []
+            self._order = order
+            submitted = list(self._submitted.items())
+        calls = []
+        for gid, uris in submitted:
+            ranked = self.rank(uris, False)
+            if ranked != uris:
+                calls.append(('aria2.changeUri', [gid, 1, uris, ranked]))
+        results = self.client.multicall(calls) if calls else []
+        with self._lock:
+            for (_, params), result in zip(calls, results):
+                if isinstance(result, Exception):
+                    self._submitted.pop(params[0], None)
+                elif params[0] in self._submitted:
+                    self._submitted[params[0]] = params[3]
+        return calls
+
+    def stats(self):
+        now = time.time()
+        hosts = {}
+        with self._lock:
+            for host, score in self.scores.items():
+                cost = score.cost(self.size_hint, now)
+                hosts[host] = {'latency': score.latency,
+                               'speed': score.speed,
+                               'failures': score.failures,
+                               'cost': cost if cost != float('inf')
+                               else None}
+            return {'probes': self.probes,
+                    'tracked': len(self._submitted), 'hosts': hosts}
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='aria2-mirrors')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.step()
+            except Exception:
+                pass
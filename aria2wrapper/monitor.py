@@ -0,0 +1,120 @@
+# coding=utf-8
+
+import json
+import socket
+import threading
+
+from aria2wrapper.websocket import WebSocket, WebSocketError
+
+EVENTS = ('aria2.onDownloadStart',
+          'aria2.onDownloadPause',
+          'aria2.onDownloadStop',
+          'aria2.onDownloadComplete',
+          'aria2.onDownloadError',
+          'aria2.onBtDownloadComplete')
+
+
+class Aria2Monitor(object):
+    """Follows aria2 over a single WebSocket RPC connection.
+
+    aria2 pushes its ``aria2.on*`` notifications to every WebSocket
+    client, so the monitor thread sits in a blocking ``recv`` while aria2
+    is up and only wakes for events.  The connection being open is the
+    running state; when it drops the monitor reconnects with exponential
+    backoff.  Listeners are called from the monitor thread.
+    """
+
+    def __init__(self, port=6800, host='127.0.0.1', is_alive=None,
+                 min_backoff=0.1, max_backoff=5):
+        self.host = host
+        self.port = port
+        self.is_alive = is_alive
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.state = None
+        self._state_listeners = []
+        self._event_listeners = []
+        self._stopped = threading.Event()
+        self._wakeup = threading.Event()
+        self._ws = None
+        self._thread = None
+
+    def add_state_listener(self, callback):
+        self._state_listeners.append(callback)
+
+    def add_event_listener(self, callback):
+        self._event_listeners.append(callback)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='aria2-monitor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        ws = self._ws
+        if ws is not None:
+            ws.shutdown()
+        if self._thread is not None:
+            self._thread.join()
+
+    def wake(self):
+        # aria2 was (re)started by us: retry the connection right away
+        # instead of waiting out the current backoff.
+        self._wakeup.set()
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+        self.state = state
+        for callback in list(self._state_listeners):
+            try:
+                callback(state)
+            except Exception:
+                pass
+
+    def _dispatch(self, message):
+        method = message.get('method')
+        if method not in EVENTS:
+            return
+        for params in message.get('params') or []:
+            gid = params.get('gid')
+            for callback in list(self._event_listeners):
+                try:
+                    callback(method, gid)
+                except Exception:
+                    pass
+
+    def _run(self):
+        backoff = self.min_backoff
+        while not self._stopped.is_set():
+            self._wakeup.clear()
+            try:
+                ws = WebSocket.connect(self.host, self.port)
+            except (socket.error, WebSocketError):
+                if self.is_alive is None or not self.is_alive():
+                    self._set_state(False)
+                self._wakeup.wait(backoff)
+                backoff = min(backoff * 2, self.max_backoff)
+                continue
+            backoff = self.min_backoff
+            self._ws = ws
+            self._set_state(True)
+            try:
+                while not self._stopped.is_set():
+                    message = ws.recv()
+                    if message is None:
+                        break
+                    try:
+                        self._dispatch(json.loads(message))
+                    except (ValueError, AttributeError):
+                        pass
+            except (socket.error, WebSocketError):
+                pass
+            finally:
+                self._ws = None
+                ws.close()
+            if not self._stopped.is_set():
+                self._set_state(False)
@@ -0,0 +1,325 @@
+# coding=utf-8
+
+# Post-download processing.  A job is a dict describing one finished
+# download: ``gid``, ``dir`` (its download directory), ``files`` (paths)
+# and ``bytes``; each stage takes a job and returns it, updated.  Stages
+# are module-level functions so they can run in a process pool.
+
+import os
+import time
+import shutil
+import signal
+import tarfile
+import zipfile
+import threading
+try:
+    from Queue import Queue
+except ImportError:
+    from queue import Queue
+
+from aria2wrapper.files import free_name, file_digest
+
+
+class ChecksumError(Exception):
+    pass
+
+
+def hash_files(job, algorithm='sha256'):
+    """Hashes the job's files into ``job['digests']``.  A file with a
+    ``<name>.<algorithm>`` sidecar (as published next to many downloads)
+    must match the digest it lists."""
+    digests = job.setdefault('digests', {})
+    for path in job['files']:
+        if not os.path.isfile(path):
+            continue
+        digests[path] = file_digest(path, algorithm)
+        sidecar = '{}.{}'.format(path, algorithm)
+        if os.path.isfile(sidecar):
+            with open(sidecar) as f:
+                expected = (f.read().split() or [''])[0].lower()
+            if expected != digests[path]:
+                raise ChecksumError('{}: {} {} != {}'.format(
+                    path, algorithm, digests[path], expected))
+    return job
+
+
+def _check_members(names, destination):
+    root = os.path.realpath(destination)
+    for name in names:
+        path = os.path.realpath(os.path.join(root, name))
+        if path != root and not path.startswith(root + os.sep):
+            raise ValueError('archive member escapes {}: {}'.format(
+                destination, name))
+
+
+def _tar_names(archive):
+    # Links count with their targets, or a link could be written through.
+    names = []
+    for member in archive.getmembers():
+        names.append(member.name)
+        if member.issym():
+            names.append(os.path.join(os.path.dirname(member.name),
+                                      member.linkname))
+        elif member.islnk():
+            names.append(member.linkname)
+    return names
+
+
+def extract_archives(job, remove=False):
+    """Unpacks zip and tar archives among the job's files into a directory
+    named after the archive; the directories join ``job['files']`` and the
+    archives are deleted if ``remove``."""
+    files = []
+    for path in job['files']:
+        if not os.path.isfile(path):
+            files.append(path)
+            continue
+        if zipfile.is_zipfile(path):
+            archive = zipfile.ZipFile(path)
+            names = archive.namelist()
+        elif tarfile.is_tarfile(path):
+            archive = tarfile.open(path)
+            names = _tar_names(archive)
+        else:
+            files.append(path)
+            continue
+        destination = os.path.splitext(path)[0]
+        if destination.endswith('.tar'):
+            destination = destination[:-4]
+        try:
+            _check_members(names, destination)
+            archive.extractall(destination)
+        finally:
+            archive.close()
+        files.append(destination)
+        if remove:
+            os.remove(path)
+        else:
+            files.append(path)
+    job['files'] = files
+    return job
+
+
+def move_files(job, target):
+    """Moves the job's files under ``target``, keeping their path relative
+    to the download directory.  Existing files are not overwritten; the
+    moved file gets a ``.1``, ``.2``... suffix instead."""
+    target = os.path.expanduser(target)
+    moved = []
+    for path in job['files']:
+        if not os.path.exists(path):
+            continue
+        relative = os.path.relpath(path, job.get('dir') or
+                                   os.path.dirname(path))
+        if relative.startswith(os.pardir):
+            relative = os.path.basename(path)
+        destination = free_name(os.path.join(target, relative))
+        if not os.path.isdir(os.path.dirname(destination)):
+            os.makedirs(os.path.dirname(destination))
+        # A rename when both are on one filesystem, a copy otherwise.
+        shutil.move(path, destination)
+        moved.append(destination)
+    job['files'] = moved
+    return job
+
+
+STAGES = {'hash': hash_files, 'extract': extract_archives,
+          'move': move_files}
+
+
+def _init_worker():
+    # A SIGTERM for the whole process group (as service managers send) is
+    # the parent's to handle; a worker dying of it would be re-forked
+    # mid-shutdown and could hang on a lock held by another thread.
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class StageStats(object):
+    def __init__(self, name, queue):
+        self.name = name
+        self.processed = 0
+        self.failed = 0
+        self.bytes = 0
+        self.busy = 0.0
+        self.max_queue_depth = 0
+        self._queue = queue
+        self._lock = threading.Lock()
+
+    def record(self, job, elapsed, ok):
+        with self._lock:
+            if ok:
+                self.processed += 1
+                self.bytes += job.get('bytes', 0)
+            else:
+                self.failed += 1
+            self.busy += elapsed
+
+    def as_dict(self, elapsed):
+        elapsed = max(elapsed, 1e-9)
+        return {'processed': self.processed, 'failed': self.failed,
+                'queue_depth': self._queue.qsize(),
+                'max_queue_depth': self.max_queue_depth,
+                'files_per_sec': self.processed / elapsed,
+                'bytes_per_sec': self.bytes / elapsed,
+                'busy': self.busy}
+
+
+class PostProcessor(object):
+    """Runs jobs through a chain of stages.
+
+    ``stages`` is a list of ``(name, function, kwargs)``.  Every stage has
+    a bounded queue and ``concurrency`` threads that hand its jobs to a
+    shared process pool of ``processes`` workers (``0`` runs the stages in
+    the threads themselves), so a slow job only holds one slot of one
+    stage and jobs leave each stage in completion order.  A full queue
+    blocks the stage feeding it, and ``submit`` for the first one.
+    """
+
+    def __init__(self, stages, processes=None, concurrency=None,
+                 queue_size=64, on_done=None, on_error=None):
+        import multiprocessing
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.pool = multiprocessing.Pool(processes, _init_worker) \
+            if processes else None
+        self.concurrency = concurrency or processes or 1
+        self.stages = []
+        for name, function, kwargs in stages:
+            queue = Queue(queue_size)
+            self.stages.append((function, kwargs, queue,
+                                StageStats(name, queue)))
+        self.on_done = on_done
+        self.on_error = on_error
+        self.started = None
+        self._threads = []
+
+    @classmethod
+    def from_settings(cls, settings, **kwargs):
+        """Builds the chain from the ``post-process`` setting, a list like
+        ``[{"stage": "hash"}, {"stage": "move", "target": "~/Sorted"}]``."""
+        stages = []
+        for spec in settings.get('post-process') or []:
+            spec = dict(spec)
+            name = spec.pop('stage')
+            if name not in STAGES:
+                raise ValueError('unknown post-process stage: ' + name)
+            stages.append((name, STAGES[name], spec))
+        kwargs.setdefault('processes', settings.get('post-process-workers'))
+        return cls(stages, **kwargs)
+
+    def start(self):
+        self.started = time.time()
+        for index in range(len(self.stages)):
+            for _ in range(self.concurrency):
+                thread = threading.Thread(target=self._work, args=(index,),
+                                          name='aria2-postprocess')
+                thread.daemon = True
+                thread.start()
+                self._threads.append((index, thread))
+
+    def submit(self, job):
+        self._put(0, job)
+
+    def stop(self):
+        """Finishes the queued jobs, then stops the threads and the pool."""
+        for index, (_, _, queue, _) in enumerate(self.stages):
+            for _ in range(self.concurrency):
+                queue.put(None)
+            for stage, thread in self._threads:
+                if stage == index:
+                    thread.join()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+    def stats(self):
+        elapsed = time.time() - (self.started or time.time())
+        return dict((stats.name, stats.as_dict(elapsed))
+                    for _, _, _, stats in self.stages)
+
+    def _put(self, index, job):
+        _, _, queue, stats = self.stages[index]
+        queue.put(job)
+        stats.max_queue_depth = max(stats.max_queue_depth, queue.qsize())
+
+    def _work(self, index):
+        function, kwargs, queue, stats = self.stages[index]
+        while True:
+            job = queue.get()
+            if job is None:
+                return
+            start = time.time()
+            try:
+                if self.pool is not None:
+                    job = self.pool.apply(function, (job,), kwargs)
+                else:
+                    job = function(job, **kwargs)
+            except Exception as e:
+                stats.record(job, time.time() - start, False)
+                if self.on_error is not None:
+                    self.on_error(job, stats.name, e)
+                continue
+            stats.record(job, time.time() - start, True)
+            if index + 1 < len(self.stages):
+                self._put(index + 1, job)
+            elif self.on_done is not None:
+                self.on_done(job)
+
+
+class Aria2PostProcessor(object):
+    """Feeds downloads aria2 reports complete into a PostProcessor.
+
+    Hook ``on_event`` to the monitor.  The lookup of a completed download
+    and the (possibly blocking) submit happen on a thread of their own, so
+    a busy pipeline never holds up the monitor.
+    """
+
+    def __init__(self, client, processor):
+        self.client = client
+        self.processor = processor
+        self._gids = Queue()
+        self._thread = None
+
+    def on_event(self, method, gid):
+        # onBtDownloadComplete fires while the torrent still seeds; its
+        # files are only free once onDownloadComplete follows.
+        if method == 'aria2.onDownloadComplete':
+            self._gids.put(gid)
+
+    def start(self):
+        self.processor.start()
+        self._thread = threading.Thread(target=self._run,
+                                        name='aria2-postprocess-intake')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._gids.put(None)
+        if self._thread is not None:
+            self._thread.join()
+        self.processor.stop()
+
+    def stats(self):
+        return self.processor.stats()
+
+    def job(self, gid):
+        status = self.client.tellStatus(gid, ['dir', 'files'])
+        files = [f for f in status['files']
+                 if f.get('selected', 'true') == 'true' and f['path'] and
+                 not f['path'].startswith('[METADATA]')]
+        return {'gid': gid, 'dir': status['dir'],
+                'files': [f['path'] for f in files],
+                'bytes': sum(int(f.get('length', 0)) for f in files)}
+
+    def _run(self):
+        while True:
+            gid = self._gids.get()
+            if gid is None:
+                return
+            try:
+                job = self.job(gid)
+            except Exception:
+                continue
+            if job['files']:
+                self.processor.submit(job)
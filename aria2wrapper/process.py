@@ -0,0 +1,329 @@
+# coding=utf-8
+
+import os
+import json
+import time
+import threading
+
+import psutil
+
+from aria2wrapper.trace import span
+
+
+def scan_aria2_process(aria2_bin, exclude=()):
+    for process in psutil.process_iter():
+        try:
+            if process.pid not in exclude and \
+                    aria2_bin in process.cmdline()[0]:
+                return process
+        except Exception:
+            pass
+    return None
+
+
+def _read_pid_record(path):
+    # (process, record) for a pid file naming a live process, else None.
+    try:
+        with open(path, 'r') as f:
+            record = json.load(f)
+        process = psutil.Process(record['pid'])
+        if abs(process.create_time() - record['create_time']) > 0.01:
+            return None
+    except (IOError, OSError, ValueError, KeyError, TypeError,
+            psutil.Error):
+        return None
+    return (process, record) if _is_alive(process) else None
+
+
+def recorded_pids(pid_paths):
+    """The pids of the live processes the pid files in ``pid_paths``
+    record."""
+    pids = set()
+    for path in pid_paths:
+        found = _read_pid_record(path)
+        if found is not None:
+            pids.add(found[0].pid)
+    return pids
+
+
+def build_aria2_args(aria2_bin, output_dir, session_file, rpc_secret=None,
+                     rpc_port=None, options=None):
+    args = [aria2_bin, '--enable-rpc',
+            '--rpc-listen-all=true',
+            '--rpc-allow-origin-all',
+            '--continue=true',
+            '--save-session={}'.
+            format(session_file),
+            '--dir={}'.format(output_dir)]
+    if os.path.exists(session_file):
+        args.append('--input-file={}'.format(session_file))
+    if rpc_secret:
+        args.append('--rpc-secret={}'.format(rpc_secret))
+    if rpc_port:
+        args.append('--rpc-listen-port={}'.format(rpc_port))
+    for name, value in sorted((options or {}).items()):
+        if name != 'dir':
+            args.append('--{}={}'.format(name, value))
+    return args
+
+
+def _is_alive(process):
+    try:
+        return process.is_running() and \
+            process.status() != psutil.STATUS_ZOMBIE
+    except psutil.Error:
+        return False
+
+
+class Aria2ProcessTracker(object):
+    """Keeps track of the aria2c child without scanning the process table.
+
+    Liveness is answered from the ``Popen`` handle when this process
+    spawned aria2c, then from the pid file (pid + start time, so a
+    recycled pid is never mistaken for aria2c), and only falls back to a
+    full ``process_iter`` scan when both of those fail.  The scan only
+    runs once per tracker, to adopt an aria2c left over from a previous
+    wrapper; every aria2c started afterwards goes through ``attach``.
+    Safe to share between threads.
+    """
+
+    def __init__(self, aria2_bin, pid_path, scan=True, exclude=None):
+        # scan=False when several aria2c share the binary and only the
+        # pid file can tell which one is ours.  ``exclude`` returns the
+        # pids the scan must not adopt (those of other trackers).
+        self.aria2_bin = aria2_bin
+        self.pid_path = pid_path
+        self.exclude = exclude
+        self._popen = None
+        self._process = None
+        self._scanned = not scan
+        self.rpc_settings = None
+        self._lock = threading.RLock()
+
+    @property
+    def pid(self):
+        process = self.get_process()
+        return process.pid if process else None
+
+    def attach(self, popen, rpc_settings=None):
+        # rpc_settings: the 'rpc-port'/'rpc-secret' aria2c was started
+        # with, so it can still be reached after the settings change.
+        with self._lock:
+            self._popen = popen
+            self._scanned = True
+            self.rpc_settings = rpc_settings
+            try:
+                self._process = psutil.Process(popen.pid)
+            except psutil.Error:
+                self._process = None
+                return
+            self._write_pid_file(self._process)
+
+    def get_process(self):
+        with self._lock:
+            if self._popen is not None:
+                if self._popen.poll() is None and \
+                        self._process is not None:
+                    return self._process
+                self._popen = None
+                self._process = None
+            if self._process is not None:
+                if _is_alive(self._process):
+                    return self._process
+                self._process = None
+            process = self._read_pid_file()
+            if process is None and not self._scanned:
+                self._scanned = True
+                process = scan_aria2_process(
+                    self.aria2_bin, self.exclude() if self.exclude else ())
+                if process is not None:
+                    self.rpc_settings = None
+                    self._write_pid_file(process)
+            self._process = process
+            return process
+
+    def wait(self, timeout=None):
+        process = self.get_process()
+        if process is None:
+            return True
+        try:
+            process.wait(timeout)
+        except psutil.NoSuchProcess:
+            pass
+        except psutil.TimeoutExpired:
+            return False
+        with self._lock:
+            # Reaps our child, unless a new one was attached meanwhile.
+            if self._popen is not None and self._popen.pid == process.pid:
+                self._popen.poll()
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._popen = None
+            self._process = None
+            self.rpc_settings = None
+            try:
+                os.remove(self.pid_path)
+            except OSError:
+                pass
+
+    def _read_pid_file(self):
+        found = _read_pid_record(self.pid_path)
+        if found is None:
+            return None
+        process, record = found
+        self.rpc_settings = record.get('rpc')
+        return process
+
+    def _write_pid_file(self, process):
+        try:
+            record = {'pid': process.pid,
+                      'create_time': process.create_time(),
+                      'bin': self.aria2_bin,
+                      'rpc': self.rpc_settings}
+            with open(self.pid_path, 'w') as f:
+                json.dump(record, f)
+        except (IOError, OSError, psutil.Error):
+            pass
+
+
+class Aria2StartError(Exception):
+    def __init__(self, message, handle):
+        super(Aria2StartError, self).__init__(message)
+        self.handle = handle
+
+
+class Aria2Handle(object):
+    """A spawned aria2c, ready once its RPC port answers.
+
+    ``wait_ready`` probes ``aria2.getVersion`` with exponential backoff
+    until it is answered, and records the time from spawn to that answer
+    in ``ready_latency``.  It raises Aria2StartError if aria2c exits first
+    (a port conflict, a bad option) or the timeout passes.  An answer
+    that rejects our secret comes from some other process on the port and
+    does not count.
+    """
+
+    def __init__(self, popen, rpc_port=None, rpc_secret=None,
+                 spawned_at=None):
+        from aria2wrapper.rpc import DEFAULT_PORT
+        self.popen = popen
+        self.rpc_port = rpc_port or DEFAULT_PORT
+        self.rpc_secret = rpc_secret or None
+        self.spawned_at = spawned_at or time.time()
+        self.ready_latency = None
+        self.version = None
+
+    @property
+    def pid(self):
+        return self.popen.pid
+
+    @property
+    def ready(self):
+        return self.ready_latency is not None
+
+    def poll(self):
+        return self.popen.poll()
+
+    def wait(self):
+        return self.popen.wait()
+
+    def stop(self, timeout=5):
+        """Terminates aria2c, and kills it if it is still up after
+        ``timeout`` seconds; for one that never answered RPC."""
+        if self.popen.poll() is not None:
+            return
+        try:
+            process = psutil.Process(self.popen.pid)
+            process.terminate()
+            try:
+                process.wait(timeout)
+            except psutil.TimeoutExpired:
+                process.kill()
+        except psutil.NoSuchProcess:
+            pass
+        self.popen.wait()
+
+    def wait_ready(self, timeout=10, min_delay=0.005, max_delay=0.25):
+        from aria2wrapper.rpc import Aria2Client
+        client = Aria2Client(self.rpc_port, self.rpc_secret, pool_size=1,
+                             timeout=1)
+        delay = min_delay
+        try:
+            while True:
+                exit_code = self.popen.poll()
+                if exit_code is not None:
+                    raise Aria2StartError(
+                        'aria2c exited with code {} before RPC port {} '
+                        'was ready'.format(exit_code, self.rpc_port), self)
+                try:
+                    # A token-carrying aria2.* call, so a foreign daemon
+                    # on the port fails it.
+                    self.version = client.call('aria2.getVersion')['version']
+                except Exception:
+                    pass
+                else:
+                    if self.popen.poll() is None:
+                        self.ready_latency = time.time() - self.spawned_at
+                        return self
+                remaining = self.spawned_at + timeout - time.time()
+                if remaining <= 0:
+                    raise Aria2StartError(
+                        'aria2c RPC port {} not ready after {}s'.format(
+                            self.rpc_port, timeout), self)
+                time.sleep(min(delay, remaining))
+                delay = min(delay * 2, max_delay)
+        finally:
+            client.close()
+
+
+def shutdown_aria2(tracker, client, wait=True, timeout=10, kill_timeout=5):
+    """Stops aria2c so that ``aria2.session`` is left consistent.
+
+    Phases: ``aria2.saveSession``, ``aria2.shutdown`` and a bounded wait,
+    then ``aria2.forceShutdown``, ``terminate`` and ``kill`` for as long as
+    the previous phase did not bring aria2c down.  Returns a list of
+    ``(phase, seconds, succeeded)``.  Without ``wait`` only the session is
+    saved and the shutdown requested.
+    """
+    phases = []
+
+    def phase(name, func):
+        start = time.time()
+        try:
+            with span('shutdown-' + name):
+                succeeded = bool(func())
+        except Exception:
+            succeeded = False
+        phases.append((name, time.time() - start, succeeded))
+        return succeeded
+
+    process = tracker.get_process()
+    if process is None:
+        tracker.clear()
+        return phases
+    phase('saveSession', client.saveSession)
+    if not wait:
+        if not phase('shutdown', client.shutdown):
+            phase('terminate', lambda: process.terminate() or True)
+        tracker.clear()
+        return phases
+
+    def terminate():
+        process.terminate()
+        return tracker.wait(kill_timeout)
+
+    def kill():
+        process.kill()
+        return tracker.wait(kill_timeout)
+
+    stopped = (phase('shutdown', client.shutdown) and
+               phase('wait', lambda: tracker.wait(timeout)))
+    if not stopped:
+        stopped = (phase('forceShutdown', client.forceShutdown) and
+                   phase('wait', lambda: tracker.wait(kill_timeout)))
+    if not stopped and not phase('terminate', terminate):
+        phase('kill', kill)
+    tracker.clear()
+    return phases
@@ -0,0 +1,112 @@
+# coding=utf-8
+
+import time
+import socket
+
+# Settings that map 1:1 onto aria2 global options which
+# aria2.changeGlobalOption accepts on a running daemon, with aria2's own
+# default used when a setting is removed.
+RUNTIME_OPTIONS = {
+    'dir': None,
+    'max-overall-download-limit': '0',
+    'max-overall-upload-limit': '0',
+    'max-download-limit': '0',
+    'max-upload-limit': '0',
+    'max-concurrent-downloads': '5',
+    'split': '5',
+    'max-connection-per-server': '1',
+    'min-split-size': '20M',
+    'lowest-speed-limit': '0',
+    'max-tries': '5',
+    'retry-wait': '0',
+    'timeout': '60',
+    'connect-timeout': '60',
+    'user-agent': None,
+}
+
+# Settings aria2 only reads at startup.
+RESTART_OPTIONS = ('rpc-secret', 'rpc-port', 'file-allocation', 'disk-cache',
+                   'enable-mmap', 'disk-tuning')
+
+# A tellWaiting/tellStopped ``num`` beyond any real queue.
+_ALL = 1 << 30
+
+
+def get_runtime_options(settings):
+    return dict((key, str(settings[key])) for key in RUNTIME_OPTIONS
+                if settings.get(key) not in (None, ''))
+
+
+def diff_settings(old_settings, new_settings):
+    """Returns (options to change at runtime, settings needing a restart)."""
+    runtime = {}
+    restart = []
+    for key in RUNTIME_OPTIONS:
+        old, new = old_settings.get(key), new_settings.get(key)
+        if old == new:
+            continue
+        if new in (None, ''):
+            new = RUNTIME_OPTIONS[key]
+            if new is None:
+                continue
+        runtime[key] = str(new)
+    for key in RESTART_OPTIONS:
+        if (old_settings.get(key) or None) != (new_settings.get(key) or None):
+            restart.append(key)
+    return runtime, restart
+
+
+def _gids(client, stopped=False):
+    # Every download aria2 holds, or None if it cannot be asked.  With
+    # ``stopped`` those that ended since it started count too, so a
+    # download finishing meanwhile is not taken for a dropped one.
+    from aria2wrapper.rpc import Aria2Error
+    calls = [('aria2.tellActive', [['gid']]),
+             ('aria2.tellWaiting', [0, _ALL, ['gid']])]
+    if stopped:
+        calls.append(('aria2.tellStopped', [0, _ALL, ['gid']]))
+    try:
+        results = client.multicall(calls)
+    except socket.error:
+        return None
+    if any(isinstance(result, Aria2Error) for result in results):
+        return None
+    return set(download['gid'] for result in results
+               for download in result)
+
+
+def apply_settings(client, old_settings, new_settings, restart,
+                   new_client=None):
+    """Brings a running aria2c from ``old_settings`` to ``new_settings``.
+
+    ``client`` must talk to the running daemon (i.e. use the old secret and
+    port).  Runtime options go through ``aria2.changeGlobalOption``; only if
+    a startup-only setting changed is the session saved and ``restart``
+    called to relaunch aria2c, which ``new_client`` (the new secret and
+    port; ``client`` by default) reaches once ``restart`` returns.  The
+    returned report says what was done, how long transfers were
+    interrupted and which active or waiting downloads, if any, were lost
+    along the way.
+    """
+    from aria2wrapper.rpc import Aria2Error
+    runtime, restart_keys = diff_settings(old_settings, new_settings)
+    report = {'changed': runtime, 'restart': restart_keys,
+              'interruption': 0.0, 'dropped': []}
+    if not runtime and not restart_keys:
+        return report
+    before = _gids(client)
+    start = time.time()
+    if restart_keys:
+        try:
+            client.saveSession()
+        except (Aria2Error, socket.error):
+            pass
+        restart()
+        client = new_client or client
+    else:
+        client.changeGlobalOption(runtime)
+    report['interruption'] = time.time() - start
+    after = _gids(client, stopped=True)
+    if before is not None and after is not None:
+        report['dropped'] = sorted(before - after)
+    return report
@@ -0,0 +1,232 @@
+# coding=utf-8
+
+import json
+import time
+import errno
+import socket
+import itertools
+import threading
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+
+DEFAULT_PORT = 6800
+
+
+class Aria2Error(Exception):
+    def __init__(self, code, message):
+        super(Aria2Error, self).__init__('{}: {}'.format(code, message))
+        self.code = code
+        self.message = message
+
+
+class ConnectionPool(object):
+    def __init__(self, host, port, size=4, timeout=30):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return httplib.HTTPConnection(self.host, self.port,
+                                      timeout=self.timeout), False
+
+    def put(self, connection):
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+class _Call(object):
+    def __init__(self, method, params):
+        self.method = method
+        self.params = params
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class Aria2Client(object):
+    """JSON-RPC client for the aria2c started by the wrapper.
+
+    Connections are kept alive in a small pool.  Calls made concurrently
+    from several threads are coalesced into one ``system.multicall``:
+    whichever caller finds a free connection sends everything queued so
+    far, so under load one round trip serves many calls.  ``rpc_secret``
+    is added as the ``token:`` parameter of every ``aria2.*`` method.
+    """
+
+    def __init__(self, port=DEFAULT_PORT, rpc_secret=None, host='127.0.0.1',
+                 pool_size=4, max_batch=500, batch_window=0, timeout=30):
+        self.rpc_secret = rpc_secret
+        self.pool = ConnectionPool(host, port, pool_size, timeout)
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._pending = []
+        self._senders = 0
+
+    @classmethod
+    def from_settings(cls, settings, **kwargs):
+        return cls(settings.get('rpc-port') or DEFAULT_PORT,
+                   settings.get('rpc-secret') or None, **kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def method(*params):
+            return self.call('aria2.' + name, *params)
+        return method
+
+    def call(self, method, *params):
+        call = _Call(method, list(params))
+        with self._lock:
+            self._pending.append(call)
+            send = self._senders < self.pool.size
+            if send:
+                self._senders += 1
+        if send:
+            if self.batch_window:
+                time.sleep(self.batch_window)
+            self._drain()
+        return call.wait()
+
+    def multicall(self, calls):
+        # calls: iterable of (method, params).  Returns one entry per call,
+        # an Aria2Error instance for calls that failed.
+        calls = [_Call(method, list(params)) for method, params in calls]
+        for start in range(0, len(calls), self.max_batch):
+            self._send(calls[start:start + self.max_batch])
+        return [call.error if call.error is not None else call.result
+                for call in calls]
+
+    def close(self):
+        self.pool.close()
+
+    def _drain(self):
+        while True:
+            with self._lock:
+                batch = self._pending[:self.max_batch]
+                del self._pending[:self.max_batch]
+                if not batch:
+                    self._senders -= 1
+                    return
+            self._send(batch)
+
+    def _params(self, method, params):
+        if self.rpc_secret and method.startswith('aria2.'):
+            return ['token:' + self.rpc_secret] + params
+        return params
+
+    def _send(self, batch):
+        try:
+            if len(batch) == 1:
+                call = batch[0]
+                response = self._post({'jsonrpc': '2.0',
+                                       'id': next(self._ids),
+                                       'method': call.method,
+                                       'params': self._params(call.method,
+                                                              call.params)})
+                if 'error' in response:
+                    call.finish(error=_error(response['error']))
+                else:
+                    call.finish(response.get('result'))
+                return
+            response = self._post({
+                'jsonrpc': '2.0',
+                'id': next(self._ids),
+                'method': 'system.multicall',
+                'params': [[{'methodName': call.method,
+                             'params': self._params(call.method,
+                                                    call.params)}
+                            for call in batch]]})
+            if 'error' in response:
+                error = _error(response['error'])
+                for call in batch:
+                    call.finish(error=error)
+                return
+            for call, result in zip(batch, response['result']):
+                if isinstance(result, list):
+                    call.finish(result[0])
+                else:
+                    call.finish(error=_error(result))
+        except Exception as e:
+            for call in batch:
+                if not call.done.is_set():
+                    call.finish(error=e)
+
+    def _post(self, payload):
+        body = json.dumps(payload).encode('utf-8')
+        while True:
+            connection, reused = self.pool.get()
+            response = None
+            try:
+                connection.request('POST', '/jsonrpc', body,
+                                   {'Content-Type': 'application/json'})
+                response = connection.getresponse()
+                data = response.read()
+            except (httplib.HTTPException, socket.error) as e:
+                connection.close()
+                # An idle keep-alive connection may have been closed by
+                # aria2 in the meantime; retry those on a fresh one.
+                # Only then: after a timeout or once aria2 started to
+                # answer it may have run the call, and addUri must not
+                # run twice.
+                if reused and response is None and _stale(e):
+                    continue
+                raise
+            if response.getheader('connection', '').lower() == 'close':
+                connection.close()
+            else:
+                self.pool.put(connection)
+            return json.loads(data.decode('utf-8'))
+
+
+def _stale(error):
+    # The connection was closed before aria2 answered anything: no status
+    # line at all, or a reset/broken pipe that is not a timeout.
+    if isinstance(error, httplib.BadStatusLine):
+        return True
+    if isinstance(error, socket.timeout):
+        return False
+    return getattr(error, 'errno', None) in (errno.ECONNRESET, errno.EPIPE,
+                                             errno.ECONNABORTED)
+
+
+def never_sent(error):
+    """Whether a transport ``error`` proves aria2 never saw the request:
+    nothing was listening on its port."""
+    return getattr(error, 'errno', None) == errno.ECONNREFUSED
+
+
+def _error(error):
+    if 'faultCode' in error:
+        return Aria2Error(error['faultCode'], error.get('faultString'))
+    return Aria2Error(error.get('code'), error.get('message'))
@@ -0,0 +1,355 @@
+# coding=utf-8
+
+import time
+import heapq
+import bisect
+import threading
+import itertools
+
+from aria2wrapper.rpc import Aria2Error
+from aria2wrapper.enqueue import enqueue, normalize_entry
+
+PRIORITY_CLASSES = ('urgent', 'high', 'normal', 'bulk')
+
+# Wrapper-only keys in a download's options (e.g. " priority=urgent" in an
+# input file); they are taken out before the download reaches aria2.
+TAG_OPTIONS = ('priority', 'deadline')
+
+_KEYS = ['gid', 'status']
+
+
+def parse_deadline(value, now=None):
+    """A deadline as a Unix time; ``+600`` means ten minutes from now."""
+    if value in (None, ''):
+        return None
+    value = str(value)
+    if value.startswith('+'):
+        return (now or time.time()) + float(value[1:])
+    return float(value)
+
+
+class _Tag(object):
+    __slots__ = ('priority', 'deadline', 'submitted', 'seq', 'started')
+
+    def __init__(self, priority, deadline, submitted, seq):
+        self.priority = priority
+        self.deadline = deadline
+        self.submitted = submitted
+        self.seq = seq
+        self.started = None
+
+
+class Aria2Scheduler(object):
+    """Priority classes and deadlines on top of aria2's FIFO queue.
+
+    Downloads are tagged with a class from ``classes`` (best first) and an
+    optional deadline; one that is within ``horizon`` seconds of its
+    deadline counts as the best class.  The tagged, still waiting
+    downloads are kept in a sorted index ``(class, deadline, arrival)``.
+
+    ``step`` (every ``interval`` seconds) reads aria2's active downloads
+    and the head of its waiting queue in a single multicall.  In a second
+    multicall it then:
+
+    - moves the ``head`` best waiting downloads to the front with
+      ``changePosition``, touching only those out of place;
+    - pauses active downloads of a worse class while a better one waits
+      for a slot, and unpauses them once none does;
+    - applies the per-class ``limits`` (``{'bulk': '1M'}``) to active
+      downloads while a better class is active or waiting.
+
+    Only the head is ever examined, so a step costs the same with 10 or
+    10,000 queued downloads.  Untagged downloads are adopted into
+    ``default`` when they reach the head.  Queue latency (submit to
+    active) is kept per class; see ``stats``.
+    """
+
+    def __init__(self, client, classes=PRIORITY_CLASSES, default='normal',
+                 interval=1, head=None, limits=None, horizon=300,
+                 preempt=True, history=1000):
+        self.client = client
+        self.classes = tuple(classes)
+        self.default = default
+        self.interval = interval
+        self.head = head
+        self.limits = dict(limits or {})
+        self.horizon = horizon
+        self.preempt = preempt
+        self.history = history
+        self._rank = dict((name, i) for i, name in enumerate(self.classes))
+        self._slots = 5
+        self._keys = []
+        self._index = {}
+        self._promotions = []
+        self._tags = {}
+        self._preempted = set()
+        self._limited = {}
+        self._latencies = dict((name, []) for name in self.classes)
+        self._started = dict((name, 0) for name in self.classes)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    # Tagging
+
+    def _check(self, priority, deadline):
+        # (class, deadline as a Unix time); ValueError if either is bad.
+        priority = priority or self.default
+        if priority not in self._rank:
+            raise ValueError('unknown priority class: {}'.format(priority))
+        return priority, parse_deadline(deadline)
+
+    def tag(self, gid, priority=None, deadline=None, submitted=None):
+        priority, deadline = self._check(priority, deadline)
+        with self._lock:
+            tag = _Tag(priority, deadline, submitted or time.time(),
+                       next(self._seq))
+            self._tags[gid] = tag
+            self._insert(gid)
+            if tag.deadline is not None:
+                heapq.heappush(self._promotions,
+                               (tag.deadline - self.horizon, gid))
+
+    def add(self, uris, options=None, priority=None, deadline=None):
+        options = dict(options or {})
+        priority, deadline = self._check(options.pop('priority', priority),
+                                         options.pop('deadline', deadline))
+        submitted = time.time()
+        gid = self.client.addUri(uris, options)
+        self.tag(gid, priority, deadline, submitted)
+        return gid
+
+    def enqueue(self, entries, **kwargs):
+        """``enqueue.enqueue`` with each entry's ``priority``/``deadline``
+        options turned into tags.  An entry whose class or deadline is
+        invalid is not submitted; it counts as failed and ``on_result``
+        gets the ValueError."""
+        tags = {}
+        rejected = []
+        on_result = kwargs.pop('on_result', None)
+
+        def untag(entries):
+            index = itertools.count()
+            for entry in entries:
+                uris, options = normalize_entry(entry)
+                try:
+                    priority, deadline = self._check(
+                        options.pop('priority', None),
+                        options.pop('deadline', None))
+                except ValueError as e:
+                    rejected.append(e)
+                    if on_result is not None:
+                        on_result(uris, e)
+                    continue
+                # Keyed by the index enqueue gives the entries it gets.
+                tags[next(index)] = (priority, deadline, time.time())
+                yield uris, options
+
+        def tag(index, uris, result):
+            priority, deadline, submitted = tags.pop(index)
+            if not isinstance(result, Exception):
+                self.tag(result, priority, deadline, submitted)
+            if on_result is not None:
+                on_result(uris, result)
+        stats = enqueue(self.client, untag(entries), on_result=tag,
+                        indexed=True, **kwargs)
+        stats.count(failed=len(rejected))
+        return stats
+
+    # The index; called with the lock held.
+
+    def _effective_rank(self, tag, now=None):
+        if tag.deadline is not None and \
+                tag.deadline - (now or time.time()) <= self.horizon:
+            return 0
+        return self._rank[tag.priority]
+
+    def _insert(self, gid, now=None):
+        self._remove(gid)
+        tag = self._tags[gid]
+        deadline = tag.deadline if tag.deadline is not None \
+            else float('inf')
+        key = (self._effective_rank(tag, now), deadline, tag.seq, gid)
+        bisect.insort(self._keys, key)
+        self._index[gid] = key
+
+    def _remove(self, gid):
+        key = self._index.pop(gid, None)
+        if key is not None:
+            del self._keys[bisect.bisect_left(self._keys, key)]
+
+    def _forget(self, gid):
+        self._remove(gid)
+        self._tags.pop(gid, None)
+        self._preempted.discard(gid)
+        self._limited.pop(gid, None)
+
+    def _adopt(self, gid, now):
+        self._tags[gid] = _Tag(self.default, None, now, next(self._seq))
+
+    def _mark_started(self, gid, now):
+        self._remove(gid)
+        tag = self._tags.get(gid)
+        if tag is None or tag.started is not None:
+            return
+        tag.started = now
+        latencies = self._latencies[tag.priority]
+        latencies.append(now - tag.submitted)
+        if len(latencies) > self.history:
+            del latencies[:len(latencies) - self.history]
+        self._started[tag.priority] += 1
+
+    def _rank_of(self, gid):
+        key = self._index.get(gid)
+        if key is not None:
+            return key[0]
+        tag = self._tags.get(gid)
+        if tag is None:
+            return self._rank[self.default]
+        return self._effective_rank(tag)
+
+    def on_event(self, method, gid):
+        with self._lock:
+            if method == 'aria2.onDownloadStart':
+                if gid in self._index and gid not in self._preempted:
+                    self._mark_started(gid, time.time())
+            elif method in ('aria2.onDownloadComplete',
+                            'aria2.onDownloadError',
+                            'aria2.onDownloadStop'):
+                self._forget(gid)
+
+    # Scheduling
+
+    def step(self):
+        """One scheduling round; returns the calls it made."""
+        head = self.head or max(2 * self._slots, 16)
+        state = self.client.multicall([
+            ('aria2.getGlobalOption', []),
+            ('aria2.tellActive', [_KEYS]),
+            ('aria2.tellWaiting', [0, head, _KEYS])])
+        for answer in state:
+            if isinstance(answer, Exception):
+                raise answer
+        options, active, waiting = state
+        self._slots = int(options.get('max-concurrent-downloads', 5))
+        with self._lock:
+            calls = self._plan(head, active, waiting, time.time())
+        if not calls:
+            return calls
+        answers = self.client.multicall(calls)
+        with self._lock:
+            for (method, params), answer in zip(calls, answers):
+                if isinstance(answer, Aria2Error):
+                    # Removed behind our back (no monitor events).
+                    self._forget(params[0])
+                elif method == 'aria2.unpause':
+                    self._preempted.discard(params[0])
+        return calls
+
+    def _plan(self, head, active, waiting, now):
+        calls = []
+        # Deadlines that came within the horizon move up.
+        while self._promotions and self._promotions[0][0] <= now:
+            gid = heapq.heappop(self._promotions)[1]
+            if gid in self._index:
+                self._insert(gid, now)
+        active_gids = [d['gid'] for d in active]
+        for gid in active_gids:
+            if gid not in self._tags:
+                self._adopt(gid, now)
+            if gid not in self._preempted:
+                self._mark_started(gid, now)
+        paused = set()
+        for download in waiting:
+            gid = download['gid']
+            if gid not in self._tags:
+                self._adopt(gid, now)
+            if download['status'] == 'paused':
+                paused.add(gid)
+                if gid not in self._preempted:
+                    # Paused by the user: out of the running until
+                    # unpaused.
+                    self._remove(gid)
+                    continue
+            if gid not in self._index and self._tags[gid].started is None:
+                self._insert(gid, now)
+        queued = self._keys[:head]
+        if self.preempt:
+            # Worse-class active downloads make way for better-class
+            # waiting ones, and come back once none is left.
+            if len(active_gids) >= self._slots:
+                victims = sorted(active_gids, key=self._rank_of,
+                                 reverse=True)
+                for key, victim in zip(
+                        [k for k in queued if k[3] not in self._preempted],
+                        victims):
+                    if key[0] >= self._rank_of(victim):
+                        break
+                    calls.append(('aria2.pause', [victim]))
+                    self._preempted.add(victim)
+                    self._insert(victim, now)
+            queued = self._keys[:head]
+            best_waiting = min([key[0] for key in queued
+                                if key[3] not in self._preempted] or
+                               [len(self.classes)])
+            for gid in self._preempted:
+                if gid in paused and self._rank_of(gid) <= best_waiting:
+                    calls.append(('aria2.unpause', [gid]))
+        # Reorder the head, moving only what is out of place.
+        actual = [d['gid'] for d in waiting if d['gid'] in self._index]
+        for position, key in enumerate(queued):
+            gid = key[3]
+            if position < len(actual) and actual[position] == gid:
+                continue
+            calls.append(('aria2.changePosition', [gid, position,
+                                                   'POS_SET']))
+            if gid in actual:
+                actual.remove(gid)
+            actual.insert(position, gid)
+        # Throttle worse classes while better ones have work.
+        if self.limits:
+            best = min([self._rank_of(gid) for gid in active_gids] +
+                       [key[0] for key in queued] or [len(self.classes)])
+            for gid in active_gids:
+                limit = self.limits.get(self._tags[gid].priority)
+                if limit is None or self._rank_of(gid) <= best:
+                    limit = '0'
+                if self._limited.get(gid, '0') != limit:
+                    calls.append(('aria2.changeOption',
+                                  [gid, {'max-download-limit': limit}]))
+                    self._limited[gid] = limit
+        return calls
+
+    def stats(self):
+        with self._lock:
+            result = {}
+            for name in self.classes:
+                latencies = sorted(self._latencies[name])
+                entry = {'waiting': 0, 'started': self._started[name]}
+                if latencies:
+                    entry['latency_p50'] = latencies[len(latencies) // 2]
+                    entry['latency_p95'] = \
+                        latencies[int(len(latencies) * 0.95)]
+                result[name] = entry
+            for key in self._keys:
+                result[self._tags[key[3]].priority]['waiting'] += 1
+            return result
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run,
+                                        name='aria2-scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.step()
+            except Exception:
+                pass
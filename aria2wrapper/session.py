@@ -0,0 +1,142 @@
+# coding=utf-8
+
+import os
+import time
+import hashlib
+try:
+    from urlparse import urlparse, unquote
+except ImportError:
+    from urllib.parse import urlparse, unquote
+
+from aria2wrapper.files import atomic_write
+from aria2wrapper.enqueue import parse_input_file, enqueue
+
+
+class CompactionReport(object):
+    def __init__(self):
+        self.entries_in = 0
+        self.entries_out = 0
+        self.pending = 0
+        self.duplicates = 0
+        self.completed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.elapsed = 0.0
+
+
+def pending_path(session_path):
+    return session_path + '.pending'
+
+
+def _key(uris, options, default_dir):
+    # The same URIs saved to another file are another download.
+    gid = options.get('gid')
+    digest = hashlib.sha1('\0'.join([
+        '\t'.join(sorted(uris)), options.get('dir') or default_dir or '',
+        options.get('out') or '']).encode('utf-8')).digest()
+    return gid, digest
+
+
+def target_path(uris, options, default_dir):
+    out = options.get('out')
+    if not out:
+        path = urlparse(uris[0]).path if uris else ''
+        out = unquote(path.rsplit('/', 1)[-1])
+    if not out:
+        return None
+    return os.path.join(options.get('dir') or default_dir or '', out)
+
+
+def is_complete(uris, options, default_dir, size=None):
+    # aria2 keeps a <file>.aria2 control file next to unfinished downloads,
+    # but a file without one may as well be another file of that name or
+    # a download of unknown length cut short: only its ``size`` tells.
+    path = target_path(uris, options, default_dir)
+    if size is None or not path or os.path.exists(path + '.aria2'):
+        return False
+    try:
+        return os.path.getsize(path) == size
+    except OSError:
+        return False
+
+
+def write_entry(f, uris, options):
+    f.write('\t'.join(uris) + '\n')
+    for name, value in sorted(options.items()):
+        f.write(' {}={}\n'.format(name, value))
+
+
+def _read_entries(paths):
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, 'r') as f:
+            for entry in parse_input_file(f):
+                yield entry
+
+
+def compact_session(session_path, default_dir=None, max_entries=None,
+                    sizes=None):
+    """Rewrites ``aria2.session`` without duplicate or finished entries.
+
+    Entries are streamed and deduplicated by GID and by URI set, directory
+    and file name (only a hash of each is kept).  ``sizes(gid)`` returns
+    the length of a download aria2 finished, or None (see
+    ``HistoryStore.completed_size``); an entry is dropped as finished when
+    its target file has that length and no control file.  Without
+    ``sizes`` every entry stays.  With ``max_entries`` only that many
+    stay in the session aria2c reads at startup.  The rest go to
+    ``<session>.pending`` and should be fed over RPC with
+    ``load_pending`` once aria2c is up.  Entries still pending from an
+    earlier launch are merged back in.  Both files are replaced
+    atomically.
+    """
+    report = CompactionReport()
+    start = time.time()
+    pending = pending_path(session_path)
+    sources = [path for path in (session_path, pending)
+               if os.path.exists(path)]
+    report.bytes_in = sum(os.path.getsize(path) for path in sources)
+    seen_gids = set()
+    seen_uris = set()
+    with atomic_write(session_path) as head:
+        with atomic_write(pending) as tail:
+            for uris, options in _read_entries(sources):
+                report.entries_in += 1
+                gid, digest = _key(uris, options, default_dir)
+                if (gid and gid in seen_gids) or digest in seen_uris:
+                    report.duplicates += 1
+                    continue
+                if gid:
+                    seen_gids.add(gid)
+                seen_uris.add(digest)
+                if gid and sizes is not None and \
+                        is_complete(uris, options, default_dir, sizes(gid)):
+                    report.completed += 1
+                    continue
+                if max_entries is None or report.entries_out < max_entries:
+                    write_entry(head, uris, options)
+                    report.entries_out += 1
+                else:
+                    write_entry(tail, uris, options)
+                    report.pending += 1
+    if not report.pending:
+        os.remove(pending)
+    report.bytes_out = sum(os.path.getsize(path)
+                           for path in (session_path, pending)
+                           if os.path.exists(path))
+    report.elapsed = time.time() - start
+    return report
+
+
+def load_pending(client, session_path, **kwargs):
+    """Feeds ``<session>.pending`` to a running aria2c in multicall
+    batches and removes the file once every entry was accepted."""
+    pending = pending_path(session_path)
+    if not os.path.exists(pending):
+        return None
+    with open(pending, 'r') as f:
+        stats = enqueue(client, parse_input_file(f), **kwargs)
+    if not stats.failed:
+        os.remove(pending)
+    return stats
@@ -0,0 +1,223 @@
+# coding=utf-8
+
+import json
+import threading
+
+from aria2wrapper.files import atomic_write
+from aria2wrapper.watch import FileWatcher, file_signature
+from aria2wrapper.reconfigure import RUNTIME_OPTIONS
+
+try:
+    _string_types = (str, unicode)
+except NameError:
+    _string_types = (str,)
+
+
+def _string(value):
+    if not isinstance(value, _string_types):
+        raise ValueError(value)
+    return value
+
+
+def _option(value):
+    if isinstance(value, bool):
+        raise ValueError(value)
+    if isinstance(value, (int, float)):
+        return str(value)
+    return _string(value)
+
+
+def _bool(value):
+    if isinstance(value, bool):
+        return value
+    if value in (0, 1):
+        return bool(value)
+    raise ValueError(value)
+
+
+def _flag(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return _string(value)
+
+
+def _limits(value):
+    return dict((str(name), (int(low), int(high)))
+                for name, (low, high) in value.items())
+
+
+def _instances(value):
+    instances = []
+    for instance in value:
+        instance = dict(instance)
+        if instance.get('rpc-port') is not None:
+            instance['rpc-port'] = int(instance['rpc-port'])
+        instances.append(instance)
+    return instances
+
+
+def _class_limits(value):
+    return dict((str(name), _option(limit)) for name, limit in value.items())
+
+
+def _rlimits(value):
+    return dict((str(name), _option(limit)) for name, limit in value.items())
+
+
+def _paths(value):
+    return [_string(path) for path in value]
+
+
+def _stages(value):
+    stages = [dict(spec) for spec in value]
+    for spec in stages:
+        _string(spec.get('stage'))
+    return stages
+
+
+# name: (type, default).  Settings missing from the file stay missing in
+# load(); get() falls back to the default.
+SCHEMA = {
+    'dir': (_string, None),
+    'rpc-secret': (_string, ''),
+    'rpc-port': (int, None),
+    'startup': (_bool, None),
+    'metrics-port': (int, None),
+    'metrics-interval': (float, 5),
+    'adaptive-concurrency': (_bool, False),
+    'adaptive-interval': (float, 30),
+    'concurrency-limits': (_limits, None),
+    'instances': (_instances, None),
+    'save-session-interval': (int, None),
+    'post-process': (_stages, None),
+    'post-process-workers': (int, None),
+    'disk-tuning': (_bool, True),
+    'file-allocation': (_string, None),
+    'disk-cache': (_option, None),
+    'enable-mmap': (_flag, None),
+    'scheduler': (_bool, False),
+    'scheduler-interval': (float, 1),
+    'scheduler-limits': (_class_limits, None),
+    'history': (_bool, False),
+    'history-interval': (float, 60),
+    'dedup': (_bool, False),
+    'dedup-dir': (_string, None),
+    'dedup-max-size': (_option, '10G'),
+    'mirror-selection': (_bool, False),
+    'mirror-probe-size': (_option, '64K'),
+    'mirror-max-uris': (int, None),
+    'mirror-interval': (float, 5),
+    'aria2-nice': (int, None),
+    'aria2-ionice': (_string, None),
+    'aria2-rlimits': (_rlimits, None),
+    'aria2-cgroup': (_string, None),
+    'aria2-memory-high': (_option, None),
+    'aria2-memory-max': (_option, None),
+    'aria2-cpu-max': (float, None),
+    'aria2-io-weight': (int, None),
+    'governor': (_bool, False),
+    'governor-interval': (float, 2),
+    'governor-max-rss': (_option, None),
+    'governor-max-cpu': (float, None),
+    'governor-max-io': (_option, None),
+    'watch-dirs': (_paths, None),
+    'watch-debounce': (float, 0.5),
+    'watch-processed-dir': (_string, '.processed'),
+    'watch-failed-dir': (_string, '.failed'),
+    'trace': (_bool, False),
+    'trace-size': (int, 10000),
+}
+for _name in RUNTIME_OPTIONS:
+    SCHEMA.setdefault(_name, (_option, None))
+
+
+def coerce(settings):
+    """Returns a copy of ``settings`` with every known setting converted to
+    its schema type; values that cannot be converted are dropped."""
+    result = {}
+    for name, value in settings.items():
+        if name in SCHEMA and value is not None:
+            try:
+                value = SCHEMA[name][0](value)
+            except (TypeError, ValueError, AttributeError):
+                continue
+        result[name] = value
+    return result
+
+
+class SettingsStore(object):
+    """``settings.json`` with an in-process cache.
+
+    ``load`` only re-parses the file when its inode, size or mtime
+    changed.  After ``subscribe`` a watcher thread refreshes the cache as
+    soon as the file is replaced, e.g. by the preferences process, and
+    ``load`` stops touching the disk at all.  ``save`` writes atomically.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._cache = None
+        self._signature = None
+        self._subscribers = []
+        self._watcher = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self._watcher is None or self._cache is None:
+                signature = file_signature(self.path)
+                if self._cache is None or signature != self._signature:
+                    self._cache = self._read()
+                    self._signature = signature
+            return dict(self._cache)
+
+    def get(self, name):
+        value = self.load().get(name)
+        if value is None and name in SCHEMA:
+            return SCHEMA[name][1]
+        return value
+
+    def save(self, settings):
+        settings = coerce(settings)
+        with self._lock:
+            with atomic_write(self.path) as f:
+                json.dump(settings, f)
+            self._cache = settings
+            self._signature = file_signature(self.path)
+            if self._watcher is not None:
+                self._watcher.signature = self._signature
+
+    def subscribe(self, callback):
+        # callback(new_settings) runs on the watcher thread.
+        with self._lock:
+            self._subscribers.append(callback)
+            if self._watcher is None:
+                self._watcher = FileWatcher(self.path, self._changed)
+
+    def close(self):
+        with self._lock:
+            watcher, self._watcher = self._watcher, None
+        if watcher is not None:
+            watcher.stop()
+
+    def _read(self):
+        try:
+            with open(self.path, 'r') as f:
+                settings = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if not isinstance(settings, dict):
+            return {}
+        return coerce(settings)
+
+    def _changed(self):
+        with self._lock:
+            self._cache = self._read()
+            self._signature = file_signature(self.path)
+            settings = dict(self._cache)
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(dict(settings))
+            except Exception:
+                pass
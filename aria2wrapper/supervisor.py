@@ -0,0 +1,202 @@
+# coding=utf-8
+
+import sys
+import time
+import signal
+import threading
+
+
+class Aria2Supervisor(object):
+    """Keeps one aria2c running in the foreground of a headless process.
+
+    The supervising thread blocks in ``wait()`` on the child, so nothing
+    runs while aria2c is healthy.  When aria2c exits on its own it is
+    restarted after an exponential backoff, which resets once a child
+    stayed up for ``reset_after`` seconds.  SIGTERM/SIGINT run
+    ``shutdown`` (which should save the session and stop aria2c) and end
+    ``run``.  Every restart is recorded in ``restarts`` with its exit
+    code, the child's uptime, the backoff applied and the latency from
+    noticing the exit to the replacement being spawned.  A ``spawn`` that
+    raises is retried like a child that exited at once.  ``pause`` stops
+    aria2c without ending ``run``; ``resume`` starts it again.  ``start``
+    supervises on a thread instead, without handling signals.
+    """
+
+    def __init__(self, spawn, shutdown, min_backoff=1, max_backoff=60,
+                 reset_after=60, log=None):
+        self.spawn = spawn
+        self.shutdown = shutdown
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.reset_after = reset_after
+        self.log = log or (lambda message: sys.stderr.write(message + '\n'))
+        self.restarts = []
+        self._stopping = False
+        self._paused = False
+        self._wakeup = threading.Event()
+        self._shutdown_thread = None
+        self._thread = None
+
+    def run(self):
+        previous = _handle_signals(self._on_signal)
+        try:
+            self._supervise()
+        finally:
+            _restore_signals(previous)
+            self.join()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._supervise,
+                                        name='aria2-supervisor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def join(self):
+        # Until supervising ended and ``shutdown`` returned.
+        if self._thread is not None:
+            self._thread.join()
+        if self._shutdown_thread is not None:
+            self._shutdown_thread.join()
+
+    def stop(self):
+        if self._stopping:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        self._shutdown_thread = threading.Thread(target=self.shutdown)
+        self._shutdown_thread.start()
+
+    @property
+    def paused(self):
+        return self._paused
+
+    def pause(self):
+        if self._paused or self._stopping:
+            return
+        self._paused = True
+        self.shutdown()
+
+    def resume(self):
+        self._paused = False
+        self._wakeup.set()
+
+    def _on_signal(self, signum, frame):
+        self.log('signal {} received, stopping aria2c'.format(signum))
+        self.stop()
+
+    def _supervise(self):
+        backoff = self.min_backoff
+        exited = exit_time = None
+        while not self._stopping:
+            if self._paused:
+                # Also when pause() came during the backoff: no spawn()
+                # until resume().
+                while self._paused and not self._stopping:
+                    self._wakeup.wait()
+                    self._wakeup.clear()
+                backoff = self.min_backoff
+                exited = None
+                continue
+            try:
+                popen = self.spawn()
+            except Exception as e:
+                # aria2c missing or not executable: retried like a child
+                # that exited at once.
+                self.log('aria2c could not be started: {}'.format(e))
+                popen = None
+            spawned = time.time()
+            if popen is not None and (self._stopping or self._paused):
+                # stop() or pause() came while spawn() ran, before there
+                # was an aria2c to stop.
+                self.shutdown()
+            if exited is not None and popen is not None:
+                exit_code, uptime, delay = exited
+                restart = {'exit_code': exit_code, 'uptime': uptime,
+                           'backoff': delay,
+                           'latency': spawned - exit_time}
+                self.restarts.append(restart)
+                self.log('aria2c restarted (exit code {exit_code}, up '
+                         '{uptime:.1f}s, backoff {backoff:.1f}s, latency '
+                         '{latency:.3f}s)'.format(**restart))
+            exit_code = popen.wait() if popen is not None else None
+            exit_time = time.time()
+            if self._stopping:
+                break
+            if self._paused:
+                continue
+            uptime = exit_time - spawned
+            if uptime >= self.reset_after:
+                backoff = self.min_backoff
+            delay = backoff
+            if popen is not None:
+                self.log('aria2c exited with code {} after {:.1f}s, '
+                         'restarting in {:.1f}s'.format(exit_code, uptime,
+                                                        delay))
+            exited = (exit_code, uptime, delay)
+            self._wakeup.wait(delay)
+            self._wakeup.clear()
+            backoff = min(backoff * 2, self.max_backoff)
+
+
+class SupervisorGroup(object):
+    """Runs several Aria2Supervisor, each keeping its own aria2c (the
+    instances of a cluster) with its own backoff, on threads of their
+    own.  ``run``, ``stop``, ``pause``, ``resume``, ``paused`` and
+    ``restarts`` work as on a single Aria2Supervisor, for all of them.
+    """
+
+    def __init__(self, supervisors, log=None):
+        self.supervisors = supervisors
+        self.log = log or (lambda message: sys.stderr.write(message + '\n'))
+        self._stopped = threading.Event()
+
+    @property
+    def restarts(self):
+        return [restart for supervisor in self.supervisors
+                for restart in supervisor.restarts]
+
+    @property
+    def paused(self):
+        return all(supervisor.paused for supervisor in self.supervisors)
+
+    def run(self):
+        previous = _handle_signals(self._on_signal)
+        try:
+            for supervisor in self.supervisors:
+                supervisor.start()
+            # A timeout, so that Python 2 gets to run the signal handler.
+            while not self._stopped.wait(1):
+                pass
+        finally:
+            _restore_signals(previous)
+            for supervisor in self.supervisors:
+                supervisor.stop()
+            for supervisor in self.supervisors:
+                supervisor.join()
+
+    def stop(self):
+        self._stopped.set()
+
+    def pause(self):
+        for supervisor in self.supervisors:
+            supervisor.pause()
+
+    def resume(self):
+        for supervisor in self.supervisors:
+            supervisor.resume()
+
+    def _on_signal(self, signum, frame):
+        self.log('signal {} received, stopping aria2c'.format(signum))
+        self.stop()
+
+
+def _handle_signals(handler):
+    previous = {}
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        previous[signum] = signal.signal(signum, handler)
+    return previous
+
+
+def _restore_signals(previous):
+    for signum, handler in previous.items():
+        signal.signal(signum, handler)
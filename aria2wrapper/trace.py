@@ -0,0 +1,333 @@
+# coding=utf-8
+
+# Spans around the wrapper's slow-when-it-hurts operations, and a sampling
+# profiler for when they are not enough.  Imported by main.py at startup,
+# so this module only imports what the interpreter has loaded anyway.
+#
+# While tracing is off, ``span`` returns a shared do-nothing context
+# manager and ``traced`` functions make one global lookup before calling
+# through.  While it is on, finished spans go into a ring of the most
+# recent ones; ``chrome_trace`` turns them (and a profile) into Chrome's
+# trace event format, for chrome://tracing or ui.perfetto.dev.
+
+import os
+import sys
+import time
+import functools
+import threading
+from collections import deque
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+# The ring while tracing is on, else None.
+_spans = None
+
+
+def enable(size=10000):
+    global _spans
+    if _spans is None or _spans.maxlen != size:
+        _spans = deque(_spans or (), maxlen=size)
+
+
+def disable():
+    global _spans
+    _spans = None
+
+
+def enabled():
+    return _spans is not None
+
+
+def spans():
+    return list(_spans or ())
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+    __slots__ = ('name', 'args', 'start')
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = _clock()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = _clock()
+        ring = _spans
+        if ring is not None:
+            thread = threading.current_thread()
+            # deque.append is atomic: no lock on the way.
+            ring.append((self.name, self.start, end - self.start,
+                         thread.ident, thread.name, self.args))
+        return False
+
+
+def span(name, **args):
+    """``with span('spawn-aria2c'):`` records how long the block took."""
+    if _spans is None:
+        return _NULL_SPAN
+    return _Span(name, args or None)
+
+
+def traced(name=None):
+    """Decorator recording a span per call, named after the function."""
+    def decorate(func):
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _spans is None:
+                return func(*args, **kwargs)
+            with _Span(label, None):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+class SamplingProfiler(object):
+    """Samples the stacks of every other thread each ``interval`` seconds.
+
+    Stacks are kept twice: counted by folded stack (``folded``, the input
+    of flamegraph.pl and speedscope) and, up to ``max_samples``, as timed
+    samples for ``chrome_trace``.  Frames are told apart by function, not
+    by line, to keep the counts readable.
+    """
+
+    def __init__(self, interval=0.005, max_samples=100000):
+        self.interval = interval
+        self.counts = {}
+        self.samples = deque(maxlen=max_samples)
+        self.passes = 0
+        self.started = None
+        self.stopped = None
+        self.sample_time = 0.0
+        self._labels = {}
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        start = _clock()
+        me = threading.current_thread().ident
+        names = dict((thread.ident, thread.name)
+                     for thread in threading.enumerate())
+        labels = self._labels
+        for tid, frame in sys._current_frames().items():
+            if tid == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                label = labels.get(code)
+                if label is None:
+                    label = labels[code] = '{} ({}:{})'.format(
+                        code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno)
+                stack.append(label)
+                frame = frame.f_back
+            stack.append(names.get(tid, str(tid)))
+            stack.reverse()
+            stack = tuple(stack)
+            self.counts[stack] = self.counts.get(stack, 0) + 1
+            self.samples.append((start, tid, stack))
+        self.passes += 1
+        self.sample_time += _clock() - start
+
+    def folded(self):
+        return ''.join('{} {}\n'.format(';'.join(stack), count)
+                       for stack, count in sorted(self.counts.items()))
+
+    def summary(self, top=3, depth=8):
+        """Per thread, its ``top`` most sampled stacks (the innermost
+        ``depth`` frames, outermost first) and the fraction of the
+        thread's samples each took."""
+        threads = {}
+        for stack, count in self.counts.items():
+            tails = threads.setdefault(stack[0], {})
+            tail = stack[1:][-depth:]
+            tails[tail] = tails.get(tail, 0) + count
+        result = []
+        for name in sorted(threads):
+            samples = sum(threads[name].values())
+            ranked = sorted(threads[name].items(),
+                            key=lambda item: -item[1])[:top]
+            result.append({'thread': name, 'samples': samples,
+                           'stacks': [{'fraction': count / float(samples),
+                                       'frames': list(tail)}
+                                      for tail, count in ranked]})
+        return {'passes': self.passes,
+                'seconds': (self.stopped or _clock()) - self.started
+                if self.started is not None else 0,
+                'overhead': self.sample_time,
+                'threads': result}
+
+    def start(self):
+        self.started = _clock()
+        self._thread = threading.Thread(target=self._run,
+                                        name='trace-profiler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.stopped = _clock()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.sample()
+            except Exception:
+                pass
+
+
+def chrome_trace(recorded=None, profiler=None):
+    """The spans (by default those in the ring) and the samples of
+    ``profiler`` as a Chrome trace event document."""
+    pid = os.getpid()
+    events = []
+    threads = {}
+    for name, start, duration, tid, thread, args in (
+            spans() if recorded is None else recorded):
+        event = {'name': name, 'ph': 'X', 'pid': pid, 'tid': tid,
+                 'ts': start * 1e6, 'dur': duration * 1e6}
+        if args:
+            event['args'] = dict((key, value if isinstance(
+                value, (int, float, bool, type(None))) else str(value))
+                for key, value in args.items())
+        events.append(event)
+        threads[tid] = thread
+    for tid, thread in threads.items():
+        events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid,
+                       'tid': tid, 'args': {'name': thread}})
+    document = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+    if profiler is not None:
+        # Frame ids: one per (parent, function), numbered on the way.
+        frames, leaves = {}, {}
+        for stack in profiler.counts:
+            parent = None
+            for label in stack:
+                key = (parent, label)
+                if key not in frames:
+                    frames[key] = str(len(frames) + 1)
+                parent = frames[key]
+            leaves[stack] = parent
+        document['stackFrames'] = dict(
+            (frame, dict({'name': label}, **(
+                {'parent': parent} if parent is not None else {})))
+            for (parent, label), frame in frames.items())
+        document['samples'] = [{'name': 'sample', 'pid': pid, 'tid': tid,
+                                'ts': ts * 1e6, 'sf': leaves[stack],
+                                'weight': 1}
+                               for ts, tid, stack in profiler.samples]
+    return document
+
+
+def dump_path(directory, prefix):
+    return os.path.join(directory, prefix + time.strftime(
+        '-%Y%m%d-%H%M%S.json'))
+
+
+def write_trace(path, profiler=None):
+    import json
+    from aria2wrapper.files import atomic_write
+    document = chrome_trace(profiler=profiler)
+    with atomic_write(path) as f:
+        json.dump(document, f)
+    if profiler is not None:
+        with atomic_write(os.path.splitext(path)[0] + '.folded') as f:
+            f.write(profiler.folded())
+    return len(document['traceEvents'])
+
+
+_profiler = None
+_profiler_lock = threading.Lock()
+
+
+def toggle_profiler(directory, interval=0.005):
+    """Starts the profiler, or stops it and writes
+    ``<directory>/profile-<time>.json`` (the Chrome trace: ring and
+    samples) and ``.folded`` next to it.  Returns the path written, or
+    None when it started."""
+    global _profiler
+    with _profiler_lock:
+        profiler, _profiler = _profiler, None
+        if profiler is None:
+            _profiler = SamplingProfiler(interval)
+            _profiler.start()
+            return None
+    return _write_profile(profiler, dump_path(directory, 'profile'))
+
+
+def _write_profile(profiler, path):
+    profiler.stop()
+    write_trace(path, profiler)
+    return path
+
+
+def profile_for(seconds, path, interval=0.005):
+    """Starts the profiler like ``toggle_profiler`` and, on a thread of
+    its own, stops it after ``seconds`` and writes it to ``path``.  Returns
+    False when the profiler was running already.  Toggled off before
+    that, it is written where ``toggle_profiler`` writes."""
+    global _profiler
+    with _profiler_lock:
+        if _profiler is not None:
+            return False
+        profiler = _profiler = SamplingProfiler(interval)
+        profiler.start()
+
+    def finish():
+        global _profiler
+        profiler._stopped.wait(seconds)
+        with _profiler_lock:
+            if _profiler is not profiler:
+                return
+            _profiler = None
+        _write_profile(profiler, path)
+    thread = threading.Thread(target=finish, name='trace-profile')
+    thread.daemon = True
+    thread.start()
+    return True
+
+
+def install_signal_handler(directory, signum=None):
+    """SIGUSR2 (where there is one) toggles the profiler.
+
+    Python runs signal handlers in the main thread, between bytecodes, so
+    a main thread stuck outside Python (in a Cocoa run loop, say) only
+    sees the signal once it is back.  ``ctl trace profile`` does not
+    need the main thread.
+    """
+    import signal
+    signum = signum or getattr(signal, 'SIGUSR2', None)
+    if signum is None:
+        return False
+
+    def toggle():
+        path = toggle_profiler(directory)
+        sys.stderr.write('profiling started\n' if path is None
+                         else 'profile written to {}\n'.format(path))
+
+    def on_signal(signum, frame):
+        thread = threading.Thread(target=toggle, name='trace-toggle')
+        thread.daemon = True
+        thread.start()
+    signal.signal(signum, on_signal)
+    return True
@@ -0,0 +1,209 @@
+# coding=utf-8
+
+# Blocking directory change notification: inotify on Linux, kqueue on
+# macOS/BSD, periodic polling anywhere else.  ``read`` returns the names
+# that changed, or None when the backend cannot tell and the caller
+# should rescan; ``read_events`` the same as ``(name, mask)`` pairs,
+# with inotify's masks where there are any and 0 elsewhere.
+
+import os
+import sys
+import errno
+import select
+import struct
+import threading
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_CLOEXEC = 0o2000000
+IN_NONBLOCK = 0o4000
+
+_EVENT = struct.Struct('iIII')
+
+
+class _InotifyWatcher(object):
+    def __init__(self, path, mask=(IN_CLOSE_WRITE | IN_MOVED_TO |
+                                   IN_MOVED_FROM | IN_CREATE | IN_DELETE)):
+        import ctypes
+        import ctypes.util
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or
+                                 'libc.so.6', use_errno=True)
+        self.fd = self._libc.inotify_init1(IN_CLOEXEC | IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if not isinstance(path, bytes):
+            path = path.encode(sys.getfilesystemencoding() or 'utf-8')
+        if self._libc.inotify_add_watch(self.fd, path, mask) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, 'inotify_add_watch failed')
+        self._wake_r, self._wake_w = os.pipe()
+
+    def read(self, timeout=None):
+        events = self.read_events(timeout)
+        return None if events is None else [name for name, _ in events]
+
+    def read_events(self, timeout=None):
+        readable, _, _ = select.select([self.fd, self._wake_r], [], [],
+                                       timeout)
+        if self._wake_r in readable:
+            os.read(self._wake_r, 512)
+        if self.fd not in readable:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset + _EVENT.size <= len(data):
+            _, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            if mask & IN_Q_OVERFLOW:
+                return None
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if name:
+                events.append((name.decode(sys.getfilesystemencoding() or
+                                           'utf-8', 'replace'), mask))
+        return events
+
+    def wake(self):
+        os.write(self._wake_w, b'x')
+
+    def close(self):
+        os.close(self.fd)
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+
+class _KqueueWatcher(object):
+    def __init__(self, path):
+        self.fd = os.open(path, getattr(os, 'O_EVTONLY', 0x8000)
+                          if sys.platform == 'darwin' else os.O_RDONLY)
+        self._wake_r, self._wake_w = os.pipe()
+        self.kq = select.kqueue()
+        self.kq.control([select.kevent(self.fd,
+                                       filter=select.KQ_FILTER_VNODE,
+                                       flags=(select.KQ_EV_ADD |
+                                              select.KQ_EV_CLEAR),
+                                       fflags=select.KQ_NOTE_WRITE),
+                         select.kevent(self._wake_r,
+                                       filter=select.KQ_FILTER_READ,
+                                       flags=select.KQ_EV_ADD)], 0, 0)
+
+    def read(self, timeout=None):
+        events = self.kq.control(None, 2, timeout)
+        changed = False
+        for event in events:
+            if event.ident == self._wake_r:
+                os.read(self._wake_r, 512)
+            else:
+                changed = True
+        return None if changed else []
+
+    read_events = read
+
+    def wake(self):
+        os.write(self._wake_w, b'x')
+
+    def close(self):
+        self.kq.close()
+        os.close(self.fd)
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+
+class _PollingWatcher(object):
+    def __init__(self, path, interval=1):
+        self.path = path
+        self.interval = interval
+        self._wakeup = threading.Event()
+
+    def read(self, timeout=None):
+        if timeout is None:
+            timeout = self.interval
+        self._wakeup.wait(min(timeout, self.interval))
+        self._wakeup.clear()
+        return None
+
+    read_events = read
+
+    def wake(self):
+        self._wakeup.set()
+
+    def close(self):
+        self._wakeup.set()
+
+
+def create_watcher(path, mask=None):
+    if sys.platform.startswith('linux'):
+        try:
+            if mask is None:
+                return _InotifyWatcher(path)
+            return _InotifyWatcher(path, mask)
+        except (OSError, AttributeError):
+            pass
+    elif hasattr(select, 'kqueue'):
+        try:
+            return _KqueueWatcher(path)
+        except OSError:
+            pass
+    return _PollingWatcher(path)
+
+
+def file_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_ino, stat.st_size, stat.st_mtime)
+
+
+class FileWatcher(object):
+    """Calls ``callback()`` from a background thread whenever ``path`` is
+    replaced or rewritten."""
+
+    def __init__(self, path, callback):
+        self.path = os.path.abspath(path)
+        self.callback = callback
+        self.signature = file_signature(self.path)
+        self._watcher = create_watcher(os.path.dirname(self.path))
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='watch-' +
+                                        os.path.basename(self.path))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        name = os.path.basename(self.path)
+        try:
+            while not self._stopped:
+                names = self._watcher.read()
+                if self._stopped:
+                    return
+                if names is not None and name not in names:
+                    continue
+                signature = file_signature(self.path)
+                if signature == self.signature:
+                    continue
+                self.signature = signature
+                try:
+                    self.callback()
+                except Exception:
+                    pass
+        finally:
+            self._watcher.close()
+
+    def stop(self):
+        self._stopped = True
+        self._watcher.wake()
+        self._thread.join()
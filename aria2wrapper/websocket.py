@@ -0,0 +1,155 @@
+# coding=utf-8
+
+# Just enough of RFC 6455 to talk to aria2's /jsonrpc endpoint: text
+# frames, ping/pong and close.  No extensions, no TLS.
+
+import os
+import socket
+import struct
+import base64
+import hashlib
+
+_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xa
+
+
+class WebSocketError(Exception):
+    pass
+
+
+def _accept_key(key):
+    digest = hashlib.sha1((key + _GUID).encode('ascii')).digest()
+    return base64.b64encode(digest).decode('ascii')
+
+
+class WebSocket(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self._buffer = b''
+
+    @classmethod
+    def connect(cls, host, port, path='/jsonrpc', timeout=5):
+        sock = socket.create_connection((host, port), timeout)
+        try:
+            key = base64.b64encode(os.urandom(16)).decode('ascii')
+            request = ('GET {} HTTP/1.1\r\n'
+                       'Host: {}:{}\r\n'
+                       'Upgrade: websocket\r\n'
+                       'Connection: Upgrade\r\n'
+                       'Sec-WebSocket-Key: {}\r\n'
+                       'Sec-WebSocket-Version: 13\r\n\r\n').\
+                format(path, host, port, key)
+            sock.sendall(request.encode('ascii'))
+            ws = cls(sock)
+            ws._handshake(key)
+        except Exception:
+            sock.close()
+            raise
+        sock.settimeout(None)
+        return ws
+
+    def _handshake(self, key):
+        while b'\r\n\r\n' not in self._buffer:
+            if len(self._buffer) > 65536:
+                raise WebSocketError('handshake response too large')
+            self._fill()
+        head, self._buffer = self._buffer.split(b'\r\n\r\n', 1)
+        lines = head.decode('latin-1').split('\r\n')
+        if len(lines[0].split()) < 2 or lines[0].split()[1] != '101':
+            raise WebSocketError('unexpected handshake: ' + lines[0])
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get('sec-websocket-accept') != _accept_key(key):
+            raise WebSocketError('bad Sec-WebSocket-Accept')
+
+    def _fill(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise WebSocketError('connection closed')
+        self._buffer += data
+
+    def _read(self, size):
+        while len(self._buffer) < size:
+            self._fill()
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def _read_frame(self):
+        first, second = bytearray(self._read(2))
+        fin = bool(first & 0x80)
+        opcode = first & 0x0f
+        length = second & 0x7f
+        if length == 126:
+            length, = struct.unpack('!H', self._read(2))
+        elif length == 127:
+            length, = struct.unpack('!Q', self._read(8))
+        mask = self._read(4) if second & 0x80 else None
+        payload = self._read(length)
+        if mask:
+            payload = _apply_mask(payload, mask)
+        return fin, opcode, payload
+
+    def send_frame(self, opcode, payload=b''):
+        header = bytearray([0x80 | opcode])
+        length = len(payload)
+        if length < 126:
+            header.append(0x80 | length)
+        elif length < 0x10000:
+            header.append(0x80 | 126)
+            header.extend(struct.pack('!H', length))
+        else:
+            header.append(0x80 | 127)
+            header.extend(struct.pack('!Q', length))
+        mask = os.urandom(4)
+        self.sock.sendall(bytes(header) + mask + _apply_mask(payload, mask))
+
+    def send(self, text):
+        if not isinstance(text, bytes):
+            text = text.encode('utf-8')
+        self.send_frame(OP_TEXT, text)
+
+    def recv(self):
+        # Returns the next text message, or None once the peer closed.
+        message = b''
+        while True:
+            fin, opcode, payload = self._read_frame()
+            if opcode == OP_PING:
+                self.send_frame(OP_PONG, payload)
+            elif opcode == OP_PONG:
+                pass
+            elif opcode == OP_CLOSE:
+                try:
+                    self.send_frame(OP_CLOSE, payload[:2])
+                except socket.error:
+                    pass
+                return None
+            else:
+                message += payload
+                if fin:
+                    return message.decode('utf-8')
+
+    def shutdown(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def close(self):
+        self.shutdown()
+        self.sock.close()
+
+
+def _apply_mask(payload, mask):
+    data = bytearray(payload)
+    mask = bytearray(mask)
+    for i in range(len(data)):
+        data[i] ^= mask[i % 4]
+    return bytes(data)
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# Aggregate download rate of 1 aria2c vs N aria2c behind the cluster
+# dispatcher, downloading from unthrottled local origins.  Needs a real
+# aria2c binary.
+#
+#   python -m benchmarks.cluster --aria2c /usr/bin/aria2c --instances 4
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+
+from aria2wrapper.cluster import Aria2Cluster
+from benchmarks.origin import OriginConfig, start_origin, parse_size
+
+
+def _wait_ready(cluster, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        cluster.refresh(force=True)
+        if all(instance.stat is not None for instance in cluster.instances):
+            return
+        time.sleep(0.05)
+    raise RuntimeError('aria2c did not come up')
+
+
+def run_cluster(aria2c, instances, origins, files, size, port):
+    work_dir = tempfile.mkdtemp()
+    settings = {'rpc-port': port,
+                'file-allocation': 'none',
+                'max-concurrent-downloads': '4',
+                'instances': [{'dir': os.path.join(work_dir, str(i))}
+                              for i in range(instances)]}
+    cluster = Aria2Cluster.from_settings(aria2c, work_dir, settings)
+    try:
+        cluster.start()
+        _wait_ready(cluster)
+        start = time.time()
+        for i in range(files):
+            origin = origins[i % len(origins)]
+            cluster.add_uri(['http://127.0.0.1:{}/file{}/{}'.format(
+                origin.server_address[1], i, size)])
+        while True:
+            status = cluster.status()
+            if not status['numActive'] and not status['numWaiting']:
+                break
+            time.sleep(0.1)
+        elapsed = time.time() - start
+        return files * size / elapsed
+    finally:
+        cluster.stop()
+        cluster.close()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--aria2c', required=True)
+    parser.add_argument('--instances', type=int, default=4)
+    parser.add_argument('--files', type=int, default=32)
+    parser.add_argument('--size', default='256M')
+    parser.add_argument('--port', type=int, default=16900)
+    args = parser.parse_args()
+    origins = [start_origin(OriginConfig()) for _ in range(4)]
+    try:
+        for count in (1, args.instances):
+            rate = run_cluster(args.aria2c, count, origins, args.files,
+                               parse_size(args.size), args.port)
+            print('{:>3} instance(s): {:>10.1f} MiB/s'.format(
+                count, rate / 2 ** 20))
+    finally:
+        for origin in origins:
+            origin.shutdown()
+            origin.server_close()
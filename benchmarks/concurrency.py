@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# Throughput with aria2's static concurrency defaults vs the adaptive
+# controller, over real HTTP from local throttled origins (1M per
+# connection, at most 12 connections each), in two setups:
+#
+#   fast: four origins behind a 40M link; more connections pay off.
+#   slow: the same origins behind a 4M link that loses 15% of its rate
+#         per transfer past 4, so the defaults are already too many.
+#
+# By default a small range-request downloader in this file honours the
+# three knobs the way aria2 does; with --aria2c a real daemon downloads.
+#
+#   python -m benchmarks.concurrency
+#   python -m benchmarks.concurrency --aria2c /usr/bin/aria2c --duration 60
+
+import os
+import sys
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+
+from aria2wrapper.rpc import Aria2Client
+from aria2wrapper.concurrency import (ConcurrencyController,
+                                      Aria2ConcurrencyTuner)
+from benchmarks.origin import OriginConfig, Link, start_origin, parse_size
+
+STATIC = {'max-concurrent-downloads': '5', 'split': '5',
+          'max-connection-per-server': '1'}
+
+SETUPS = {'fast': {'link': '40M', 'connections': 0, 'penalty': 0},
+          'slow': {'link': '4M', 'connections': 4, 'penalty': 0.15}}
+
+# The downloader's threads grow with these; aria2's own limits are wider.
+LIMITS = {'max-concurrent-downloads': (1, 16), 'split': (1, 16),
+          'max-connection-per-server': (1, 8)}
+
+
+class _Downloader(object):
+    """Downloads ``size``-byte files from all ``origins`` for as long as it
+    runs.  At most max-concurrent-downloads run at once; each is split
+    into min(split, max-connection-per-server * origins) ranges fetched
+    in parallel, spread over the origins.  Like aria2, split and
+    max-connection-per-server only apply to downloads started after a
+    change.  A 503 (the origin's connection cap) is retried after a
+    pause; ``on_result`` gets each range fetched, as the tuner gets each
+    completed download from aria2."""
+
+    def __init__(self, origins, size, options, on_result=None):
+        self.origins = [origin.server_address for origin in origins]
+        self.size = size
+        self.options = dict(options)
+        self.on_result = on_result
+        self.received = 0
+        self._active = 0
+        self._downloads = 0
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._stopped = False
+        self._thread = None
+
+    def change(self, options):
+        with self._lock:
+            self.options.update(options)
+            self._changed.notify()
+
+    def take_received(self):
+        with self._lock:
+            received, self.received = self.received, 0
+        return received
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            self._changed.notify()
+        self._thread.join()
+
+    def _run(self):
+        with self._lock:
+            while not self._stopped:
+                if self._active < int(
+                        self.options['max-concurrent-downloads']):
+                    self._active += 1
+                    pieces = min(int(self.options['split']),
+                                 int(self.options[
+                                     'max-connection-per-server']) *
+                                 len(self.origins))
+                    thread = threading.Thread(target=self._download,
+                                              args=(pieces,))
+                    thread.daemon = True
+                    thread.start()
+                else:
+                    self._changed.wait()
+
+    def _download(self, pieces):
+        with self._lock:
+            first = self._downloads
+            self._downloads += 1
+        step = self.size // pieces
+        threads = []
+        for i in range(pieces):
+            end = self.size - 1 if i == pieces - 1 else (i + 1) * step - 1
+            origin = self.origins[(first + i) % len(self.origins)]
+            thread = threading.Thread(target=self._fetch,
+                                      args=(origin, i * step, end))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        with self._lock:
+            self._active -= 1
+            self._changed.notify()
+
+    def _fetch(self, address, start, end):
+        host = '{}:{}'.format(*address)
+        while not self._stopped:
+            connection = httplib.HTTPConnection(address[0], address[1],
+                                                timeout=30)
+            try:
+                connection.request('GET', '/file/{}'.format(self.size),
+                                   headers={'Range': 'bytes={}-{}'.format(
+                                       start, end)})
+                response = connection.getresponse()
+                if response.status != 206:
+                    # Retried, as aria2 does up to --max-tries.
+                    response.read()
+                    time.sleep(0.2)
+                    continue
+                while not self._stopped:
+                    data = response.read(16384)
+                    if not data:
+                        break
+                    with self._lock:
+                        self.received += len(data)
+                if self.on_result is not None:
+                    self.on_result(host, True)
+                return
+            except (httplib.HTTPException, socket.error):
+                time.sleep(0.2)
+            finally:
+                connection.close()
+
+
+def _start_origins(setup):
+    config = SETUPS[setup]
+    link = Link(parse_size(config['link']), config['connections'],
+                config['penalty'])
+    return [start_origin(OriginConfig(rate=parse_size('1M'),
+                                      max_connections=12, link=link))
+            for _ in range(4)]
+
+
+def _stop_origins(origins):
+    for origin in origins:
+        origin.shutdown()
+        origin.server_close()
+
+
+def _run_downloader(origins, adaptive, duration, interval):
+    controller = ConcurrencyController(STATIC, LIMITS) if adaptive \
+        else None
+    downloader = _Downloader(origins, parse_size('1M'), STATIC,
+                             controller and controller.record_result)
+    downloader.start()
+    samples = []
+    try:
+        deadline = time.time() + duration
+        while time.time() < deadline:
+            time.sleep(interval)
+            throughput = downloader.take_received() / float(interval)
+            samples.append(throughput)
+            if controller is not None:
+                downloader.change(controller.step(throughput))
+    finally:
+        downloader.stop()
+    tail = samples[len(samples) // 2:] or [0]
+    return (sum(tail) / float(len(tail)),
+            dict(downloader.options) if adaptive else None)
+
+
+def run_downloader(setup, duration, interval):
+    origins = _start_origins(setup)
+    try:
+        static, _ = _run_downloader(origins, False, duration, interval)
+        adaptive, final = _run_downloader(origins, True, duration, interval)
+    finally:
+        _stop_origins(origins)
+    return {'static_bps': static, 'adaptive_bps': adaptive,
+            'final_options': final}
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _run_aria2c(aria2c, origins, adaptive, duration, interval):
+    work_dir = tempfile.mkdtemp()
+    port = _free_port()
+    args = [aria2c, '--enable-rpc', '--rpc-listen-port={}'.format(port),
+            '--dir={}'.format(work_dir), '--file-allocation=none',
+            '--allow-overwrite=true', '--quiet=true'] + \
+        ['--{}={}'.format(k, v) for k, v in sorted(STATIC.items())]
+    process = subprocess.Popen(args, close_fds=True)
+    client = Aria2Client(port)
+    try:
+        for _ in range(100):
+            try:
+                client.getVersion()
+                break
+            except Exception:
+                time.sleep(0.05)
+        # Files that finish within seconds, so split changes apply.
+        for i in range(5000):
+            client.addUri(['http://127.0.0.1:{}/file{}/{}'.format(
+                origin.server_address[1], i, 1 << 20)
+                for origin in origins])
+        tuner = Aria2ConcurrencyTuner(client, interval) if adaptive else None
+        samples = []
+        deadline = time.time() + duration
+        next_step = time.time() + interval
+        while time.time() < deadline:
+            time.sleep(0.5)
+            samples.append(int(client.getGlobalStat()['downloadSpeed']))
+            if tuner is not None and time.time() >= next_step:
+                tuner.step()
+                next_step += interval
+        tail = samples[len(samples) // 2:] or [0]
+        return sum(tail) / float(len(tail))
+    finally:
+        try:
+            client.forceShutdown()
+        except Exception:
+            pass
+        client.close()
+        try:
+            process.wait()
+        except KeyboardInterrupt:
+            process.kill()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run_aria2c(aria2c, setup, duration, interval):
+    origins = _start_origins(setup)
+    try:
+        return {'static_bps': _run_aria2c(aria2c, origins, False, duration,
+                                          interval),
+                'adaptive_bps': _run_aria2c(aria2c, origins, True, duration,
+                                            interval)}
+    finally:
+        _stop_origins(origins)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--aria2c')
+    parser.add_argument('--setup', choices=sorted(SETUPS), action='append',
+                        help='default: all')
+    parser.add_argument('--duration', type=float, default=60)
+    parser.add_argument('--interval', type=float, default=2)
+    args = parser.parse_args()
+    for setup in args.setup or sorted(SETUPS):
+        if args.aria2c:
+            results = run_aria2c(args.aria2c, setup, args.duration,
+                                 args.interval)
+        else:
+            results = run_downloader(setup, args.duration, args.interval)
+        print('{}: static {:.2f} MiB/s, adaptive {:.2f} MiB/s'.format(
+            setup, results['static_bps'] / 2 ** 20,
+            results['adaptive_bps'] / 2 ** 20))
+        if results.get('final_options'):
+            print('  final options: {}'.format(', '.join(
+                '{}={}'.format(k, v)
+                for k, v in sorted(results['final_options'].items()))))
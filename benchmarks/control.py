@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# Latency of asking a running wrapper for its status through the control
+# socket vs spawning a Python process per CLI action.  Starts
+# `main.py daemon` in a scratch config dir; needs an aria2c binary.
+#
+#   python -m benchmarks.control --aria2c /usr/bin/aria2c
+
+import os
+import sys
+import time
+import shutil
+import signal
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+from aria2wrapper.control import ControlClient
+
+
+def _time_per_call(func, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        func()
+    return (time.time() - start) / repeat
+
+
+def _wait_for(path, timeout=10):
+    deadline = time.time() + timeout
+    while not os.path.exists(path):
+        if time.time() > deadline:
+            raise RuntimeError('wrapper did not open its control socket')
+        time.sleep(0.02)
+
+
+def run(aria2c, repeat, spawn_repeat):
+    home = tempfile.mkdtemp()
+    bin_dir = os.path.join(home, 'bin')
+    os.mkdir(bin_dir)
+    os.symlink(os.path.realpath(aria2c), os.path.join(bin_dir, 'aria2c'))
+    env = dict(os.environ, HOME=home, XDG_CONFIG_HOME=home,
+               PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''))
+    main = os.path.join(ROOT, 'main.py')
+    path = os.path.join(home, 'aria2-wrapper', 'control.sock')
+    daemon = subprocess.Popen([sys.executable, main, 'daemon'], env=env)
+    try:
+        _wait_for(path)
+        client = ControlClient(path)
+        try:
+            results = [('socket, open connection',
+                        _time_per_call(lambda: client.request('status'),
+                                       repeat))]
+        finally:
+            client.close()
+
+        def connect_and_request():
+            client = ControlClient(path)
+            try:
+                client.request('status')
+            finally:
+                client.close()
+        results.append(('socket, connect per call',
+                        _time_per_call(connect_and_request, repeat)))
+        with open(os.devnull, 'w') as devnull:
+            results.append(('spawn `main.py ctl status`',
+                            _time_per_call(lambda: subprocess.check_call(
+                                [sys.executable, main, 'ctl', 'status'],
+                                env=env, stdout=devnull), spawn_repeat)))
+            results.append(('spawn bare interpreter',
+                            _time_per_call(lambda: subprocess.check_call(
+                                [sys.executable, '-c', 'pass'],
+                                stdout=devnull), spawn_repeat)))
+        return results
+    finally:
+        daemon.send_signal(signal.SIGTERM)
+        daemon.wait()
+        shutil.rmtree(home, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--aria2c', required=True)
+    parser.add_argument('--repeat', type=int, default=1000)
+    parser.add_argument('--spawn-repeat', type=int, default=20)
+    args = parser.parse_args()
+    print('{:<28} {:>10}'.format('path', 'ms/call'))
+    for name, seconds in run(args.aria2c, args.repeat, args.spawn_repeat):
+        print('{:<28} {:>10.3f}'.format(name, seconds * 1000))
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# The dedup cache under a skewed workload: --requests downloads drawn
+# (Zipf-like) from --artifacts distinct files on a rate-limited local
+# origin.  A miss is fetched over HTTP (standing in for aria2) and filed;
+# a hit is one HEAD request plus a link.  Reports hit rate, bytes saved
+# and origin traffic, with and without a size bound forcing evictions.
+#
+#   python -m benchmarks.dedup --artifacts 50 --requests 300 --size 4M
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+
+from aria2wrapper.dedup import DedupCache, fetch_validators
+from aria2wrapper.files import parse_size
+from benchmarks.origin import OriginConfig, start_origin
+
+
+def _download(uri, path):
+    response = urlopen(uri)
+    try:
+        with open(path, 'wb') as f:
+            shutil.copyfileobj(response, f, 1 << 20)
+    finally:
+        response.close()
+
+
+def run(artifacts, requests, size, rate, max_size, seed=1):
+    random.seed(seed)
+    config = OriginConfig(size, rate)
+    origin = start_origin(config)
+    directory = tempfile.mkdtemp()
+    cache = DedupCache(os.path.join(directory, 'dedup.sqlite'),
+                       os.path.join(directory, 'cache'), max_size)
+    weights = [1.0 / (rank + 1) for rank in range(artifacts)]
+    total = sum(weights)
+    hit_time = miss_time = 0.0
+    hits = 0
+    try:
+        for i in range(requests):
+            pick, artifact = random.random() * total, 0
+            while pick > weights[artifact]:
+                pick -= weights[artifact]
+                artifact += 1
+            # Each artifact has its own size, so its own ETag.
+            uri = 'http://127.0.0.1:{}/artifact{}/{}'.format(
+                origin.server_address[1], artifact, size + artifact)
+            # Every request goes to a fresh directory, as when the user
+            # moved the previous copy away.
+            target = os.path.join(directory, 'downloads', str(i))
+            start = time.time()
+            if cache.fetch([uri], target) is not None:
+                hits += 1
+                hit_time += time.time() - start
+                continue
+            os.makedirs(target)
+            path = os.path.join(target, 'artifact{}.bin'.format(artifact))
+            _download(uri, path)
+            cache.add([uri], path, fetch_validators(uri))
+            miss_time += time.time() - start
+        stats = cache.stats()
+    finally:
+        cache.close()
+        origin.shutdown()
+        origin.server_close()
+        shutil.rmtree(directory, ignore_errors=True)
+    return {'hit_rate': stats['hit_rate'],
+            'bytes_saved': stats['bytes_saved'],
+            'origin_bytes': config.bytes_sent,
+            'evicted': stats['evicted'],
+            'hit_ms': hit_time / max(hits, 1) * 1000,
+            'miss_ms': miss_time / max(requests - hits, 1) * 1000}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--artifacts', type=int, default=50)
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--size', type=parse_size, default=parse_size('4M'))
+    parser.add_argument('--rate', type=parse_size, default=parse_size('50M'),
+                        help='origin bytes/s per connection')
+    args = parser.parse_args()
+    print('{:<12} {:>9} {:>12} {:>12} {:>8} {:>9} {:>9}'.format(
+        'max size', 'hit rate', 'saved MB', 'origin MB', 'evicted',
+        'hit ms', 'miss ms'))
+    for fraction in (1.0, 0.25):
+        max_size = int(args.size * args.artifacts * fraction)
+        r = run(args.artifacts, args.requests, args.size, args.rate,
+                max_size)
+        print('{:<12} {:>8.1f}% {:>12.1f} {:>12.1f} {:>8} {:>9.2f} '
+              '{:>9.2f}'.format('{:.0f}%'.format(fraction * 100),
+                                r['hit_rate'] * 100, r['bytes_saved'] / 1e6,
+                                r['origin_bytes'] / 1e6, r['evicted'],
+                                r['hit_ms'], r['miss_ms']))
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# Bulk URI submission against the fake aria2: one addUri request per URI
+# vs enqueue()'s multicall batches.
+#
+#   python -m benchmarks.enqueue --count 20000
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+
+from aria2wrapper.rpc import Aria2Client
+from aria2wrapper.enqueue import enqueue
+from benchmarks.fake_aria2 import FakeAria2, start_server
+
+
+def _uris(count):
+    for i in range(count):
+        yield 'http://example.com/file/{}'.format(i)
+
+
+def run(count, latency, batch_size):
+    results = {}
+    for name in ('per-uri', 'batched'):
+        aria2 = FakeAria2(latency=latency)
+        server = start_server(aria2)
+        client = Aria2Client(server.server_address[1])
+        try:
+            start = time.time()
+            if name == 'per-uri':
+                for uri in _uris(count):
+                    client.call('aria2.addUri', [uri])
+            else:
+                enqueue(client, _uris(count), batch_size=batch_size)
+            elapsed = time.time() - start
+        finally:
+            client.close()
+            server.shutdown()
+            server.server_close()
+        results[name] = {'uris_per_sec': count / elapsed,
+                         'http_requests': aria2.requests,
+                         'added': len(aria2.downloads)}
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=20000)
+    parser.add_argument('--latency', type=float, default=0.001)
+    parser.add_argument('--batch-size', type=int, default=200)
+    args = parser.parse_args()
+    results = run(args.count, args.latency, args.batch_size)
+    print('{:<8} {:>10} {:>10} {:>8}'.format('mode', 'uris/s',
+                                             'requests', 'added'))
+    for name in ('per-uri', 'batched'):
+        r = results[name]
+        print('{:<8} {:>10.0f} {:>10} {:>8}'.format(
+            name, r['uris_per_sec'], r['http_requests'], r['added']))
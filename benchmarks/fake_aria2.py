@@ -0,0 +1,498 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# A stand-in for aria2's JSON-RPC endpoint, good enough to measure the
+# wrapper's RPC paths offline.  Downloads never progress on their own
+# unless ``simulate`` (--rate) runs them: then the queue head starts as
+# slots free up and the bandwidth is shared honouring max-download-limit
+# and max-overall-download-limit; with --write the bytes also go to disk.
+# In-process ``listeners`` get the aria2.onDownloadStart notifications a
+# WebSocket client would.
+# Also accepts aria2c's own command line (--rpc-listen-port=..., --dir=...,
+# --input-file=..., --save-session=...), which is how benchmarks/bin/aria2c
+# stands in for the real binary.
+#
+#   python -m benchmarks.fake_aria2 --port 6800 --rpc-secret s3cret
+
+import os
+import sys
+import json
+import hashlib
+import time
+import signal
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+
+from aria2wrapper.files import atomic_write
+from aria2wrapper.enqueue import parse_input_file
+from aria2wrapper.session import write_entry
+from benchmarks.origin import parse_size
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+
+class FakeAria2(object):
+    def __init__(self, rpc_secret=None, latency=0, write=False):
+        self.rpc_secret = rpc_secret
+        self.latency = latency
+        self.write = write
+        self.listeners = []
+        self.options = {'dir': '/tmp', 'max-concurrent-downloads': '5',
+                        'split': '5', 'max-connection-per-server': '1',
+                        'max-overall-download-limit': '0'}
+        self.downloads = {}
+        # Waiting and paused gids, in queue order.
+        self.queue = []
+        self.session_path = None
+        self._download_options = {}
+        self.requests = 0
+        self.calls = 0
+        self._next_gid = 1
+        self._lock = threading.Lock()
+        self.shutdown_requested = threading.Event()
+
+    def handle(self, request):
+        with self._lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        try:
+            result = self.dispatch(request['method'],
+                                   list(request.get('params', [])))
+        except RPCFault as e:
+            return {'jsonrpc': '2.0', 'id': request.get('id'),
+                    'error': {'code': e.code, 'message': e.message}}
+        return {'jsonrpc': '2.0', 'id': request.get('id'), 'result': result}
+
+    def dispatch(self, method, params):
+        if method == 'system.multicall':
+            results = []
+            for call in params[0]:
+                try:
+                    results.append([self.dispatch(call['methodName'],
+                                                  list(call['params']))])
+                except RPCFault as e:
+                    results.append({'faultCode': e.code,
+                                    'faultString': e.message})
+            return results
+        with self._lock:
+            self.calls += 1
+        if method.startswith('aria2.'):
+            if self.rpc_secret:
+                if not params or params[0] != 'token:' + self.rpc_secret:
+                    raise RPCFault(1, 'Unauthorized')
+                params = params[1:]
+            elif params and str(params[0]).startswith('token:'):
+                params = params[1:]
+        handler = getattr(self, 'rpc_' + method.replace('.', '_'), None)
+        if handler is None:
+            raise RPCFault(1, 'No such method: ' + method)
+        return handler(*params)
+
+    def add(self, uris, options=None, status='waiting', position=None):
+        with self._lock:
+            gid = (options or {}).get('gid')
+            while not gid or gid in self.downloads:
+                gid = '{:016x}'.format(self._next_gid)
+                self._next_gid += 1
+            self._download_options[gid] = dict(options or {}, gid=gid)
+            self.downloads[gid] = {
+                'gid': gid, 'status': status,
+                'totalLength': '0', 'completedLength': '0',
+                'downloadSpeed': '0', 'errorCode': '0',
+                'dir': (options or {}).get('dir', self.options['dir']),
+                'files': [{'index': '1', 'path': '',
+                           'uris': [{'uri': uri, 'status': 'used'}
+                                    for uri in uris]}],
+                'addedAt': time.time()}
+            if position is None:
+                self.queue.append(gid)
+            else:
+                self.queue.insert(int(position), gid)
+        return gid
+
+    def load_session(self, path):
+        with open(path) as f:
+            for uris, options in parse_input_file(f):
+                self.add(uris, options, 'paused'
+                         if options.get('pause') == 'true' else 'waiting')
+
+    def save_session(self):
+        if not self.session_path:
+            return
+        with self._lock:
+            downloads = [(d['files'][0]['uris'], self._download_options[gid])
+                         for gid, d in sorted(self.downloads.items())
+                         if d['status'] in ('active', 'waiting', 'paused')]
+        with atomic_write(self.session_path) as f:
+            for uris, options in downloads:
+                write_entry(f, [uri['uri'] for uri in uris], options)
+
+    def _get(self, gid):
+        try:
+            return self.downloads[gid]
+        except KeyError:
+            raise RPCFault(1, 'GID {} is not found'.format(gid))
+
+    def rpc_aria2_getVersion(self):
+        return {'version': '1.37.0-fake', 'enabledFeatures': []}
+
+    def _unique(self, options):
+        gid = (options or {}).get('gid')
+        if gid in self.downloads:
+            raise RPCFault(1, 'GID#{} is not unique.'.format(gid))
+
+    def rpc_aria2_addUri(self, uris, options=None, position=None):
+        self._unique(options)
+        return self.add(uris, options, position=position)
+
+    def rpc_aria2_addTorrent(self, torrent, uris=None, options=None,
+                             position=None):
+        self._unique(options)
+        info_hash = hashlib.sha1(torrent.encode('ascii')).hexdigest()
+        return self.add(['magnet:?xt=urn:btih:' + info_hash], options,
+                        position=position)
+
+    def rpc_aria2_addMetalink(self, metalink, options=None, position=None):
+        return [self.add(['metalink:' + hashlib.sha1(
+            metalink.encode('ascii')).hexdigest()], options,
+            position=position)]
+
+    def rpc_aria2_tellStatus(self, gid, keys=None):
+        download = self._get(gid)
+        if keys:
+            return dict((k, v) for k, v in download.items() if k in keys)
+        return dict(download)
+
+    def _tell(self, statuses, offset, num, keys):
+        with self._lock:
+            if 'waiting' in statuses:
+                items = [self.downloads[gid]
+                         for gid in self.queue[offset:offset + num]]
+            elif 'active' in statuses:
+                items = [d for d in self.downloads.values()
+                         if d['status'] in statuses][offset:offset + num]
+            else:
+                # In the order they stopped; a negative offset counts from
+                # the newest, backwards, as in aria2.
+                items = sorted((d for d in self.downloads.values()
+                                if d['status'] in statuses),
+                               key=lambda d: d.get('stoppedAt', d['addedAt']))
+                if offset < 0:
+                    items.reverse()
+                    offset = -offset - 1
+                items = items[offset:offset + num]
+        if keys:
+            items = [dict((k, v) for k, v in d.items() if k in keys)
+                     for d in items]
+        return items
+
+    def rpc_aria2_tellActive(self, keys=None):
+        return self._tell(('active',), 0, len(self.downloads), keys)
+
+    def rpc_aria2_tellWaiting(self, offset, num, keys=None):
+        return self._tell(('waiting', 'paused'), offset, num, keys)
+
+    def rpc_aria2_tellStopped(self, offset, num, keys=None):
+        return self._tell(('complete', 'error', 'removed'), offset, num,
+                          keys)
+
+    def rpc_aria2_remove(self, gid):
+        with self._lock:
+            download = self._get(gid)
+            download['status'] = 'removed'
+            download['stoppedAt'] = time.time()
+            if gid in self.queue:
+                self.queue.remove(gid)
+        return gid
+
+    def rpc_aria2_pause(self, gid):
+        # As in aria2, a paused active download goes to the queue's front.
+        with self._lock:
+            download = self._get(gid)
+            if download['status'] not in ('active', 'waiting'):
+                raise RPCFault(1, 'GID {} cannot be paused now'.format(gid))
+            if download['status'] == 'active':
+                self.queue.insert(0, gid)
+            download['status'] = 'paused'
+        return gid
+
+    def rpc_aria2_unpause(self, gid):
+        with self._lock:
+            download = self._get(gid)
+            if download['status'] != 'paused':
+                raise RPCFault(1, 'GID {} cannot be unpaused now'.format(
+                    gid))
+            download['status'] = 'waiting'
+        return gid
+
+    def rpc_aria2_changePosition(self, gid, pos, how):
+        with self._lock:
+            self._get(gid)
+            if gid not in self.queue:
+                raise RPCFault(1, 'GID {} not found in the waiting '
+                                  'queue'.format(gid))
+            current = self.queue.index(gid)
+            position = {'POS_SET': 0, 'POS_CUR': current,
+                        'POS_END': len(self.queue) - 1}[how] + int(pos)
+            position = max(0, min(position, len(self.queue) - 1))
+            del self.queue[current]
+            self.queue.insert(position, gid)
+        return position
+
+    def rpc_aria2_getServers(self, gid):
+        # One connection, to the first URI.
+        download = self._get(gid)
+        if download['status'] != 'active':
+            raise RPCFault(1, 'No active download for GID {}'.format(gid))
+        uri = download['files'][0]['uris'][0]['uri']
+        return [{'index': '1', 'servers': [
+            {'uri': uri, 'currentUri': uri,
+             'downloadSpeed': download['downloadSpeed']}]}]
+
+    def rpc_aria2_changeUri(self, gid, index, del_uris, add_uris,
+                            position=None):
+        with self._lock:
+            uris = self._get(gid)['files'][int(index) - 1]['uris']
+            deleted = 0
+            for uri in del_uris:
+                for entry in uris:
+                    if entry['uri'] == uri:
+                        uris.remove(entry)
+                        deleted += 1
+                        break
+            position = len(uris) if position is None else int(position)
+            uris[position:position] = [{'uri': uri, 'status': 'waiting'}
+                                       for uri in add_uris]
+        return [deleted, len(add_uris)]
+
+    def rpc_aria2_changeOption(self, gid, options):
+        with self._lock:
+            self._get(gid)
+            self._download_options[gid].update(options)
+        return 'OK'
+
+    def rpc_aria2_getGlobalStat(self):
+        downloads = list(self.downloads.values())
+        statuses = [d['status'] for d in downloads]
+        speed = sum(int(d['downloadSpeed']) for d in downloads
+                    if d['status'] == 'active')
+        return {'downloadSpeed': str(speed), 'uploadSpeed': '0',
+                'numActive': str(statuses.count('active')),
+                'numWaiting': str(statuses.count('waiting') +
+                                  statuses.count('paused')),
+                'numStopped': str(len(statuses) -
+                                  statuses.count('active') -
+                                  statuses.count('waiting') -
+                                  statuses.count('paused')),
+                'numStoppedTotal': str(len(statuses))}
+
+    def rpc_aria2_getGlobalOption(self):
+        return dict(self.options)
+
+    def rpc_aria2_changeGlobalOption(self, options):
+        self.options.update(options)
+        return 'OK'
+
+    def rpc_aria2_saveSession(self):
+        self.save_session()
+        return 'OK'
+
+    def rpc_aria2_shutdown(self):
+        self.shutdown_requested.set()
+        return 'OK'
+
+    def rpc_aria2_forceShutdown(self):
+        self.shutdown_requested.set()
+        return 'OK'
+
+    # Simulation
+
+    def tick(self, elapsed, rate, size):
+        """Advances downloads by ``elapsed`` seconds of ``rate`` bytes/s;
+        each download is ``size`` bytes."""
+        now = time.time()
+        started = []
+        with self._lock:
+            active = [d for d in self.downloads.values()
+                      if d['status'] == 'active']
+            slots = int(self.options['max-concurrent-downloads'])
+            for gid in list(self.queue):
+                if len(active) >= slots:
+                    break
+                download = self.downloads[gid]
+                if download['status'] != 'waiting':
+                    continue
+                self.queue.remove(gid)
+                download['status'] = 'active'
+                download['totalLength'] = str(size)
+                download.setdefault('startedAt', now)
+                active.append(download)
+                started.append(gid)
+            # Water-filling: limited downloads take their limit, the rest
+            # share what is left equally.
+            budget = rate * elapsed
+            overall = parse_size(self.options.get(
+                'max-overall-download-limit', '0'))
+            if overall:
+                budget = min(budget, overall * elapsed)
+            pending = []
+            for download in active:
+                limit = parse_size(self._download_options[
+                    download['gid']].get('max-download-limit', '0'))
+                pending.append((limit * elapsed if limit else budget,
+                                download))
+            pending.sort(key=lambda item: item[0])
+            speeds = {}
+            while pending:
+                share = budget / len(pending)
+                cap, download = pending.pop(0)
+                speeds[download['gid']] = min(cap, share)
+                budget -= speeds[download['gid']]
+            for download in active:
+                completed = int(download['completedLength']) + \
+                    int(speeds[download['gid']])
+                download['downloadSpeed'] = str(
+                    int(speeds[download['gid']] / max(elapsed, 1e-6)))
+                download['completedLength'] = str(min(completed, size))
+                if self.write:
+                    self._write(download, int(speeds[download['gid']]),
+                                completed >= size)
+                if completed >= size:
+                    download['status'] = 'complete'
+                    download['downloadSpeed'] = '0'
+                    download['stoppedAt'] = now
+        for gid in started:
+            for listener in self.listeners:
+                listener('aria2.onDownloadStart', gid)
+
+    def _write(self, download, count, done):
+        # The file is dropped once complete, so a long run does not
+        # fill the disk; its bytes have gone through the page cache.
+        path = os.path.join(download['dir'], download['gid'] + '.fake')
+        with open(path, 'ab') as f:
+            while count > 0:
+                f.write(b'\0' * min(count, 1 << 20))
+                count -= 1 << 20
+        if done:
+            os.remove(path)
+
+    def simulate(self, rate, size, interval=0.02):
+        def run():
+            last = time.time()
+            while not self.shutdown_requested.wait(interval):
+                now = time.time()
+                self.tick(now - last, rate, size)
+                last = now
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+class RPCFault(Exception):
+    def __init__(self, code, message):
+        super(RPCFault, self).__init__(message)
+        self.code = code
+        self.message = message
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        request = json.loads(body.decode('utf-8'))
+        if isinstance(request, list):
+            response = [self.server.aria2.handle(r) for r in request]
+        else:
+            response = self.server.aria2.handle(request)
+        data = json.dumps(response).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json-rpc')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+def start_server(aria2, port=0, host='127.0.0.1'):
+    server = _Server((host, port), _Handler)
+    server.aria2 = aria2
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def _parse_aria2c_options(argv):
+    options = {}
+    for arg in argv:
+        if arg.startswith('--'):
+            name, _, value = arg[2:].partition('=')
+            options[name] = value or 'true'
+    return options
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=6800)
+    parser.add_argument('--rpc-secret')
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--rate', type=parse_size, default=0,
+                        help='simulate downloads at this total rate')
+    parser.add_argument('--size', type=parse_size, default=10 << 20,
+                        help='size of each simulated download')
+    parser.add_argument('--write', action='store_true',
+                        help='write the simulated downloads into --dir')
+    args, aria2c_argv = parser.parse_known_args(argv)
+    options = _parse_aria2c_options(aria2c_argv)
+    for name in ('enable-rpc', 'rpc-allow-origin-all'):
+        options.pop(name, None)
+    port = int(options.pop('rpc-listen-port', args.port))
+    host = '0.0.0.0' \
+        if options.pop('rpc-listen-all', None) == 'true' else '127.0.0.1'
+    input_file = options.pop('input-file', None)
+    aria2 = FakeAria2(options.pop('rpc-secret', args.rpc_secret),
+                      args.latency, args.write)
+    aria2.session_path = options.pop('save-session', None)
+    aria2.options.update(options)
+    if input_file and os.path.exists(input_file):
+        aria2.load_session(input_file)
+    server = start_server(aria2, port, host)
+    if args.rate:
+        aria2.simulate(args.rate, args.size)
+    # aria2c saves its session on SIGTERM/SIGINT as on aria2.shutdown.
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum,
+                      lambda signum, frame: aria2.shutdown_requested.set())
+    interval = int(aria2.options.get('save-session-interval', 0))
+    last_save = time.time()
+    while not aria2.shutdown_requested.wait(1):
+        if interval and time.time() - last_save >= interval:
+            aria2.save_session()
+            last_save = time.time()
+    aria2.save_session()
+    # Let the answer to aria2.shutdown go out; exiting ends the server.
+    time.sleep(0.1)
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()
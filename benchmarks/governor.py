@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# The resource governor against a real child: the fake aria2c, simulating
+# downloads at --rate and writing them to disk.  Reports which limits of
+# the launch envelope applied, the cost of one sample of the child, and
+# the child's disk I/O before and under an --io-budget.
+#
+#   python -m benchmarks.governor --rate 200M --io-budget 50M
+
+import os
+import sys
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+
+import psutil
+
+from aria2wrapper.rpc import Aria2Client
+from aria2wrapper.files import parse_size
+from aria2wrapper.governor import (ProcessSampler, Aria2Governor,
+                                   apply_limits, cgroup_files)
+from aria2wrapper.process import Aria2Handle
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def _spawn(directory, rate, size):
+    port = _free_port()
+    popen = subprocess.Popen(
+        [sys.executable, '-m', 'benchmarks.fake_aria2', '--write',
+         '--rate', str(rate), '--size', str(size),
+         '--rpc-listen-port={}'.format(port), '--dir={}'.format(directory),
+         '--max-concurrent-downloads=4'],
+        cwd=os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+    return Aria2Handle(popen, port).wait_ready()
+
+
+def bench_sample(process, repeat):
+    sampler = ProcessSampler(lambda: process)
+    start = time.time()
+    for _ in range(repeat):
+        sampler.sample()
+    return (time.time() - start) / repeat * 1000
+
+
+def _io_rates(measure, seconds, interval):
+    # ``measure`` returns a sample of the child's usage.
+    rates = []
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        time.sleep(interval)
+        usage = measure()
+        if usage and usage['io'] is not None:
+            rates.append((time.time(), usage['io']))
+    return rates
+
+
+def bench_governor(client, process, budget, seconds, interval):
+    sampler = ProcessSampler(lambda: process)
+    sampler.sample()
+    before = _io_rates(sampler.sample, seconds, interval)
+    governor = Aria2Governor(client, ProcessSampler(lambda: process),
+                             {'io': budget}, interval)
+
+    def governed():
+        governor.step()
+        return governor.usage
+    start = time.time()
+    during = _io_rates(governed, seconds * 2, interval)
+    limit = client.getGlobalOption()['max-overall-download-limit']
+    governor.stop()
+    restored = client.getGlobalOption()['max-overall-download-limit']
+    within = [t - start for t, rate in during if rate <= budget * 1.1]
+    steady = [rate for t, rate in during if t - start > seconds]
+    return {'before': sum(r for _, r in before) / max(len(before), 1),
+            'steady': sum(steady) / max(len(steady), 1),
+            'converged_s': within[0] if within else None,
+            'over_budget': sum(1 for r in steady if r > budget * 1.1) /
+            float(max(len(steady), 1)),
+            'limit': limit, 'restored': restored,
+            'throttles': governor.governor.throttles}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rate', type=parse_size, default=parse_size('200M'),
+                        help='simulated download rate of the child')
+    parser.add_argument('--io-budget', type=parse_size,
+                        default=parse_size('50M'))
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--interval', type=float, default=0.5)
+    parser.add_argument('--cgroup', help='cgroup v2 group to try, '
+                        'relative to /sys/fs/cgroup')
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp()
+    handle = _spawn(directory, args.rate, parse_size('256M'))
+    client = Aria2Client(handle.rpc_port)
+    try:
+        process = psutil.Process(handle.pid)
+        limits = apply_limits(handle.pid, 10, 'idle',
+                              {'nofile': 1024, 'core': 0}, args.cgroup,
+                              cgroup_files('1G', cpu_max=1, io_weight=50))
+        sample_ms = bench_sample(process, 1000)
+        for _ in range(8):
+            client.addUri(['http://example.com/big.iso'])
+        result = bench_governor(client, process, args.io_budget,
+                                args.seconds, args.interval)
+    finally:
+        client.close()
+        handle.popen.terminate()
+        handle.wait()
+        shutil.rmtree(directory, ignore_errors=True)
+    for name, error in sorted(limits.items()):
+        print('{:<14} {}'.format(name, 'applied' if error is None
+                                 else 'not applied: ' + error))
+    print('sample:        {:.3f} ms'.format(sample_ms))
+    print('disk I/O:      {:.1f} MB/s unthrottled, {:.1f} MB/s governed '
+          '(budget {:.1f} MB/s)'.format(result['before'] / 1e6,
+                                        result['steady'] / 1e6,
+                                        args.io_budget / 1e6))
+    print('converged:     {}'.format(
+        '{:.1f}s'.format(result['converged_s'])
+        if result['converged_s'] is not None else 'never'))
+    print('over budget:   {:.0f}% of governed samples'.format(
+        result['over_budget'] * 100))
+    print('download limit {} while governed, {} after stop'.format(
+        result['limit'], result['restored']))
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# The download history store: ingestion from the fake aria2's tellStopped
+# (a first full sync, then incremental ones), bulk insert rate, and query
+# latency once the store holds --rows rows.
+#
+#   python -m benchmarks.history --rows 1000000
+
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+
+from aria2wrapper.rpc import Aria2Client
+from aria2wrapper.history import HistoryStore, Aria2HistoryRecorder
+from benchmarks.fake_aria2 import FakeAria2, start_server
+
+_YEAR = 365 * 86400
+
+
+def _stop(aria2, count, start):
+    # Adds ``count`` finished downloads to the fake aria2.
+    for i in range(start, start + count):
+        gid = aria2.add(['http://example.com/file/{}'.format(i)])
+        download = aria2.downloads[gid]
+        aria2.queue.remove(gid)
+        download.update({'status': 'error' if i % 20 == 0 else 'complete',
+                         'totalLength': '1048576',
+                         'completedLength': '1048576',
+                         'stoppedAt': time.time()})
+        download['files'][0]['path'] = '/downloads/file/{}'.format(i)
+
+
+def bench_sync(path, stopped, incremental, repeat):
+    aria2 = FakeAria2()
+    server = start_server(aria2)
+    client = Aria2Client(server.server_address[1])
+    store = HistoryStore(path)
+    try:
+        _stop(aria2, stopped, 0)
+        recorder = Aria2HistoryRecorder(client, store)
+        start = time.time()
+        recorder.sync()
+        full = time.time() - start
+        elapsed = 0
+        requests = aria2.requests
+        for i in range(repeat):
+            _stop(aria2, incremental, stopped + i * incremental)
+            start = time.time()
+            recorder.sync()
+            elapsed += time.time() - start
+        requests = (aria2.requests - requests) / float(repeat)
+    finally:
+        store.close()
+        client.close()
+        server.shutdown()
+        server.server_close()
+    return {'full_sync_rows_per_sec': stopped / full,
+            'incremental_sync_ms': elapsed / repeat * 1000,
+            'incremental_requests': requests}
+
+
+def _records(count, now):
+    for i in range(count):
+        finished = now - _YEAR + i * float(_YEAR) / count
+        yield {'gid': '{:016x}'.format(i),
+               'uri': 'https://mirror{}.example.com/pub/{}.iso'.format(
+                   i % 100, i),
+               'path': '/downloads/{}.iso'.format(i),
+               'status': 'error' if i % 20 == 0 else 'complete',
+               'error_code': 1 if i % 20 == 0 else 0,
+               'size': 1 << 30, 'completed': 1 << 30,
+               'started': finished - 60, 'finished': finished,
+               'duration': 60, 'speed': (1 << 30) / 60.0}
+
+
+def bench_store(path, rows, repeat):
+    store = HistoryStore(path)
+    now = time.time()
+    batch = []
+    start = time.time()
+    for record in _records(rows, now):
+        batch.append(record)
+        if len(batch) == 10000:
+            store.add(batch)
+            batch = []
+    store.add(batch)
+    insert = time.time() - start
+    queries = {
+        'by_uri': lambda i: store.query(
+            uri='https://mirror{}.example.com/pub/{}.iso'.format(
+                i % 100, i * 7919 % rows)),
+        'by_uri_prefix': lambda i: store.query(
+            uri_prefix='https://mirror{}.example.com/'.format(i % 100)),
+        'last_hour': lambda i: store.query(since=now - 3600, limit=None),
+        'day_range': lambda i: store.query(
+            since=now - random.randint(2, 360) * 86400, until=now -
+            random.randint(0, 1) * 86400, limit=1000),
+        'errors_last_week': lambda i: store.query(
+            since=now - 7 * 86400, status='error', limit=None)}
+    results = {'insert_rows_per_sec': rows / insert,
+               'size_mb': os.path.getsize(path) / 1e6}
+    for name, query in sorted(queries.items()):
+        times = []
+        for i in range(repeat):
+            start = time.time()
+            query(i)
+            times.append(time.time() - start)
+        results[name + '_ms'] = sorted(times)[len(times) // 2] * 1000
+    store.close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--stopped', type=int, default=1000,
+                        help="stopped downloads in aria2's list")
+    parser.add_argument('--incremental', type=int, default=10,
+                        help='downloads stopping between two syncs')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    directory = tempfile.mkdtemp()
+    try:
+        results = bench_sync(os.path.join(directory, 'sync.sqlite'),
+                             args.stopped, args.incremental, args.repeat)
+        results.update(bench_store(os.path.join(directory, 'store.sqlite'),
+                                   args.rows, args.repeat))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    for name, value in sorted(results.items()):
+        print('{:<28} {:>12.2f}'.format(name, value))
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# Watch-folder ingestion against the fake aria2, simulating downloads so
+# they start.  Measures the latency from a file landing in the folder to
+# its download being submitted and active, both for files dropped one at
+# a time and for a burst of --burst files.  Also reports the RPC requests
+# and folder scans the burst took, and whether a slow writer's file is
+# taken whole.
+#
+#   python -m benchmarks.ingest --burst 5000
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+
+from aria2wrapper.rpc import Aria2Client
+from aria2wrapper.ingest import Aria2Ingester
+from benchmarks.fake_aria2 import FakeAria2, start_server
+
+
+def _content(i):
+    kind = ('.txt', '.torrent', '.metalink')[i % 3]
+    if kind == '.txt':
+        return kind, 'http://example.com/file/{}\n'.format(i)
+    if kind == '.torrent':
+        return kind, 'd4:infod4:name{}:{}ee'.format(len(str(i)), i)
+    return kind, '<metalink><file name="{}"/></metalink>'.format(i)
+
+
+def _drop(folder, i, rename):
+    kind, content = _content(i)
+    name = 'drop{}{}'.format(i, kind)
+    # Publishing by rename (IN_MOVED_TO) or plain write (IN_CLOSE_WRITE).
+    path = os.path.join(folder, '.' + name if rename else name)
+    with open(path, 'w') as f:
+        f.write(content)
+    if rename:
+        os.rename(path, os.path.join(folder, name))
+
+
+def _wait(ingester, files, timeout=120):
+    deadline = time.time() + timeout
+    while ingester.files < files and time.time() < deadline:
+        time.sleep(0.01)
+    return ingester.files >= files
+
+
+def _ingester(aria2, client, directory, name, debounce):
+    ingester = Aria2Ingester(client, [os.path.join(directory, name)],
+                             debounce)
+    aria2.listeners.append(ingester.on_event)
+    ingester.start()
+    return ingester, ingester.folders[0].path
+
+
+def run(count, burst, debounce):
+    aria2 = FakeAria2()
+    # Every download starts at the next tick.
+    aria2.options['max-concurrent-downloads'] = str(10 ** 6)
+    server = start_server(aria2)
+    aria2.simulate(1 << 30, 1 << 20)
+    client = Aria2Client(server.server_address[1])
+    directory = tempfile.mkdtemp()
+    results = {}
+    try:
+        ingester, folder = _ingester(aria2, client, directory, 'single',
+                                     debounce)
+        for i in range(count):
+            _drop(folder, i, i % 2)
+            time.sleep(0.05)
+        _wait(ingester, count)
+        time.sleep(0.1)
+        ingester.stop()
+        results['single'] = ingester.stats()
+
+        ingester, folder = _ingester(aria2, client, directory, 'burst',
+                                     debounce)
+        requests = aria2.requests
+        start = time.time()
+        for i in range(burst):
+            _drop(folder, i, i % 2)
+        _wait(ingester, burst)
+        elapsed = time.time() - start
+        time.sleep(0.1)
+        ingester.stop()
+        results['burst'] = dict(ingester.stats(), elapsed=elapsed,
+                                requests=aria2.requests - requests)
+
+        ingester, folder = _ingester(aria2, client, directory, 'slow',
+                                     debounce)
+        lines = int(debounce * 4 / 0.05) + 1
+        with open(os.path.join(folder, 'slow.txt'), 'w') as f:
+            for i in range(lines):
+                f.write('http://example.com/slow/{}\n'.format(i))
+                f.flush()
+                time.sleep(0.05)
+        _wait(ingester, 1)
+        ingester.stop()
+        results['slow'] = dict(ingester.stats(), lines=lines)
+    finally:
+        aria2.shutdown_requested.set()
+        client.close()
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+def _ms(percentiles):
+    if percentiles is None:
+        return '-'
+    return '{:.1f}/{:.1f}'.format(percentiles['p50'] * 1000,
+                                  percentiles['p95'] * 1000)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=30,
+                        help='files dropped one at a time')
+    parser.add_argument('--burst', type=int, default=5000)
+    parser.add_argument('--debounce', type=float, default=0.2)
+    args = parser.parse_args()
+    r = run(args.count, args.burst, args.debounce)
+    print('{:<8} {:>7} {:>10} {:>22} {:>22}'.format(
+        '', 'files', 'downloads', 'drop->submit p50/p95', 'drop->active '
+        'p50/p95'))
+    for name in ('single', 'burst'):
+        print('{:<8} {:>7} {:>10} {:>19} ms {:>19} ms'.format(
+            name, r[name]['files'], r[name]['downloads'],
+            _ms(r[name]['submit_latency']), _ms(r[name]['start_latency'])))
+    print('burst: {} files in {:.2f}s, {} RPC requests, {} folder scans'.
+          format(r['burst']['files'], r['burst']['elapsed'],
+                 r['burst']['requests'], r['burst']['scans']))
+    print('slow writer: {} file(s), {} of {} lines submitted'.format(
+        r['slow']['files'], r['slow']['downloads'], r['slow']['lines']))
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# Cost of one metrics sample (a getGlobalStat + tellActive multicall)
+# against the fake aria2, and the resulting overhead at a given interval.
+#
+#   python -m benchmarks.metrics --active 20 --samples 500
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+
+from aria2wrapper.rpc import Aria2Client
+from aria2wrapper.metrics import Aria2Sampler
+from benchmarks.fake_aria2 import FakeAria2, start_server
+
+
+def run(active, samples, interval):
+    aria2 = FakeAria2()
+    for i in range(active):
+        aria2.add(['http://example.com/{}'.format(i)], status='active')
+    server = start_server(aria2)
+    client = Aria2Client(server.server_address[1])
+    sampler = Aria2Sampler(client, interval, capacity=100)
+    try:
+        start = time.time()
+        for _ in range(samples):
+            sampler.sample_once()
+        per_sample = (time.time() - start) / samples
+        start = time.time()
+        for _ in range(samples):
+            sampler.render_prometheus()
+        per_render = (time.time() - start) / samples
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+    return {'sample_ms': per_sample * 1000,
+            'render_ms': per_render * 1000,
+            'overhead_at_interval': per_sample / interval,
+            'buffered': len(sampler.samples)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--active', type=int, default=20)
+    parser.add_argument('--samples', type=int, default=500)
+    parser.add_argument('--interval', type=float, default=5)
+    args = parser.parse_args()
+    r = run(args.active, args.samples, args.interval)
+    print('sample {:.3f} ms, render {:.3f} ms, overhead at {}s interval '
+          '{:.4%}, {} samples buffered'.format(
+              r['sample_ms'], r['render_ms'], args.interval,
+              r['overhead_at_interval'], r['buffered']))
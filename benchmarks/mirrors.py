@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# Mirror selection against local origins with different throttles: the
+# probe's ranking next to the measured time of a full download from each
+# mirror, concurrent vs one-by-one probing, and re-ranking from live
+# speeds (a mirror slowing down mid-run) through the fake aria2.
+#
+#   python -m benchmarks.mirrors --size 8M
+
+import os
+import sys
+import time
+import argparse
+try:
+    from urllib2 import urlopen
+except ImportError:
+    from urllib.request import urlopen
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+
+from aria2wrapper.rpc import Aria2Client
+from aria2wrapper.files import parse_size
+from aria2wrapper.mirrors import MirrorSelector, host_of
+from benchmarks.fake_aria2 import FakeAria2, start_server
+from benchmarks.origin import OriginConfig, start_origin
+
+# name: (bytes/s per connection, added latency, error rate)
+MIRRORS = [('slow', parse_size('1M'), 0.02, 0),
+           ('far', parse_size('20M'), 0.3, 0),
+           ('medium', parse_size('5M'), 0.02, 0),
+           ('flaky', parse_size('20M'), 0.01, 0.8),
+           ('fast', parse_size('20M'), 0.005, 0)]
+
+
+def _start_mirrors():
+    mirrors = []
+    for name, rate, latency, error_rate in MIRRORS:
+        config = OriginConfig(rate=rate, latency=latency,
+                              error_rate=error_rate)
+        mirrors.append((name, config, start_origin(config)))
+    return mirrors
+
+
+def _uri(server, size):
+    return 'http://127.0.0.1:{}/pub/{}'.format(server.server_address[1],
+                                               size)
+
+
+def _fetch(uri):
+    start = time.time()
+    try:
+        response = urlopen(uri, timeout=60)
+        try:
+            while response.read(1 << 20):
+                pass
+        finally:
+            response.close()
+    except Exception:
+        return None
+    return time.time() - start
+
+
+def bench_ranking(mirrors, size):
+    uris = [_uri(server, size) for _, _, server in mirrors]
+    names = dict((host_of(uri), name)
+                 for uri, (name, _, _) in zip(uris, mirrors))
+    results = {}
+    for workers in (1, len(uris)):
+        selector = MirrorSelector(size_hint=size, workers=workers)
+        start = time.time()
+        ranked = selector.rank(uris)
+        results['probe_ms_{}_workers'.format(workers)] = \
+            (time.time() - start) * 1000
+    results['ranking'] = [names[host_of(uri)] for uri in ranked]
+    results['download_s'] = dict((names[host_of(uri)], _fetch(uri))
+                                 for uri in uris)
+    return results
+
+
+def bench_rerank(mirrors, size):
+    # A download from the fastest mirror reports a crawl; a waiting
+    # download listing it first gets its URIs reordered.
+    aria2 = FakeAria2()
+    server = start_server(aria2)
+    client = Aria2Client(server.server_address[1])
+    try:
+        selector = MirrorSelector(client, size_hint=size)
+        uris = [_uri(s, size) for _, _, s in mirrors]
+        running = aria2.add([selector.rank(uris)[0]])
+        aria2.queue.remove(running)
+        aria2.downloads[running]['status'] = 'active'
+        aria2.downloads[running]['downloadSpeed'] = str(10 << 10)
+        waiting = selector.add(uris)
+        before = aria2.downloads[waiting]['files'][0]['uris'][0]['uri']
+        steps = []
+        changed = []
+        for _ in range(10):
+            start = time.time()
+            changed.extend(selector.step())
+            steps.append(time.time() - start)
+        after = aria2.downloads[waiting]['files'][0]['uris'][0]['uri']
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+    names = dict((host_of(_uri(s, size)), name) for name, _, s in mirrors)
+    return {'first_before': names[host_of(before)],
+            'first_after': names[host_of(after)],
+            'change_uri_calls': len(changed),
+            'step_ms': sum(steps) / len(steps) * 1000}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=parse_size, default=parse_size('8M'))
+    args = parser.parse_args()
+    mirrors = _start_mirrors()
+    try:
+        ranking = bench_ranking(mirrors, args.size)
+        rerank = bench_rerank(mirrors, args.size)
+    finally:
+        for _, _, server in mirrors:
+            server.shutdown()
+            server.server_close()
+    print('ranked: ' + ' > '.join(ranking['ranking']))
+    for name in ranking['ranking']:
+        elapsed = ranking['download_s'][name]
+        print('  {:<8} full download {}'.format(
+            name, '{:.2f}s'.format(elapsed) if elapsed else 'failed'))
+    print('probe: {:.0f} ms one at a time, {:.0f} ms concurrently'.format(
+        ranking['probe_ms_1_workers'],
+        ranking['probe_ms_{}_workers'.format(len(mirrors))]))
+    print('live speeds: first mirror {} -> {} ({} changeUri, '
+          '{:.2f} ms/step)'.format(rerank['first_before'],
+                                   rerank['first_after'],
+                                   rerank['change_uri_calls'],
+                                   rerank['step_ms']))
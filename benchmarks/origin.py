@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# A local HTTP origin serving generated content with per-connection
+# bandwidth, added latency, a connection cap and random error injection.
+# Any path works; the size comes from the last path segment or --size:
+#
+#   python -m benchmarks.origin --port 8080 --rate 1M --max-connections 4
+#   curl -o /dev/null http://127.0.0.1:8080/files/104857600
+
+import os
+import re
+import sys
+import time
+import random
+import socket
+import argparse
+import threading
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+
+from aria2wrapper.files import parse_size
+
+_CHUNK = 16384
+_BLOCK = bytes(bytearray(i % 251 for i in range(_CHUNK)))
+
+
+class Link(object):
+    """A bottleneck shared by origins, carrying ``rate`` bytes/s in all.
+    Past ``connections`` transfers at once the rate is divided by 1 +
+    ``penalty`` per further transfer, as loss and retransmits cut into a
+    congested slow link."""
+
+    def __init__(self, rate, connections=0, penalty=0):
+        self.rate = rate
+        self.connections = connections
+        self.penalty = penalty
+        self.active = 0
+        self.lock = threading.Lock()
+        self._free_at = 0
+
+    def effective_rate(self):
+        over = max(self.active - self.connections, 0) \
+            if self.connections else 0
+        return self.rate / (1 + self.penalty * over)
+
+    def send(self, count):
+        # Books ``count`` bytes of link time and waits for them.
+        with self.lock:
+            now = time.time()
+            self._free_at = max(self._free_at, now) + \
+                count / float(self.effective_rate())
+            delay = self._free_at - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+class OriginConfig(object):
+    def __init__(self, size=100 << 20, rate=0, latency=0, error_rate=0,
+                 max_connections=0, link=None):
+        self.size = size
+        self.rate = rate
+        self.latency = latency
+        self.error_rate = error_rate
+        self.max_connections = max_connections
+        self.link = link
+        self.connections = 0
+        self.bytes_sent = 0
+        self.requests = 0
+        self.errors = 0
+        self.lock = threading.Lock()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def _size(self):
+        segment = self.path.split('?')[0].rstrip('/').rsplit('/', 1)[-1]
+        return int(segment) if segment.isdigit() else self.server.config.size
+
+    def _range(self, size):
+        match = re.match(r'bytes=(\d*)-(\d*)$',
+                         self.headers.get('Range') or '')
+        if not match or not (match.group(1) or match.group(2)):
+            return None
+        if match.group(1):
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else size - 1
+        else:
+            start, end = size - int(match.group(2)), size - 1
+        return start, min(end, size - 1)
+
+    def _fail(self, code):
+        config = self.server.config
+        with config.lock:
+            config.errors += 1
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_HEAD(self):
+        self.do_GET(body=False)
+
+    def do_GET(self, body=True):
+        config = self.server.config
+        with config.lock:
+            config.requests += 1
+            over = config.max_connections and \
+                config.connections >= config.max_connections
+            if not over:
+                config.connections += 1
+        if over:
+            self._fail(503)
+            return
+        try:
+            if config.latency:
+                time.sleep(config.latency)
+            if config.error_rate and random.random() < config.error_rate:
+                self._fail(500)
+                return
+            size = self._size()
+            span = self._range(size)
+            if span is None:
+                start, end = 0, size - 1
+                self.send_response(200)
+            else:
+                start, end = span
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.
+                                 format(start, end, size))
+            self.send_header('Accept-Ranges', 'bytes')
+            # The content only depends on the size.
+            self.send_header('ETag', '"{}"'.format(size))
+            self.send_header('Content-Length', str(end - start + 1))
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.end_headers()
+            if body:
+                try:
+                    self._send_body(end - start + 1)
+                except socket.error:
+                    # The client hung up (a benchmark stopping).
+                    self.close_connection = True
+        finally:
+            with config.lock:
+                config.connections -= 1
+
+    def _send_body(self, remaining):
+        config = self.server.config
+        link = config.link
+        if link is not None:
+            with link.lock:
+                link.active += 1
+        try:
+            self._send_chunks(remaining)
+        finally:
+            if link is not None:
+                with link.lock:
+                    link.active -= 1
+
+    def _send_chunks(self, remaining):
+        config = self.server.config
+        started = time.time()
+        sent = 0
+        while remaining > 0:
+            chunk = min(remaining, _CHUNK)
+            self.wfile.write(_BLOCK[:chunk])
+            remaining -= chunk
+            sent += chunk
+            with config.lock:
+                config.bytes_sent += chunk
+            if config.link is not None:
+                config.link.send(chunk)
+            if config.rate:
+                delay = sent / float(config.rate) - (time.time() - started)
+                if delay > 0:
+                    time.sleep(delay)
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+def start_origin(config, port=0, host='127.0.0.1'):
+    server = _Server((host, port), _Handler)
+    server.config = config
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--size', default='100M')
+    parser.add_argument('--rate', default='0',
+                        help='bytes per second per connection, 0 = no limit')
+    parser.add_argument('--latency', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--max-connections', type=int, default=0)
+    args = parser.parse_args()
+    server = start_origin(OriginConfig(parse_size(args.size),
+                                       parse_size(args.rate), args.latency,
+                                       args.error_rate,
+                                       args.max_connections), args.port)
+    print('origin listening on {}'.format(server.server_address))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
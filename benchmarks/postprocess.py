@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# Post-processing of a batch of finished downloads (hash, unzip, move):
+# one job after another vs the PostProcessor pipeline, with its per-stage
+# throughput and queue depths.
+#
+#   python -m benchmarks.postprocess --files 200 --size 4M --processes 4
+
+import os
+import sys
+import time
+import shutil
+import zipfile
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+
+from aria2wrapper.postprocess import PostProcessor, STAGES
+from benchmarks.origin import parse_size
+
+
+def generate(download_dir, files, size, archives):
+    jobs = []
+    block = os.urandom(min(size, 1 << 20))
+    for i in range(files):
+        path = os.path.join(download_dir, 'file{}.bin'.format(i))
+        with open(path, 'wb') as f:
+            for offset in range(0, size, len(block)):
+                f.write(block[:size - offset])
+        if i < archives:
+            archive = path[:-4] + '.zip'
+            with zipfile.ZipFile(archive, 'w') as z:
+                z.write(path, os.path.basename(path))
+            os.remove(path)
+            path = archive
+        jobs.append({'gid': str(i), 'dir': download_dir, 'files': [path],
+                     'bytes': os.path.getsize(path)})
+    return jobs
+
+
+def _stages(target):
+    return [('hash', STAGES['hash'], {}),
+            ('extract', STAGES['extract'], {'remove': True}),
+            ('move', STAGES['move'], {'target': target})]
+
+
+def run_serial(jobs, target):
+    start = time.time()
+    for job in jobs:
+        for _, function, kwargs in _stages(target):
+            job = function(job, **kwargs)
+    return time.time() - start, None
+
+
+def run_pipeline(jobs, target, processes):
+    done = threading.Semaphore(0)
+    processor = PostProcessor(_stages(target), processes,
+                              on_done=lambda job: done.release(),
+                              on_error=lambda job, stage, e: done.release())
+    processor.start()
+    start = time.time()
+    for job in jobs:
+        processor.submit(job)
+    for _ in jobs:
+        done.acquire()
+    elapsed = time.time() - start
+    stats = processor.stats()
+    processor.stop()
+    return elapsed, stats
+
+
+def run(files, size, archives, processes):
+    results = {}
+    for name, runner in (('serial', run_serial),
+                         ('pipeline', lambda jobs, target:
+                          run_pipeline(jobs, target, processes))):
+        work_dir = tempfile.mkdtemp()
+        try:
+            download_dir = os.path.join(work_dir, 'downloads')
+            os.mkdir(download_dir)
+            jobs = generate(download_dir, files, size, archives)
+            results[name] = runner(jobs, os.path.join(work_dir, 'sorted'))
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=200)
+    parser.add_argument('--size', default='4M')
+    parser.add_argument('--archives', type=int, default=50,
+                        help='how many of the files are zip archives')
+    parser.add_argument('--processes', type=int)
+    args = parser.parse_args()
+    results = run(args.files, parse_size(args.size), args.archives,
+                  args.processes)
+    for name in ('serial', 'pipeline'):
+        elapsed, _ = results[name]
+        print('{:<9} {:>8.2f}s {:>9.1f} files/s'.format(
+            name, elapsed, args.files / elapsed))
+    print('{:<9} {:>9} {:>9} {:>9} {:>10}'.format(
+        'stage', 'files/s', 'MB/s', 'failed', 'max queue'))
+    for name in ('hash', 'extract', 'move'):
+        stats = results['pipeline'][1][name]
+        print('{:<9} {:>9.1f} {:>9.1f} {:>9} {:>10}'.format(
+            name, stats['files_per_sec'], stats['bytes_per_sec'] / 1e6,
+            stats['failed'], stats['max_queue_depth']))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# Cost of finding the aria2c child: full process table scan vs the
+# Popen handle vs the pid file, for a growing number of processes.
+#
+#   python -m benchmarks.process_detection --sizes 0,500,2000
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+
+from aria2wrapper.process import Aria2ProcessTracker, scan_aria2_process
+
+
+def _find_sleep():
+    for path in ('/bin/sleep', '/usr/bin/sleep'):
+        if os.path.exists(path):
+            return path
+    raise RuntimeError('no sleep binary found')
+
+
+def _time_per_call(func, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        func()
+    return (time.time() - start) / repeat
+
+
+def run(sizes, repeat):
+    work_dir = tempfile.mkdtemp()
+    fake_bin = os.path.join(work_dir, 'aria2c')
+    os.symlink(_find_sleep(), fake_bin)
+    pid_path = os.path.join(work_dir, 'aria2.pid')
+    fillers = []
+    results = []
+    try:
+        for size in sizes:
+            while len(fillers) < size:
+                fillers.append(subprocess.Popen([_find_sleep(), '600']))
+            aria2 = subprocess.Popen([fake_bin, '600'])
+            attached = Aria2ProcessTracker(fake_bin, pid_path)
+            attached.attach(aria2)
+            from_pid_file = Aria2ProcessTracker(fake_bin, pid_path)
+            assert scan_aria2_process(fake_bin).pid == aria2.pid
+            assert from_pid_file.get_process().pid == aria2.pid
+            results.append((size,
+                            _time_per_call(lambda: scan_aria2_process(
+                                fake_bin), repeat),
+                            _time_per_call(attached.get_process, repeat),
+                            _time_per_call(lambda: Aria2ProcessTracker(
+                                fake_bin, pid_path).get_process(), repeat)))
+            aria2.kill()
+            aria2.wait()
+            attached.clear()
+    finally:
+        for filler in fillers:
+            filler.kill()
+            filler.wait()
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='0,250,1000,2000')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+    print('{:>8} {:>12} {:>12} {:>12}'.format('extra', 'scan ms',
+                                              'popen ms', 'pidfile ms'))
+    for size, scan, popen, pid_file in run(sizes, args.repeat):
+        print('{:>8} {:>12.3f} {:>12.3f} {:>12.3f}'.format(
+            size, scan * 1000, popen * 1000, pid_file * 1000))
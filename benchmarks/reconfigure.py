@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# Interruption caused by a preference change: the live changeGlobalOption
+# path vs the save-session-then-restart path, against the fake aria2.
+#
+#   python -m benchmarks.reconfigure --active 50
+
+import os
+import sys
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+
+from aria2wrapper.rpc import Aria2Client
+from aria2wrapper.reconfigure import apply_settings
+from benchmarks.fake_aria2 import FakeAria2, start_server
+
+
+def _fake_with_active(active):
+    aria2 = FakeAria2()
+    for i in range(active):
+        aria2.add(['http://example.com/{}'.format(i)], status='active')
+    return aria2
+
+
+def run(active):
+    old = {'dir': '/tmp/a', 'rpc-port': None}
+    results = {}
+
+    server = start_server(_fake_with_active(active))
+    client = Aria2Client(server.server_address[1])
+    try:
+        report = apply_settings(client, old,
+                                dict(old, **{'dir': '/tmp/b',
+                                             'max-concurrent-downloads': 8}),
+                                restart=None)
+        results['live'] = {'interruption_ms': report['interruption'] * 1000,
+                           'interrupted': len(report['dropped'])}
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+
+    servers = [start_server(_fake_with_active(active))]
+    port = servers[0].server_address[1]
+    client = Aria2Client(port)
+
+    def restart():
+        servers[0].shutdown()
+        servers[0].server_close()
+        # aria2c re-reads the session: every transfer starts over.
+        servers[0] = start_server(_fake_with_active(active), port)
+    try:
+        report = apply_settings(client, old,
+                                dict(old, **{'rpc-secret': 'new'}),
+                                restart)
+        results['restart'] = {'interruption_ms':
+                              report['interruption'] * 1000,
+                              'interrupted': active}
+    finally:
+        client.close()
+        servers[0].shutdown()
+        servers[0].server_close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--active', type=int, default=50)
+    args = parser.parse_args()
+    results = run(args.active)
+    print('{:<8} {:>16} {:>12}'.format('path', 'interruption ms',
+                                       'interrupted'))
+    for name in ('live', 'restart'):
+        print('{:<8} {:>16.2f} {:>12}'.format(
+            name, results[name]['interruption_ms'],
+            results[name]['interrupted']))
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# RPC throughput/latency against the fake aria2: one connection per call
+# vs the pooled client vs the pooled client with multicall coalescing.
+#
+#   python -m benchmarks.rpc_throughput --threads 16 --calls 200
+
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+try:
+    import httplib
+except ImportError:
+    import http.client as httplib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+
+from aria2wrapper.rpc import Aria2Client
+from benchmarks.fake_aria2 import FakeAria2, start_server
+
+
+class _OneShotClient(object):
+    def __init__(self, port, rpc_secret):
+        self.port = port
+        self.rpc_secret = rpc_secret
+
+    def call(self, method, *params):
+        connection = httplib.HTTPConnection('127.0.0.1', self.port)
+        try:
+            connection.request('POST', '/jsonrpc', json.dumps({
+                'jsonrpc': '2.0', 'id': 0, 'method': method,
+                'params': ['token:' + self.rpc_secret] + list(params)}))
+            return json.loads(connection.getresponse().read().
+                              decode('utf-8'))['result']
+        finally:
+            connection.close()
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_mode(client, threads, calls):
+    latencies = []
+    lock = threading.Lock()
+
+    def worker():
+        local = []
+        for i in range(calls // 2):
+            start = time.time()
+            gid = client.call('aria2.addUri', ['http://example.com/{}'.
+                                               format(i)])
+            local.append(time.time() - start)
+            start = time.time()
+            client.call('aria2.tellStatus', gid, ['status'])
+            local.append(time.time() - start)
+        with lock:
+            latencies.extend(local)
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.time()
+    for worker_thread in workers:
+        worker_thread.start()
+    for worker_thread in workers:
+        worker_thread.join()
+    elapsed = time.time() - start
+    return {'calls_per_sec': len(latencies) / elapsed,
+            'p50_ms': _percentile(latencies, 0.5) * 1000,
+            'p99_ms': _percentile(latencies, 0.99) * 1000}
+
+
+def run(threads, calls, latency):
+    results = {}
+    secret = 'bench'
+    modes = [('one-shot', lambda port: _OneShotClient(port, secret)),
+             ('pooled', lambda port: Aria2Client(port, secret,
+                                                 max_batch=1)),
+             ('pooled+multicall', lambda port: Aria2Client(port, secret))]
+    for name, make_client in modes:
+        aria2 = FakeAria2(secret, latency)
+        server = start_server(aria2)
+        client = make_client(server.server_address[1])
+        try:
+            results[name] = run_mode(client, threads, calls)
+            results[name]['http_requests'] = aria2.requests
+        finally:
+            if hasattr(client, 'close'):
+                client.close()
+            server.shutdown()
+            server.server_close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--calls', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.001,
+                        help='simulated server time per HTTP request (s)')
+    args = parser.parse_args()
+    results = run(args.threads, args.calls, args.latency)
+    print('{:<18} {:>10} {:>9} {:>9} {:>9}'.format(
+        'mode', 'calls/s', 'p50 ms', 'p99 ms', 'requests'))
+    for name in ('one-shot', 'pooled', 'pooled+multicall'):
+        r = results[name]
+        print('{:<18} {:>10.0f} {:>9.2f} {:>9.2f} {:>9}'.format(
+            name, r['calls_per_sec'], r['p50_ms'], r['p99_ms'],
+            r['http_requests']))
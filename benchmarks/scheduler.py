@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# Queue latency of urgent downloads submitted behind a long bulk backlog:
+# aria2's FIFO queue vs Aria2Scheduler, against the fake aria2 simulating
+# the transfers.  Also times one scheduler step as the backlog grows.
+#
+#   python -m benchmarks.scheduler --bulk 10000 --duration 10
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+
+from aria2wrapper.rpc import Aria2Client
+from aria2wrapper.enqueue import enqueue
+from aria2wrapper.scheduler import Aria2Scheduler
+from benchmarks.fake_aria2 import FakeAria2, start_server
+from benchmarks.origin import parse_size
+
+
+def _entries(count, priority=None):
+    for i in range(count):
+        uri = 'http://example.com/{}/{}'.format(priority or 'bulk', i)
+        yield ([uri], {'priority': priority}) if priority else uri
+
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def run_latency(mode, bulk, urgent, rate, size, duration, interval):
+    aria2 = FakeAria2()
+    server = start_server(aria2)
+    client = Aria2Client(server.server_address[1])
+    scheduler = None
+    try:
+        if mode == 'scheduler':
+            scheduler = Aria2Scheduler(client, interval=interval,
+                                       limits={'bulk': '1K'})
+            scheduler.enqueue(_entries(bulk, 'bulk'))
+            scheduler.start()
+        else:
+            enqueue(client, _entries(bulk))
+        aria2.simulate(rate, size)
+        gids = []
+        start = time.time()
+        for i in range(urgent):
+            time.sleep(max(0, start + duration * i / urgent - time.time()))
+            uri = 'http://example.com/urgent/{}'.format(i)
+            if scheduler is not None:
+                gids.append(scheduler.add([uri], priority='urgent'))
+            else:
+                gids.append(client.addUri([uri]))
+        time.sleep(max(0, start + duration - time.time()))
+    finally:
+        if scheduler is not None:
+            scheduler.stop()
+        aria2.shutdown_requested.set()
+        client.close()
+        server.shutdown()
+        server.server_close()
+    latencies = [aria2.downloads[gid]['startedAt'] -
+                 aria2.downloads[gid]['addedAt']
+                 for gid in gids if 'startedAt' in aria2.downloads[gid]]
+    result = {'urgent_started': len(latencies), 'urgent': urgent,
+              'bulk_completed': sum(
+                  1 for d in aria2.downloads.values()
+                  if d['status'] == 'complete' and
+                  '/bulk/' in d['files'][0]['uris'][0]['uri'])}
+    if latencies:
+        result['latency_p50_ms'] = _percentile(latencies, 0.5) * 1000
+        result['latency_p95_ms'] = _percentile(latencies, 0.95) * 1000
+    return result
+
+
+def run_step(queued, repeat):
+    aria2 = FakeAria2()
+    server = start_server(aria2)
+    client = Aria2Client(server.server_address[1])
+    try:
+        scheduler = Aria2Scheduler(client)
+        scheduler.enqueue(_entries(queued, 'bulk'))
+        scheduler.step()
+        # Each round, one new urgent download has to reach the front.
+        elapsed = 0
+        for i in range(repeat):
+            scheduler.add(['http://example.com/urgent/{}'.format(i)],
+                          priority='urgent')
+            start = time.time()
+            scheduler.step()
+            elapsed += time.time() - start
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
+    return {'step_ms': elapsed / repeat * 1000}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bulk', type=int, default=10000)
+    parser.add_argument('--urgent', type=int, default=10)
+    parser.add_argument('--rate', type=parse_size, default=parse_size('50M'))
+    parser.add_argument('--size', type=parse_size, default=parse_size('20M'))
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--interval', type=float, default=0.25)
+    parser.add_argument('--repeat', type=int, default=50)
+    args = parser.parse_args()
+    print('{:<10} {:>9} {:>12} {:>12} {:>10}'.format(
+        'mode', 'started', 'p50 ms', 'p95 ms', 'bulk done'))
+    for mode in ('fifo', 'scheduler'):
+        r = run_latency(mode, args.bulk, args.urgent, args.rate, args.size,
+                        args.duration, args.interval)
+        print('{:<10} {:>4}/{:<4} {:>12} {:>12} {:>10}'.format(
+            mode, r['urgent_started'], r['urgent'],
+            '{:.1f}'.format(r['latency_p50_ms'])
+            if 'latency_p50_ms' in r else '-',
+            '{:.1f}'.format(r['latency_p95_ms'])
+            if 'latency_p95_ms' in r else '-', r['bulk_completed']))
+    print('')
+    for queued in (100, args.bulk, args.bulk * 10):
+        r = run_step(queued, args.repeat)
+        print('step with {:>7} queued: {:.2f} ms'.format(
+            queued, r['step_ms']))
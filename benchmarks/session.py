@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# Session compaction on a generated, bloated aria2.session (duplicates and
+# finished downloads), and with --aria2c the daemon's startup time on the
+# original vs the compacted session.
+#
+#   python -m benchmarks.session --entries 50000
+#   python -m benchmarks.session --entries 50000 --aria2c /usr/bin/aria2c
+
+import os
+import sys
+import time
+import shutil
+import socket
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+
+from aria2wrapper.rpc import Aria2Client
+from aria2wrapper.session import compact_session, write_entry
+
+
+FINISHED_SIZE = 16
+
+
+def generate(path, download_dir, entries, duplicates=0.5, completed=0.2):
+    # Returns the gids of the finished downloads, files of FINISHED_SIZE.
+    unique = int(entries * (1 - duplicates))
+    finished = int(unique * completed)
+    with open(path, 'w') as f:
+        for i in range(entries):
+            n = i % unique
+            name = 'file{}.bin'.format(n)
+            if n < finished and i < unique:
+                with open(os.path.join(download_dir, name), 'wb') as out:
+                    out.write(b'x' * FINISHED_SIZE)
+            write_entry(f, ['http://127.0.0.1:9/' + name],
+                        {'gid': '{:016x}'.format(n + 1),
+                         'dir': download_dir, 'pause': 'true'})
+    return set('{:016x}'.format(n + 1) for n in range(finished))
+
+
+def _startup_time(aria2c, session, download_dir):
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    start = time.time()
+    process = subprocess.Popen([aria2c, '--enable-rpc', '--quiet=true',
+                                '--rpc-listen-port={}'.format(port),
+                                '--dir={}'.format(download_dir),
+                                '--input-file={}'.format(session)],
+                               close_fds=True)
+    client = Aria2Client(port, timeout=60)
+    try:
+        while True:
+            try:
+                client.getGlobalStat()
+                return time.time() - start
+            except Exception:
+                time.sleep(0.01)
+    finally:
+        try:
+            client.forceShutdown()
+        except Exception:
+            pass
+        client.close()
+        process.wait()
+
+
+def run(entries, aria2c=None, max_entries=None):
+    work_dir = tempfile.mkdtemp()
+    try:
+        session = os.path.join(work_dir, 'aria2.session')
+        finished = generate(session, work_dir, entries)
+        results = {}
+        if aria2c:
+            results['startup_before'] = _startup_time(aria2c, session,
+                                                      work_dir)
+        report = compact_session(
+            session, work_dir, max_entries,
+            lambda gid: FINISHED_SIZE if gid in finished else None)
+        results['compaction'] = vars(report)
+        if aria2c:
+            results['startup_after'] = _startup_time(aria2c, session,
+                                                     work_dir)
+        return results
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=50000)
+    parser.add_argument('--max-entries', type=int)
+    parser.add_argument('--aria2c')
+    args = parser.parse_args()
+    results = run(args.entries, args.aria2c, args.max_entries)
+    report = results['compaction']
+    print('compacted {entries_in} -> {entries_out} entries '
+          '({pending} pending, {duplicates} duplicates, {completed} '
+          'complete), {bytes_in} -> {bytes_out} bytes in '
+          '{elapsed:.3f}s'.format(**report))
+    if 'startup_before' in results:
+        print('aria2c startup {:.3f}s -> {:.3f}s'.format(
+            results['startup_before'], results['startup_after']))
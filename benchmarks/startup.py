@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# Wall time and peak RSS for each main.py mode up to the point where it
+# has imported everything it needs (ARIA2_WRAPPER_STARTUP_PROBE makes the
+# mode exit there, before touching aria2c or opening windows).
+#
+#   python -m benchmarks.startup --repeat 10
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+MODES = [('interpreter', None),
+         ('tray', []),
+         ('preferences', ['preferences']),
+         ('enqueue', ['enqueue', os.devnull]),
+         ('cluster', ['cluster', 'status']),
+         ('daemon', ['daemon'])]
+
+
+def _maxrss_kib(rusage):
+    # ru_maxrss is in bytes on macOS and KiB elsewhere.
+    if sys.platform == 'darwin':
+        return rusage.ru_maxrss // 1024
+    return rusage.ru_maxrss
+
+
+def measure(python, args, repeat):
+    home = tempfile.mkdtemp()
+    env = dict(os.environ, ARIA2_WRAPPER_STARTUP_PROBE='1', HOME=home,
+               XDG_CONFIG_HOME=home)
+    command = [python, '-c', 'pass'] if args is None else \
+        [python, os.path.join(ROOT, 'main.py')] + args
+    times, rss = [], []
+    try:
+        for _ in range(repeat):
+            start = time.time()
+            process = subprocess.Popen(command, env=env, cwd=ROOT,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+            _, status, rusage = os.wait4(process.pid, 0)
+            times.append(time.time() - start)
+            process.returncode = status
+            process.communicate()
+            if status != 0:
+                return None
+            rss.append(_maxrss_kib(rusage))
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+    times.sort()
+    return {'median_ms': times[len(times) // 2] * 1000,
+            'max_rss_kib': max(rss)}
+
+
+def run(python, repeat):
+    return dict((name, measure(python, args, repeat))
+                for name, args in MODES)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--python', default=sys.executable)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+    results = run(args.python, args.repeat)
+    print('{:<12} {:>10} {:>12}'.format('mode', 'median ms', 'max RSS KiB'))
+    for name, _ in MODES:
+        r = results[name]
+        if r is None:
+            print('{:<12} {:>23}'.format(name, 'failed (missing deps?)'))
+        else:
+            print('{:<12} {:>10.1f} {:>12}'.format(name, r['median_ms'],
+                                                   r['max_rss_kib']))
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# The wrapper's hot paths, offline: process detection, aria2c start/stop/
+# restart through main.py's own helpers (with benchmarks/bin/aria2c unless
+# --aria2c is given), settings load/save and RPC throughput.  Results are
+# written as JSON so runs on different commits can be compared.
+#
+#   python -m benchmarks.suite --output before.json
+#   python -m benchmarks.suite --compare before.json --threshold 0.2
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import tempfile
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+from aria2wrapper.process import scan_aria2_process
+from aria2wrapper.settings import SettingsStore
+from benchmarks import rpc_throughput
+
+SCENARIOS = ('process_detection', 'lifecycle', 'settings', 'rpc')
+
+# Differences below this are timer noise, whatever the percentage.
+NOISE_MS = 0.05
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def _ms_per_call(func, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        func()
+    return (time.time() - start) / repeat * 1000
+
+
+def _free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class _Wrapper(object):
+    # main.py's helpers, pointed at a scratch config dir and aria2c.
+
+    def __init__(self, aria2c, home):
+        os.environ['HOME'] = os.environ['XDG_CONFIG_HOME'] = home
+        import main
+        main._get_aria2_bin = lambda: aria2c
+        self.main = main
+        self.aria2c = aria2c
+        self.port = _free_port()
+        self.output_dir = os.path.join(home, 'downloads')
+        os.mkdir(self.output_dir)
+
+    def start(self):
+        # Returns once the RPC port answers.
+        return self.main._change_aria2_state(True, self.output_dir, None,
+                                             self.port)
+
+    def stop(self):
+        self.main._terminate_aria2_process(self.aria2c)
+
+
+def _timed(func):
+    start = time.time()
+    func()
+    return (time.time() - start) * 1000
+
+
+def bench_lifecycle(wrapper, repeat):
+    start, ready, restart, stop = [], [], [], []
+    for _ in range(repeat):
+        handle = []
+        start.append(_timed(lambda: handle.append(wrapper.start())))
+        ready.append(handle[0].ready_latency * 1000)
+        restart.append(_timed(wrapper.start))
+        stop.append(_timed(wrapper.stop))
+    return {'start_ms': _median(start), 'spawn_to_ready_ms': _median(ready),
+            'restart_ms': _median(restart), 'stop_ms': _median(stop)}
+
+
+def bench_process_detection(wrapper, repeat):
+    main = wrapper.main
+    wrapper.start()
+    try:
+        attached = _ms_per_call(
+            lambda: main._get_aria2_process(wrapper.aria2c), repeat)
+
+        def from_pid_file():
+            main._aria2_trackers.clear()
+            main._get_aria2_process(wrapper.aria2c)
+        pid_file = _ms_per_call(from_pid_file, repeat)
+        scan = _ms_per_call(lambda: scan_aria2_process(wrapper.aria2c),
+                            max(1, repeat // 10))
+    finally:
+        wrapper.stop()
+    return {'attached_ms': attached, 'pid_file_ms': pid_file,
+            'scan_ms': scan}
+
+
+def bench_settings(home, repeat):
+    path = os.path.join(home, 'settings-bench.json')
+    settings = {'dir': home, 'rpc-port': 6800, 'rpc-secret': 'secret',
+                'max-concurrent-downloads': '5'}
+    store = SettingsStore(path)
+    save = _ms_per_call(lambda: store.save(settings), repeat)
+    cached = _ms_per_call(store.load, repeat)
+    cold = _ms_per_call(lambda: SettingsStore(path).load(), repeat)
+    store.close()
+    return {'save_ms': save, 'load_cached_ms': cached,
+            'load_cold_ms': cold}
+
+
+def bench_rpc(threads, calls):
+    results = {}
+    for mode, result in rpc_throughput.run(threads, calls, 0).items():
+        for name, value in result.items():
+            results['{}.{}'.format(mode, name)] = value
+    return results
+
+
+def _git_commit():
+    with open(os.devnull, 'w') as devnull:
+        try:
+            return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                stderr=devnull).decode('ascii').strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+
+def run(scenarios, aria2c, repeat):
+    home = tempfile.mkdtemp()
+    results = {}
+    try:
+        wrapper = _Wrapper(aria2c, home)
+        if 'process_detection' in scenarios:
+            results['process_detection'] = bench_process_detection(
+                wrapper, repeat * 10)
+        if 'lifecycle' in scenarios:
+            results['lifecycle'] = bench_lifecycle(wrapper, repeat)
+        if 'settings' in scenarios:
+            results['settings'] = bench_settings(home, repeat * 10)
+        if 'rpc' in scenarios:
+            results['rpc'] = bench_rpc(8, repeat * 20)
+    finally:
+        shutil.rmtree(home, ignore_errors=True)
+    return {'commit': _git_commit(), 'time': time.time(),
+            'python': platform.python_version(),
+            'platform': sys.platform, 'results': results}
+
+
+def compare(baseline, current, threshold):
+    """Prints each metric against the baseline; returns the regressions
+    beyond ``threshold`` (a fraction)."""
+    regressions = []
+    print('{:<44} {:>12} {:>12} {:>8}'.format(
+        'metric', 'baseline', 'current', 'change'))
+    for scenario, metrics in sorted(current['results'].items()):
+        for name, value in sorted(metrics.items()):
+            old = baseline['results'].get(scenario, {}).get(name)
+            metric = '{}.{}'.format(scenario, name)
+            if not old or not name.endswith(('_ms', '_per_sec')):
+                continue
+            change = (value - old) / float(old)
+            worse = -change if name.endswith('_per_sec') else change
+            if name.endswith('_ms') and abs(value - old) < NOISE_MS:
+                worse = 0
+            print('{:<44} {:>12.3f} {:>12.3f} {:>+7.1f}%{}'.format(
+                metric, old, value, change * 100,
+                ' !' if worse > threshold else ''))
+            if worse > threshold:
+                regressions.append(metric)
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS))
+    parser.add_argument('--aria2c',
+                        default=os.path.join(ROOT, 'benchmarks', 'bin',
+                                             'aria2c'))
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--output', help='write the results to this file')
+    parser.add_argument('--compare', help='results of an earlier run')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='exit 1 if a metric got worse by more than '
+                             'this fraction')
+    args = parser.parse_args()
+    report = run(args.scenarios.split(','),
+                 os.path.realpath(args.aria2c), args.repeat)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), report, args.threshold)
+        if regressions:
+            sys.exit(1)
+    elif not args.output:
+        print(json.dumps(report, indent=2, sort_keys=True))
@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# coding=utf-8
+
+# Cost of the tracing layer.  Measures a call through ``traced`` and a
+# ``with span()`` block with tracing off and on, against a plain call.
+# Also measures how much a CPU-bound loop slows down under the sampling
+# profiler with --threads idle threads around (the tray has a dozen), and
+# the time to export a full ring.
+#
+#   python -m benchmarks.trace --threads 12
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(
+    os.path.realpath(__file__))))
+
+from aria2wrapper import trace
+
+
+def _plain():
+    return None
+
+
+@trace.traced('bench')
+def _traced():
+    return None
+
+
+def _spanned():
+    with trace.span('bench'):
+        return None
+
+
+def _ns_per_call(func, repeat):
+    start = time.time()
+    for _ in range(repeat):
+        func()
+    return (time.time() - start) / repeat * 1e9
+
+
+def bench_spans(repeat):
+    results = {'plain': _ns_per_call(_plain, repeat)}
+    trace.disable()
+    results['traced_off'] = _ns_per_call(_traced, repeat)
+    results['span_off'] = _ns_per_call(_spanned, repeat)
+    trace.enable()
+    results['traced_on'] = _ns_per_call(_traced, repeat)
+    results['span_on'] = _ns_per_call(_spanned, repeat)
+    trace.disable()
+    return results
+
+
+def _work(n):
+    total = 0
+    for i in range(n):
+        total += i * i
+    return total
+
+
+def _idle_threads(count, stop):
+    def idle(depth):
+        # A few frames deep, like a thread blocked in a library.
+        if depth:
+            return idle(depth - 1)
+        stop.wait()
+    threads = [threading.Thread(target=idle, args=(10,))
+               for _ in range(count)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    return threads
+
+
+def bench_profiler(threads, n, intervals):
+    stop = threading.Event()
+    _idle_threads(threads, stop)
+    try:
+        start = time.time()
+        _work(n)
+        base = time.time() - start
+        results = {'work_s': base}
+        for interval in intervals:
+            profiler = trace.SamplingProfiler(interval)
+            profiler.start()
+            start = time.time()
+            _work(n)
+            elapsed = time.time() - start
+            profiler.stop()
+            main = [thread for thread in profiler.summary(1, 1)['threads']
+                    if thread['thread'] == 'MainThread'][0]
+            results[interval] = {
+                'slowdown': elapsed / base - 1,
+                'passes': profiler.passes,
+                'sample_us': profiler.sample_time /
+                max(profiler.passes, 1) * 1e6,
+                'top': main['stacks'][0]['frames'][-1]}
+    finally:
+        stop.set()
+    return results
+
+
+def bench_export(size):
+    trace.enable(size)
+    for _ in range(size):
+        _traced()
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'trace.json')
+        start = time.time()
+        trace.write_trace(path)
+        elapsed = time.time() - start
+        size_mb = os.path.getsize(path) / 1e6
+    finally:
+        trace.disable()
+        shutil.rmtree(directory, ignore_errors=True)
+    return elapsed * 1000, size_mb
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=1000000)
+    parser.add_argument('--threads', type=int, default=12)
+    parser.add_argument('--work', type=int, default=20000000)
+    parser.add_argument('--ring', type=int, default=10000)
+    args = parser.parse_args()
+    spans = bench_spans(args.repeat)
+    print('per call (ns): plain {plain:.0f}, traced off {traced_off:.0f} '
+          'on {traced_on:.0f}, span off {span_off:.0f} on {span_on:.0f}'.
+          format(**spans))
+    profiled = bench_profiler(args.threads, args.work, (0.005, 0.001))
+    print('work loop: {:.2f}s unprofiled, {} idle threads'.format(
+        profiled['work_s'], args.threads))
+    for interval in (0.005, 0.001):
+        r = profiled[interval]
+        print('  every {:.0f} ms: {:+.1f}% slower, {} samples, '
+              '{:.0f} us/sample, main thread in {}'.format(
+                  interval * 1000, r['slowdown'] * 100, r['passes'],
+                  r['sample_us'], r['top']))
+    elapsed_ms, size_mb = bench_export(args.ring)
+    print('export of {} spans: {:.0f} ms, {:.1f} MB'.format(
+        args.ring, elapsed_ms, size_mb))
@@ -1,14 +1,22 @@
 #!/usr/bin/env python
 # coding=utf-8
 
+# Each mode (tray, preferences, CLI subcommands) imports what it needs
+# inside the functions that use it, so no launch pays for the GUI stack,
+# psutil or the RPC machinery unless that mode uses them.
 import os
 import sys
-import subprocess
 import json
-import Tkinter as tk
-import tkFileDialog as filedialog
-from PIL import Image, ImageTk
-import psutil
+import threading
+import subprocess
+
+from aria2wrapper.trace import span, traced
+
+
+def _startup_probe():
+    # benchmarks/startup.py: exit once a mode has done its imports.
+    if os.environ.get('ARIA2_WRAPPER_STARTUP_PROBE'):
+        sys.exit(0)
 
 
 def _is_windows_x64():
@@ -23,11 +31,19 @@ def _get_aria2_bin():
             platform = 'win64'
     else:
         basis = __file__
-    return os.path.realpath(os.path.join(os.path.dirname(basis), 'aria2',
-                                         platform,
-                                         'aria2c' +
-                                         ('.exe'
-                                          if sys.platform == 'win32' else '')))
+    aria2_bin = os.path.realpath(os.path.join(os.path.dirname(basis), 'aria2',
+                                              platform,
+                                              'aria2c' +
+                                              ('.exe'
+                                               if sys.platform == 'win32'
+                                               else '')))
+    if not os.path.exists(aria2_bin) and not hasattr(sys, 'frozen'):
+        # No bundled binary for this platform (e.g. Linux): use the
+        # system's aria2c.
+        for path in os.environ.get('PATH', '').split(os.pathsep):
+            if os.access(os.path.join(path, 'aria2c'), os.X_OK):
+                return os.path.realpath(os.path.join(path, 'aria2c'))
+    return aria2_bin
 
 
 def _get_image(name):
@@ -48,6 +64,7 @@ def _get_app_path():
     return __file__
 
 
+@traced('registry-as-startup')
 def _registry_as_startup(app_path):
     if not hasattr(sys, 'frozen'):
         raise NotImplementedError()
@@ -76,6 +93,7 @@ def _registry_as_startup(app_path):
         raise NotImplementedError()
 
 
+@traced('remove-startup')
 def _remove_startup(app_path):
     if not hasattr(sys, 'frozen'):
         raise NotImplementedError()
@@ -98,6 +116,7 @@ def _remove_startup(app_path):
         raise NotImplementedError()
 
 
+@traced('is-in-startup')
 def _is_in_startup(app_path):
     app_name, _ = os.path.splitext(os.path.basename(app_path))
     if sys.platform == 'win32':
@@ -121,20 +140,51 @@ def _is_in_startup(app_path):
         raise NotImplementedError()
 
 
+_aria2_trackers = {}
+
+# aria2c reads this many session entries itself at startup; the rest are
+# added over RPC once it is up.
+_SESSION_STARTUP_ENTRIES = 1000
+
+
+def _get_aria2_tracker(aria2_bin):
+    tracker = _aria2_trackers.get(aria2_bin)
+    if tracker is None:
+        from aria2wrapper.process import Aria2ProcessTracker
+        tracker = Aria2ProcessTracker(aria2_bin,
+                                      _get_config_path('aria2.pid'),
+                                      exclude=_get_cluster_pids)
+        _aria2_trackers[aria2_bin] = tracker
+    return tracker
+
+
+def _get_cluster_pids():
+    # The cluster's aria2c (aria2-<index>.pid) run the same binary; the
+    # main tracker must not adopt one of them and shut it down.
+    import glob
+    from aria2wrapper.process import recorded_pids
+    return recorded_pids(glob.glob(_get_config_path('aria2-*.pid')))
+
+
+@traced('get-aria2-process')
 def _get_aria2_process(aria2_bin):
-    for process in psutil.process_iter():
-        try:
-            if aria2_bin in process.cmdline()[0]:
-                return process
-        except Exception:
-            pass
-    return None
+    return _get_aria2_tracker(aria2_bin).get_process()
 
 
+@traced('terminate-aria2c')
 def _terminate_aria2_process(aria2_bin, wait=True):
-    running_process = _get_aria2_process(aria2_bin)
-    if running_process:
-        running_process.terminate()
+    from aria2wrapper.rpc import Aria2Client
+    from aria2wrapper.process import shutdown_aria2
+    tracker = _get_aria2_tracker(aria2_bin)
+    if tracker.get_process() is None:
+        tracker.clear()
+        return []
+    client = Aria2Client.from_settings(tracker.rpc_settings or
+                                       _load_setting(), timeout=5)
+    try:
+        return shutdown_aria2(tracker, client, wait)
+    finally:
+        client.close()
 
 
 def _get_config_path(config_name):
@@ -143,6 +193,11 @@ def _get_config_path(config_name):
                                     'configs')
     elif sys.platform == 'darwin':
         configs_path = os.path.join(os.path.expanduser('~'), '.aria2-wrapper')
+    elif sys.platform.startswith('linux'):
+        configs_path = os.path.join(os.environ.get('XDG_CONFIG_HOME') or
+                                    os.path.join(os.path.expanduser('~'),
+                                                 '.config'),
+                                    'aria2-wrapper')
     else:
         raise NotImplementedError()
     if not os.path.exists(configs_path):
@@ -150,41 +205,796 @@ def _get_config_path(config_name):
     return os.path.join(configs_path, config_name)
 
 
+_settings_store = None
+
+
+def _get_settings_store():
+    global _settings_store
+    if _settings_store is None:
+        from aria2wrapper.settings import SettingsStore
+        _settings_store = SettingsStore(_get_config_path('settings.json'))
+    return _settings_store
+
+
+@traced('load-settings')
 def _load_setting():
-    settings_path = _get_config_path('settings.json')
-    if not os.path.exists(settings_path):
-        return {}
-    return json.load(open(settings_path, 'r'))
+    return _get_settings_store().load()
 
 
+@traced('save-settings')
 def _save_setting(settings):
-    json.dump(settings, open(_get_config_path('settings.json'), 'w'))
+    _get_settings_store().save(settings)
 
 
-def _change_aria2_state(state, output_dir, rpc_secret):
+def _get_aria2_client(settings=None):
+    from aria2wrapper.rpc import Aria2Client
+    if settings is None:
+        settings = _load_setting()
+    return Aria2Client.from_settings(settings)
+
+
+def _get_disk_options(output_dir, settings, refresh=False,
+                      background=False):
+    # Explicit settings win; the rest comes from the cached profile of
+    # the download directory's filesystem.
+    from aria2wrapper.disk import (DISK_OPTIONS, DiskProfile, get_profile,
+                                   choose_options)
+    explicit = dict((key, str(settings[key])) for key in DISK_OPTIONS
+                    if settings.get(key) not in (None, ''))
+    if not settings.get('disk-tuning', True):
+        return explicit, DiskProfile(output_dir), []
+    try:
+        profile = get_profile(output_dir,
+                              _get_config_path('disk-profile.json'),
+                              refresh=refresh, background=background)
+    except (IOError, OSError):
+        return explicit, DiskProfile(output_dir), []
+    options, reasons = choose_options(profile)
+    options.update(explicit)
+    return options, profile, reasons
+
+
+_aria2_state_lock = threading.RLock()
+
+
+@traced('change-aria2c-state')
+def _change_aria2_state(state, output_dir, rpc_secret, rpc_port=None,
+                        options=None, ready_timeout=10):
+    """Stops aria2c and, if ``state``, starts it again and waits until its
+    RPC port answers.  Returns the ready Aria2Handle (None when stopping);
+    raises Aria2StartError if aria2c dies or does not come up in time
+    (stopping it).  Concurrent calls are serialized, so a double toggle
+    cannot leave two aria2c behind."""
+    from aria2wrapper.process import (build_aria2_args, Aria2Handle,
+                                      Aria2StartError)
+    from aria2wrapper.session import pending_path
     if not output_dir:
         output_dir = os.path.join(os.path.expanduser('~'),
                                   'Downloads')
     aria2_bin = _get_aria2_bin()
-    _terminate_aria2_process(aria2_bin)
-    if state:
+    with _aria2_state_lock:
+        _terminate_aria2_process(aria2_bin)
+        if not state:
+            return None
+        settings = _load_setting()
         session_file = _get_config_path('aria2.session')
-        args = [aria2_bin, '--enable-rpc',
-                '--rpc-listen-all=true',
-                '--rpc-allow-origin-all',
-                '--continue=true',
-                '--save-session={}'.
-                format(session_file),
-                '--dir={}'.format(output_dir)]
-        if os.path.exists(session_file):
-            args.append('--input-file={}'.format(session_file))
-        if rpc_secret:
-            args.append('--rpc-secret={}'.format(rpc_secret))
-        subprocess.Popen(args, close_fds=True)
+        if os.path.exists(session_file) or \
+                os.path.exists(pending_path(session_file)):
+            with span('compact-session'):
+                _compact_session(session_file, output_dir, settings)
+        with span('disk-options'):
+            # Under the lock, maybe on the tray's main thread: a missing
+            # profile is probed in the background for the next start.
+            options = dict(_get_disk_options(output_dir, settings,
+                                             background=True)[0],
+                           **(options or {}))
+        args = build_aria2_args(aria2_bin, output_dir, session_file,
+                                rpc_secret, rpc_port, options)
+        with span('spawn-aria2c'):
+            handle = Aria2Handle(subprocess.Popen(args, close_fds=True),
+                                 rpc_port, rpc_secret)
+            _get_aria2_tracker(aria2_bin).\
+                attach(handle.popen,
+                       {'rpc-port': rpc_port, 'rpc-secret': rpc_secret})
+        with span('apply-limits'):
+            _apply_aria2_limits(handle.pid, settings)
+        with span('wait-ready'):
+            try:
+                handle.wait_ready(ready_timeout)
+            except Aria2StartError:
+                # A hung aria2c is stopped, so that callers (and the
+                # daemon's supervisor) see the failed start as an exit.
+                handle.stop()
+                _get_aria2_tracker(aria2_bin).clear()
+                raise
+    if os.path.exists(pending_path(session_file)):
+        thread = threading.Thread(target=_load_pending_session,
+                                  args=(session_file, rpc_port,
+                                        rpc_secret))
+        thread.daemon = True
+        thread.start()
+    return handle
+
+
+def _compact_session(session_file, output_dir, settings):
+    # Only the history knows which downloads finished, and their length.
+    import sqlite3
+    from aria2wrapper.session import compact_session
+    store = None
+    try:
+        if settings.get('history'):
+            from aria2wrapper.history import HistoryStore
+            store = HistoryStore(_get_config_path('history.sqlite'))
+        compact_session(session_file, output_dir, _SESSION_STARTUP_ENTRIES,
+                        store.completed_size if store else None)
+    except (IOError, OSError, sqlite3.Error):
+        pass
+    finally:
+        if store is not None:
+            store.close()
+
+
+def _apply_aria2_limits(pid, settings):
+    # The resource envelope from the settings.  aria2c keeps running
+    # without the limits that cannot be applied here.
+    from aria2wrapper.governor import apply_limits, cgroup_files
+    result = apply_limits(pid, settings.get('aria2-nice'),
+                          settings.get('aria2-ionice'),
+                          settings.get('aria2-rlimits'),
+                          settings.get('aria2-cgroup'),
+                          cgroup_files(settings.get('aria2-memory-high'),
+                                       settings.get('aria2-memory-max'),
+                                       settings.get('aria2-cpu-max'),
+                                       settings.get('aria2-io-weight')))
+    for name, error in sorted(result.items()):
+        if error is not None:
+            sys.stderr.write('aria2c {} not applied: {}\n'.format(
+                name, error))
+    return result
+
+
+def _load_pending_session(session_file, rpc_port, rpc_secret):
+    from aria2wrapper.rpc import Aria2Client, DEFAULT_PORT
+    from aria2wrapper.session import load_pending
+    client = Aria2Client(rpc_port or DEFAULT_PORT, rpc_secret or None)
+    try:
+        load_pending(client, session_file)
+    except Exception:
+        pass
+    finally:
+        client.close()
+
+
+@traced('reconfigure-aria2c')
+def _reconfigure_aria2(old_settings, new_settings):
+    from aria2wrapper.reconfigure import get_runtime_options, apply_settings
+    if _get_aria2_process(_get_aria2_bin()) is None:
+        return None
+
+    def restart():
+        _change_aria2_state(True, new_settings.get('dir', None),
+                            new_settings.get('rpc-secret', None),
+                            new_settings.get('rpc-port', None),
+                            get_runtime_options(new_settings))
+    client = _get_aria2_client(old_settings)
+    new_client = _get_aria2_client(new_settings)
+    try:
+        return apply_settings(client, old_settings, new_settings, restart,
+                              new_client)
+    finally:
+        client.close()
+        new_client.close()
+
+
+def _use_cluster(settings):
+    # Several 'instances' replace the main aria2c.
+    return len(settings.get('instances') or []) > 1
+
+
+def _submit_entries(entries, client=None, cluster=None, **kwargs):
+    # (submitted, failed, elapsed): to ``client``'s aria2c, or each batch
+    # to the least loaded instance of ``cluster``.
+    from aria2wrapper.enqueue import enqueue
+    if cluster is not None:
+        results = cluster.enqueue(entries, **kwargs)
+        return (sum(r.submitted for r in results),
+                sum(r.failed for r in results),
+                sum(r.elapsed for r in results))
+    stats = enqueue(client, entries, **kwargs)
+    return stats.submitted, stats.failed, stats.elapsed
+
+
+def _get_aria2_cluster(settings=None):
+    from aria2wrapper.cluster import Aria2Cluster
+    if settings is None:
+        settings = _load_setting()
+    return Aria2Cluster.from_settings(
+        _get_aria2_bin(), os.path.dirname(_get_config_path('settings.json')),
+        settings)
+
+
+def _enqueue(paths):
+    from aria2wrapper.enqueue import parse_input_file
+    _startup_probe()
+    settings = _load_setting()
+    cluster = client = None
+    if _use_cluster(settings):
+        cluster = _get_aria2_cluster(settings)
+    else:
+        client = _get_aria2_client(settings)
+    dedup = _get_dedup(client, settings) if settings.get('dedup') else None
+    mirrors = _get_mirror_selector(None, settings) \
+        if settings.get('mirror-selection') else None
+    try:
+        for path in paths or ['-']:
+            f = sys.stdin if path == '-' else open(path, 'r')
+            try:
+                entries = parse_input_file(f)
+                hits = []
+                if dedup is not None:
+                    entries = dedup.filter(
+                        entries, lambda uris, path: hits.append(path))
+                if mirrors is not None:
+                    entries = mirrors.rank_entries(entries)
+                submitted, failed, elapsed = _submit_entries(
+                    entries, client, cluster)
+            finally:
+                if f is not sys.stdin:
+                    f.close()
+            print('{}: {} submitted, {} failed{} in {:.1f}s'.format(
+                path, submitted, failed,
+                ', {} from the dedup cache'.format(len(hits))
+                if dedup is not None else '', elapsed))
+    finally:
+        (cluster or client).close()
+        if dedup is not None:
+            dedup.cache.close()
+
+
+def _cluster(command):
+    cluster = _get_aria2_cluster()
+    _startup_probe()
+    try:
+        if command == 'start':
+            failed = [(index, error) for index, error in cluster.start()
+                      if error is not None]
+            for index, error in failed:
+                sys.stderr.write('instance {}: {}\n'.format(index, error))
+            if failed:
+                sys.exit(1)
+        elif command == 'stop':
+            cluster.stop()
+        else:
+            print(json.dumps(cluster.status(), indent=2))
+    finally:
+        cluster.close()
+
+
+def _get_output_dir(settings):
+    return settings.get('dir', None) or \
+        os.path.join(os.path.expanduser('~'), 'Downloads')
+
+
+def _diagnose(output_dir=None):
+    settings = _load_setting()
+    output_dir = output_dir or _get_output_dir(settings)
+    options, profile, reasons = _get_disk_options(output_dir, settings,
+                                                  refresh=True)
+    _startup_probe()
+    print('download directory: {}'.format(profile.path))
+    print('filesystem:         {}'.format(profile.fs_type))
+    print('fallocate:          {}'.format(
+        'no' if profile.fallocate is None
+        else '{:.1f} ms for 64 MiB'.format(profile.fallocate * 1000)))
+    if profile.free is not None:
+        print('free space:         {:.1f} GB'.format(profile.free / 1e9))
+    if profile.write_speed is not None:
+        print('sequential write:   {:.1f} MB/s'.
+              format(profile.write_speed / 1e6))
+    print('')
+    for name in sorted(options):
+        print('--{}={}{}'.format(name, options[name],
+                                 '  (from settings)'
+                                 if settings.get(name) not in (None, '')
+                                 else ''))
+    if not settings.get('disk-tuning', True):
+        print('disk tuning is off in the settings')
+    for reason in reasons:
+        print('  - ' + reason)
+
+
+def _start_post_processor(monitor, settings, threads=False):
+    """With ``threads`` the stages run in worker threads instead of a
+    forked process pool: the tray forks after AppKit is loaded and its
+    threads are running, which macOS does not survive reliably."""
+    import multiprocessing
+    from aria2wrapper.postprocess import PostProcessor, Aria2PostProcessor
+
+    def on_error(job, stage, error):
+        sys.stderr.write('post-process {} failed for {}: {}\n'.
+                         format(stage, job['gid'], error))
+    kwargs = {'on_error': on_error}
+    if threads:
+        kwargs.update(processes=0,
+                      concurrency=settings.get('post-process-workers') or
+                      multiprocessing.cpu_count())
+    post_processor = Aria2PostProcessor(
+        _get_aria2_client(settings),
+        PostProcessor.from_settings(settings, **kwargs))
+    monitor.add_event_listener(post_processor.on_event)
+    post_processor.start()
+    return post_processor
+
+
+def _start_scheduler(monitor, settings):
+    from aria2wrapper.scheduler import Aria2Scheduler
+    scheduler = Aria2Scheduler(_get_aria2_client(settings),
+                               interval=settings.get('scheduler-interval', 1),
+                               limits=settings.get('scheduler-limits'))
+    monitor.add_event_listener(scheduler.on_event)
+    scheduler.start()
+    return scheduler
+
+
+def _get_dedup(client, settings):
+    from aria2wrapper.files import parse_size
+    from aria2wrapper.dedup import DedupCache, Aria2Dedup
+    output_dir = _get_output_dir(settings)
+    # Next to the downloads by default, so they can be hard linked.
+    cache = DedupCache(_get_config_path('dedup.sqlite'),
+                       os.path.expanduser(settings.get('dedup-dir') or
+                                          os.path.join(output_dir,
+                                                       '.aria2-dedup')),
+                       parse_size(settings.get('dedup-max-size') or '10G'))
+    return Aria2Dedup(client, cache, output_dir)
+
+
+def _start_dedup(monitor, settings):
+    dedup = _get_dedup(_get_aria2_client(settings), settings)
+    monitor.add_event_listener(dedup.on_event)
+    dedup.start()
+    return dedup
+
+
+def _dedup_stats():
+    _startup_probe()
+    settings = _load_setting()
+    dedup = _get_dedup(None, settings)
+    try:
+        print(json.dumps(dedup.stats(), indent=2))
+    finally:
+        dedup.cache.close()
+
+
+def _get_mirror_selector(client, settings):
+    from aria2wrapper.files import parse_size
+    from aria2wrapper.mirrors import MirrorSelector
+    return MirrorSelector(
+        client, parse_size(settings.get('mirror-probe-size') or '64K'),
+        max_uris=settings.get('mirror-max-uris'),
+        interval=settings.get('mirror-interval', 5))
+
+
+def _start_mirrors(monitor, settings):
+    mirrors = _get_mirror_selector(_get_aria2_client(settings), settings)
+    monitor.add_event_listener(mirrors.on_event)
+    mirrors.start()
+    return mirrors
+
+
+def _start_metrics(monitor, settings):
+    # The sampler and its HTTP endpoint on 'metrics-port'.  A port in
+    # use costs the endpoint only; the tuner still reads the sampler.
+    import socket
+    from aria2wrapper.metrics import Aria2Sampler, start_metrics_server
+    sampler = Aria2Sampler(_get_aria2_client(settings),
+                           settings.get('metrics-interval', 5))
+    monitor.add_event_listener(
+        lambda method, gid:
+        method == 'aria2.onDownloadError' and sampler.record_error())
+    sampler.start()
+    try:
+        server = start_metrics_server(sampler, settings['metrics-port'])
+    except socket.error as e:
+        sys.stderr.write('metrics endpoint on port {} not started: {}\n'.
+                         format(settings['metrics-port'], e))
+        server = None
+    return sampler, server
+
+
+def _start_tuner(monitor, settings, sampler=None):
+    from aria2wrapper.concurrency import Aria2ConcurrencyTuner
+    interval = settings.get('adaptive-interval', 30)
+    tuner = Aria2ConcurrencyTuner(
+        _get_aria2_client(settings), interval,
+        settings.get('concurrency-limits'),
+        (lambda: sampler.rate(interval)) if sampler else None)
+    monitor.add_event_listener(tuner.on_event)
+    tuner.start()
+    return tuner
+
+
+def _start_ingester(monitor, settings):
+    from aria2wrapper.ingest import Aria2Ingester
+    ingester = Aria2Ingester(
+        _get_aria2_client(settings),
+        [os.path.expanduser(path) for path in settings['watch-dirs']],
+        settings.get('watch-debounce', 0.5),
+        settings.get('watch-processed-dir', '.processed'),
+        settings.get('watch-failed-dir', '.failed'))
+    monitor.add_event_listener(ingester.on_event)
+    ingester.start()
+    return ingester
+
+
+def _start_history(monitor, settings):
+    from aria2wrapper.history import HistoryStore, Aria2HistoryRecorder
+    recorder = Aria2HistoryRecorder(
+        _get_aria2_client(settings),
+        HistoryStore(_get_config_path('history.sqlite')),
+        settings.get('history-interval', 60))
+    monitor.add_event_listener(recorder.on_event)
+    recorder.start()
+    return recorder
+
+
+def _start_governor(settings):
+    from aria2wrapper.files import parse_size
+    from aria2wrapper.governor import ProcessSampler, Aria2Governor
+    tracker = _get_aria2_tracker(_get_aria2_bin())
+    budgets = {'cpu': settings.get('governor-max-cpu')}
+    for name in ('rss', 'io'):
+        budget = settings.get('governor-max-' + name)
+        budgets[name] = parse_size(budget) if budget else None
+    governor = Aria2Governor(_get_aria2_client(settings),
+                             ProcessSampler(tracker.get_process), budgets,
+                             settings.get('governor-interval', 2))
+    governor.start()
+    return governor
+
+
+def _history(argv):
+    import argparse
+    import datetime
+    from aria2wrapper.history import HistoryStore, parse_time
+    parser = argparse.ArgumentParser(prog='main.py history')
+    parser.add_argument('--uri')
+    parser.add_argument('--uri-prefix')
+    parser.add_argument('--since', type=parse_time,
+                        help='Unix time, YYYY-MM-DD[THH:MM[:SS]] or '
+                             '-SECONDS (ago)')
+    parser.add_argument('--until', type=parse_time)
+    parser.add_argument('--status',
+                        choices=('complete', 'error', 'removed'))
+    parser.add_argument('--limit', type=int, default=100)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args(argv)
+    _startup_probe()
+    store = HistoryStore(_get_config_path('history.sqlite'))
+    try:
+        rows = store.query(args.uri, args.uri_prefix, args.since,
+                           args.until, args.status, args.limit)
+    finally:
+        store.close()
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    for row in rows:
+        print('{} {:<8} {:>12} {:>8} {:>10} {} {}'.format(
+            datetime.datetime.fromtimestamp(row['finished']).strftime(
+                '%Y-%m-%d %H:%M:%S'),
+            row['status'] if not row['error_code']
+            else 'error:{}'.format(row['error_code']),
+            row['size'],
+            '{:.1f}s'.format(row['duration'])
+            if row['duration'] is not None else '-',
+            '{:.0f}B/s'.format(row['speed'])
+            if row['speed'] is not None else '-',
+            row['uri'] or '-', row['path'] or '-'))
+
+
+def _start_tracing(settings):
+    # Spans while the 'trace' setting is on; the profiler on SIGUSR2 or
+    # `main.py ctl trace profile`, whatever the setting.
+    from aria2wrapper import trace
+    if settings.get('trace'):
+        trace.enable(settings.get('trace-size', 10000))
+    trace.install_signal_handler(
+        os.path.dirname(_get_config_path('settings.json')))
+
+
+def _daemon():
+    from aria2wrapper.process import Aria2StartError
+    from aria2wrapper.reconfigure import get_runtime_options
+    from aria2wrapper.supervisor import Aria2Supervisor
+    _startup_probe()
+
+    def spawn():
+        settings = _load_setting()
+        options = get_runtime_options(settings)
+        # aria2c only writes the session on a clean exit; also save it
+        # periodically so a crash loses little.
+        options.setdefault('save-session-interval',
+                           settings.get('save-session-interval') or 60)
+        try:
+            return _change_aria2_state(True, settings.get('dir', None),
+                                       settings.get('rpc-secret', None),
+                                       settings.get('rpc-port', None),
+                                       options)
+        except Aria2StartError as e:
+            # Supervised like any other exit; a hung aria2c was stopped.
+            sys.stderr.write('{}\n'.format(e))
+            return e.handle
+
+    def shutdown():
+        if history is not None:
+            # aria2c takes its stopped downloads with it.
+            try:
+                history.sync()
+            except Exception:
+                pass
+        # Waits for a spawn() in progress, so its aria2c is stopped too.
+        with _aria2_state_lock:
+            _terminate_aria2_process(_get_aria2_bin())
+
+    def status():
+        result = {'paused': supervisor.paused,
+                  'restarts': len(supervisor.restarts)}
+        if post_processor is not None:
+            result['post-process'] = post_processor.stats()
+        if scheduler is not None:
+            result['scheduler'] = scheduler.stats()
+        if history is not None:
+            result['history'] = history.stats()
+        if dedup is not None:
+            result['dedup'] = dedup.stats()
+        if mirrors is not None:
+            result['mirrors'] = mirrors.stats()
+        if governor is not None:
+            result['governor'] = governor.stats()
+        if ingester is not None:
+            result['watch'] = ingester.stats()
+        if cluster is not None:
+            result['cluster'] = cluster.status()
+        return result
+    settings = _load_setting()
+    cluster = None
+    if _use_cluster(settings):
+        cluster = _get_aria2_cluster(settings)
+        # The instances take the main aria2c's place.
+        with _aria2_state_lock:
+            _terminate_aria2_process(_get_aria2_bin())
+        supervisor = cluster.supervise()
+    else:
+        supervisor = Aria2Supervisor(spawn, shutdown)
+    _start_tracing(settings)
+    monitor = post_processor = scheduler = history = dedup = mirrors = None
+    ingester = sampler = metrics_server = tuner = None
+    if any(settings.get(name) for name in ('post-process', 'scheduler',
+                                           'history', 'dedup',
+                                           'mirror-selection',
+                                           'watch-dirs', 'metrics-port',
+                                           'adaptive-concurrency')):
+        from aria2wrapper.rpc import DEFAULT_PORT
+        from aria2wrapper.monitor import Aria2Monitor
+        monitor = Aria2Monitor(settings.get('rpc-port') or DEFAULT_PORT,
+                               is_alive=lambda: _get_aria2_process(
+                                   _get_aria2_bin()) is not None)
+        if settings.get('post-process'):
+            post_processor = _start_post_processor(monitor, settings)
+        if settings.get('scheduler'):
+            scheduler = _start_scheduler(monitor, settings)
+        if settings.get('history'):
+            history = _start_history(monitor, settings)
+        if settings.get('dedup'):
+            dedup = _start_dedup(monitor, settings)
+        if settings.get('mirror-selection'):
+            mirrors = _start_mirrors(monitor, settings)
+        if settings.get('watch-dirs'):
+            ingester = _start_ingester(monitor, settings)
+        if settings.get('metrics-port'):
+            sampler, metrics_server = _start_metrics(monitor, settings)
+        if settings.get('adaptive-concurrency'):
+            tuner = _start_tuner(monitor, settings, sampler)
+        monitor.start()
+    governor = None
+    if settings.get('governor'):
+        governor = _start_governor(settings)
+    server = _start_control_server(supervisor.resume, supervisor.pause,
+                                   status, scheduler, dedup, mirrors,
+                                   cluster)
+    try:
+        supervisor.run()
+    finally:
+        if server is not None:
+            server.stop()
+        if monitor is not None:
+            monitor.stop()
+        if post_processor is not None:
+            post_processor.stop()
+        if scheduler is not None:
+            scheduler.stop()
+        if history is not None:
+            history.stop()
+        if dedup is not None:
+            dedup.stop()
+        if mirrors is not None:
+            mirrors.stop()
+        if governor is not None:
+            governor.stop()
+        if ingester is not None:
+            ingester.stop()
+        if metrics_server is not None:
+            metrics_server.shutdown()
+        if sampler is not None:
+            sampler.stop()
+        if tuner is not None:
+            tuner.stop()
+        if cluster is not None:
+            cluster.close()
+
+
+def _start_control_server(start, stop, status=None, scheduler=None,
+                          dedup=None, mirrors=None, cluster=None):
+    # Lets `main.py ctl ...` drive this process instead of doing the work
+    # in a freshly started interpreter.
+    from aria2wrapper.control import ControlServer, ControlError
+    applied = [_load_setting()]
+
+    def get_status():
+        settings = _load_setting()
+        tracker = _get_aria2_tracker(_get_aria2_bin())
+        result = {'running': tracker.get_process() is not None,
+                  'pid': tracker.pid,
+                  'rpc-port': settings.get('rpc-port', None),
+                  'dir': settings.get('dir', None)}
+        if status is not None:
+            result.update(status())
+        return result
+
+    def reconfigure():
+        new_settings = _load_setting()
+        report = _reconfigure_aria2(applied[0], new_settings)
+        applied[0] = new_settings
+        return report
+
+    def enqueue(entries):
+        entries = [(entry['uris'], entry.get('options'))
+                   for entry in entries]
+        hits = []
+        if dedup is not None:
+            entries = list(dedup.filter(
+                entries, lambda uris, path: hits.append(path)))
+        on_result = None
+        if mirrors is not None:
+            entries = mirrors.rank_entries(entries)
+            # Only the main aria2c's downloads get their URIs reordered.
+            on_result = mirrors.track if cluster is None else None
+        if cluster is not None:
+            submitted, failed, elapsed = _submit_entries(
+                entries, cluster=cluster, on_result=on_result)
+        elif scheduler is not None:
+            # Honours " priority=..." and " deadline=..." options.
+            stats = scheduler.enqueue(entries, on_result=on_result)
+            submitted, failed, elapsed = \
+                stats.submitted, stats.failed, stats.elapsed
+        else:
+            client = _get_aria2_client()
+            try:
+                submitted, failed, elapsed = _submit_entries(
+                    entries, client, on_result=on_result)
+            finally:
+                client.close()
+        return {'submitted': submitted, 'failed': failed,
+                'cached': len(hits), 'elapsed': elapsed}
+
+    def trace(action='dump', path=None, seconds=5):
+        # on/off: the span ring; dump: write it out; profile: sample
+        # every thread for ``seconds`` in the background, then write
+        # ring and samples to ``path``.
+        from aria2wrapper import trace as tracing
+        if action == 'on':
+            tracing.enable(_load_setting().get('trace-size', 10000))
+        elif action == 'off':
+            tracing.disable()
+        elif action not in ('dump', 'profile'):
+            raise ValueError('unknown trace action: ' + action)
+        if action in ('on', 'off'):
+            return {'enabled': tracing.enabled()}
+        path = path or tracing.dump_path(
+            os.path.dirname(_get_config_path('settings.json')), action)
+        if action == 'dump':
+            return {'path': path, 'enabled': tracing.enabled(),
+                    'spans': tracing.write_trace(path)}
+        if not tracing.profile_for(float(seconds), path):
+            raise ValueError('the profiler is running already')
+        return {'path': path, 'seconds': float(seconds)}
+    server = ControlServer(_get_config_path('control.sock'),
+                           {'status': get_status, 'start': start,
+                            'stop': stop, 'reconfigure': reconfigure,
+                            'enqueue': enqueue, 'trace': trace})
+    try:
+        server.start()
+    except (NotImplementedError, ControlError, EnvironmentError):
+        return None
+    return server
+
+
+def _ctl(argv):
+    from aria2wrapper.control import ControlClient, ControlError
+    command = argv[0] if argv else 'status'
+    args = {}
+    if command == 'trace':
+        # trace on|off|dump [PATH]|profile [SECONDS [PATH]]
+        args['action'] = argv[1] if len(argv) > 1 else 'dump'
+        rest = argv[2:]
+        if args['action'] == 'profile' and rest:
+            args['seconds'] = float(rest.pop(0))
+        if rest:
+            args['path'] = os.path.abspath(rest[0])
+    _startup_probe()
+    try:
+        client = ControlClient(_get_config_path('control.sock'))
+    except EnvironmentError:
+        sys.stderr.write('aria2-wrapper is not running\n')
+        sys.exit(1)
+    totals = {'submitted': 0, 'failed': 0, 'cached': 0, 'elapsed': 0.0}
+    try:
+        if command == 'enqueue':
+            result = _ctl_enqueue(client, argv[1:], totals)
+        else:
+            result = client.request(command, **args)
+    except ControlError as e:
+        sys.stderr.write('{}\n'.format(e))
+        if command == 'enqueue':
+            sys.stderr.write('before that: {submitted} submitted, {failed} '
+                             'failed, {cached} cached\n'.format(**totals))
+        sys.exit(1)
+    finally:
+        client.close()
+    if result is not None:
+        print(json.dumps(result, indent=2))
+
+
+def _ctl_enqueue(client, paths, totals, batch_size=1000):
+    # One request per batch: memory stays flat, and no request has to
+    # get the whole list through within the client's timeout.  The
+    # results are added up in ``totals``.
+    from aria2wrapper.enqueue import parse_input_file
+
+    def send(batch):
+        result = client.request('enqueue', entries=batch)
+        for key in totals:
+            totals[key] += result.get(key, 0)
+    for path in paths or ['-']:
+        f = sys.stdin if path == '-' else open(path, 'r')
+        try:
+            batch = []
+            for uris, options in parse_input_file(f):
+                batch.append({'uris': uris, 'options': options})
+                if len(batch) >= batch_size:
+                    send(batch)
+                    batch = []
+            if batch:
+                send(batch)
+        finally:
+            if f is not sys.stdin:
+                f.close()
+    return totals
 
 
 def _show_preferences():
+    try:
+        import Tkinter as tk
+        import tkFileDialog as filedialog
+    except ImportError:
+        import tkinter as tk
+        from tkinter import filedialog
+    from PIL import Image, ImageTk
+    from aria2wrapper.reconfigure import get_runtime_options
+    _startup_probe()
     settings = _load_setting()
+    old_settings = dict(settings)
 
     window = tk.Tk()
     window.resizable(0, 0)
@@ -240,14 +1050,22 @@ def _show_preferences():
     aria2_state.grid(row=row, column=1, columnspan=2, sticky='w')
 
     def on_aria2_switched(event):
+        from aria2wrapper.process import Aria2StartError
         state = not aria2_started.get()
-        _change_aria2_state(state, store_dir.get(),
-                            store_rpc_secret.get())
+        try:
+            _change_aria2_state(state, store_dir.get(),
+                                store_rpc_secret.get(),
+                                settings.get('rpc-port', None),
+                                get_runtime_options(settings))
+        except Aria2StartError:
+            state = False
         if state:
             aria2_state['text'] = on_text
         else:
             aria2_state['text'] = off_text
         aria2_started.set(state)
+        old_settings['dir'] = store_dir.get()
+        old_settings['rpc-secret'] = store_rpc_secret.get()
         event.widget['image'] = on_image if state else off_image
     aria2_switcher.bind('<ButtonRelease-1>', on_aria2_switched)
 
@@ -311,6 +1129,10 @@ def _show_preferences():
         settings['rpc-secret'] = store_rpc_secret.get()
         settings['startup'] = run_with_system.get()
         _save_setting(settings)
+        try:
+            _reconfigure_aria2(old_settings, settings)
+        except Exception:
+            pass
     window.bind("<Destroy>", on_destroty)
 
     window.lift()
@@ -320,8 +1142,39 @@ def _show_preferences():
 if __name__ == "__main__":
     if len(sys.argv) > 1 and sys.argv[1] == 'preferences':
         _show_preferences()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'enqueue':
+        _enqueue(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'daemon':
+        _daemon()
+    elif len(sys.argv) > 1 and sys.argv[1] == 'cluster':
+        _cluster(sys.argv[2] if len(sys.argv) > 2 else 'status')
+    elif len(sys.argv) > 1 and sys.argv[1] == 'diagnose':
+        _diagnose(sys.argv[2] if len(sys.argv) > 2 else None)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'ctl':
+        _ctl(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'history':
+        _history(sys.argv[2:])
+    elif len(sys.argv) > 1 and sys.argv[1] == 'dedup':
+        _dedup_stats()
     else:
+        from aria2wrapper.process import Aria2StartError
+        from aria2wrapper.reconfigure import get_runtime_options
+        if sys.platform == 'darwin':
+            import rumps
+            from PyObjCTools import AppHelper
+            from aria2wrapper.rpc import DEFAULT_PORT
+            from aria2wrapper.monitor import Aria2Monitor
+        elif sys.platform == 'win32':
+            import win32api
+            import win32con
+            import win32gui_struct
+            try:
+                import winxpgui as win32gui
+            except ImportError:
+                import win32gui
+        _startup_probe()
         settings = _load_setting()
+        _start_tracing(settings)
         if settings.get('startup', None) is None:
             try:
                 _registry_as_startup(_get_app_path())
@@ -329,8 +1182,13 @@ if __name__ == "__main__":
                 _save_setting(settings)
             except Exception:
                 pass
-        _change_aria2_state(True, settings.get('dir', None),
-                            settings.get('rpc-secret', None))
+        try:
+            _change_aria2_state(True, settings.get('dir', None),
+                                settings.get('rpc-secret', None),
+                                settings.get('rpc-port', None),
+                                get_runtime_options(settings))
+        except Aria2StartError as e:
+            sys.stderr.write('{}\n'.format(e))
 
         def _start_preferences():
             if hasattr(sys, 'frozen'):
@@ -349,7 +1207,6 @@ if __name__ == "__main__":
                                   'preferences'], close_fds=True)
 
         if sys.platform == 'darwin':
-            import rumps
             rumps._NOTIFICATIONS = False
 
             class Aria2WrapperApp(rumps.App):
@@ -361,6 +1218,79 @@ if __name__ == "__main__":
                                  rumps.separator,
                                  'Quit']
                     self.set_aria2_state(True)
+                    settings = _load_setting()
+                    self.monitor = Aria2Monitor(
+                        settings.get('rpc-port') or DEFAULT_PORT,
+                        is_alive=lambda: _get_aria2_process(
+                            _get_aria2_bin()) is not None)
+                    self.monitor.add_state_listener(
+                        lambda state: AppHelper.callAfter(
+                            self.set_aria2_state, state))
+                    self.monitor.start()
+                    _get_settings_store().subscribe(self.on_settings_changed)
+                    self.sampler = self.metrics_server = None
+                    if settings.get('metrics-port'):
+                        self.sampler, self.metrics_server = _start_metrics(
+                            self.monitor, settings)
+                    self.tuner = None
+                    if settings.get('adaptive-concurrency'):
+                        self.tuner = _start_tuner(self.monitor, settings,
+                                                  self.sampler)
+                    self.post_processor = None
+                    if settings.get('post-process'):
+                        self.post_processor = _start_post_processor(
+                            self.monitor, settings, threads=True)
+                    self.scheduler = None
+                    if settings.get('scheduler'):
+                        self.scheduler = _start_scheduler(self.monitor,
+                                                          settings)
+                    self.history = None
+                    if settings.get('history'):
+                        self.history = _start_history(self.monitor,
+                                                      settings)
+                    self.dedup = None
+                    if settings.get('dedup'):
+                        self.dedup = _start_dedup(self.monitor, settings)
+                    self.mirrors = None
+                    if settings.get('mirror-selection'):
+                        self.mirrors = _start_mirrors(self.monitor,
+                                                      settings)
+                    self.governor = None
+                    if settings.get('governor'):
+                        self.governor = _start_governor(settings)
+                    self.ingester = None
+                    if settings.get('watch-dirs'):
+                        self.ingester = _start_ingester(self.monitor,
+                                                        settings)
+                    self.control = _start_control_server(
+                        lambda: self.control_aria2_state(True),
+                        lambda: self.control_aria2_state(False),
+                        self.extra_status, self.scheduler, self.dedup,
+                        self.mirrors)
+
+                def extra_status(self):
+                    status = {}
+                    if self.post_processor is not None:
+                        status['post-process'] = self.post_processor.stats()
+                    if self.scheduler is not None:
+                        status['scheduler'] = self.scheduler.stats()
+                    if self.history is not None:
+                        status['history'] = self.history.stats()
+                    if self.dedup is not None:
+                        status['dedup'] = self.dedup.stats()
+                    if self.mirrors is not None:
+                        status['mirrors'] = self.mirrors.stats()
+                    if self.governor is not None:
+                        status['governor'] = self.governor.stats()
+                    if self.ingester is not None:
+                        status['watch'] = self.ingester.stats()
+                    return status
+
+                def on_settings_changed(self, settings):
+                    port = settings.get('rpc-port') or DEFAULT_PORT
+                    if port != self.monitor.port:
+                        self.monitor.port = port
+                        self.monitor.wake()
 
                 def set_aria2_state(self, state):
                     item = self.menu['Aria2']
@@ -374,14 +1304,38 @@ if __name__ == "__main__":
 
                 def change_aria2_state(self, state):
                     settings = _load_setting()
-                    _change_aria2_state(state, settings.get('dir', None),
-                                        settings.get('rpc-secret', None))
+                    try:
+                        _change_aria2_state(state,
+                                            settings.get('dir', None),
+                                            settings.get('rpc-secret', None),
+                                            settings.get('rpc-port', None),
+                                            get_runtime_options(settings))
+                    except Aria2StartError as e:
+                        sys.stderr.write('{}\n'.format(e))
+                        state = False
                     self.set_aria2_state(state)
+                    self.monitor.wake()
 
-                @rumps.timer(1)
-                def refresh_aria2_state(self, sender):
-                    self.set_aria2_state(_get_aria2_process(
-                                         _get_aria2_bin()) is not None)
+                def control_aria2_state(self, state):
+                    # Runs on the control socket's thread; only the menu
+                    # update goes through the main loop.  A failed start
+                    # is reported back to the control client.
+                    settings = _load_setting()
+                    try:
+                        handle = _change_aria2_state(
+                            state, settings.get('dir', None),
+                            settings.get('rpc-secret', None),
+                            settings.get('rpc-port', None),
+                            get_runtime_options(settings))
+                    except Aria2StartError:
+                        AppHelper.callAfter(self.set_aria2_state, False)
+                        raise
+                    finally:
+                        self.monitor.wake()
+                    AppHelper.callAfter(self.set_aria2_state, state)
+                    if handle is not None:
+                        return {'pid': handle.pid,
+                                'ready-latency': handle.ready_latency}
 
                 @rumps.clicked('Aria2')
                 def aria2_switcher(self, sender):
@@ -393,18 +1347,34 @@ if __name__ == "__main__":
 
                 @rumps.clicked('Quit')
                 def quit(self, sender):
+                    self.monitor.stop()
+                    if self.control is not None:
+                        self.control.stop()
+                    _get_settings_store().close()
+                    if self.metrics_server is not None:
+                        self.metrics_server.shutdown()
+                    if self.sampler is not None:
+                        self.sampler.stop()
+                    if self.tuner is not None:
+                        self.tuner.stop()
+                    if self.post_processor is not None:
+                        self.post_processor.stop()
+                    if self.scheduler is not None:
+                        self.scheduler.stop()
+                    if self.history is not None:
+                        self.history.stop()
+                    if self.dedup is not None:
+                        self.dedup.stop()
+                    if self.mirrors is not None:
+                        self.mirrors.stop()
+                    if self.governor is not None:
+                        self.governor.stop()
+                    if self.ingester is not None:
+                        self.ingester.stop()
                     _terminate_aria2_process(_get_aria2_bin(), False)
                     rumps.quit_application(sender)
             Aria2WrapperApp().run()
         elif sys.platform == 'win32':
-            import win32api
-            import win32con
-            import win32gui_struct
-            try:
-                import winxpgui as win32gui
-            except ImportError:
-                import win32gui
-
             def non_string_iterable(obj):
                 try:
                     iter(obj)
@@ -639,8 +1609,13 @@ if __name__ == "__main__":
 
             def change_aria2_state(systray, state):
                 settings = _load_setting()
-                _change_aria2_state(state, settings.get('dir', None),
-                                    settings.get('rpc-secret', None))
+                try:
+                    _change_aria2_state(state, settings.get('dir', None),
+                                        settings.get('rpc-secret', None),
+                                        settings.get('rpc-port', None),
+                                        get_runtime_options(settings))
+                except Aria2StartError:
+                    state = False
                 set_aria2_state(state)
 
             def quit(_):
@@ -0,0 +1,32 @@
+# coding=utf-8
+
+import unittest
+
+from aria2wrapper.mirrors import MirrorSelector
+
+
+class _Client(object):
+    # aria2 with one active download from a single, never probed host.
+    def tellActive(self, keys=None):
+        return [{'gid': '1'}]
+
+    def multicall(self, calls):
+        return [[{'index': '1', 'servers': [
+            {'uri': 'http://a.example/f', 'currentUri': 'http://a.example/f',
+             'downloadSpeed': '1048576'}]}] for _ in calls]
+
+
+class MirrorSelectorTest(unittest.TestCase):
+    def test_live_speed_of_unprobed_host(self):
+        selector = MirrorSelector(_Client(), probe=None)
+        selector.step()
+        self.assertEqual(selector.rank(['http://b.example/f',
+                                        'http://a.example/f'], False),
+                         ['http://a.example/f', 'http://b.example/f'])
+        host = selector.stats()['hosts']['a.example']
+        self.assertIsNone(host['latency'])
+        self.assertAlmostEqual(host['cost'], 64.0)
+
+
+if __name__ == '__main__':
+    unittest.main()